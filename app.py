@@ -8,24 +8,33 @@ from flask import Flask, render_template
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 import os
-from controllers.extensions import db
-from werkzeug.security import generate_password_hash
+from controllers.extensions import db, engine_options, install_sqlite_pragmas
+from controllers.config import get_config
+from controllers.cache import cache
+from controllers.windows import windows
+from controllers.lotsearch import lot_search
+from controllers.jobs import export_jobs
+from controllers.fragments import fragments
 
 # Initialize extensions - got this from Flask docs
 login_manager = LoginManager()
 
-def create_app():
+def create_app(config_class=None):
     app = Flask(__name__)
-    # TODO: change this secret key in production (if I ever deploy this)
-    app.config['SECRET_KEY'] = 'my_super_secret_key_12345'  # i know this is bad but its just for demo
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///parking.db'
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # this reduces memory usage
-    
-    # TODO: add environment variables for production
-    # learned about this from a blog post but haven't implemented yet
+    # settings come from controllers/config.py, which reads environment variables
+    # (SECRET_KEY, DATABASE_URL, PARKING_CONFIG, ...)
+    app.config.from_object(config_class or get_config())
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
 
     db.init_app(app)
     login_manager.init_app(app)
+    cache.init_app(app)
+    windows.init_app(app)
+    lot_search.init_app(app)
+    export_jobs.init_app(app)
+    fragments.init_app(app)
+    with app.app_context():
+        install_sqlite_pragmas(app)  # WAL, busy_timeout etc. for SQLite
 
     # Register blueprints - had to put this here to avoid circular import issues
     # spent like 2 hours debugging this lol - kept getting import errors
@@ -36,36 +45,53 @@ def create_app():
     from controllers.api import api_bp
     app.register_blueprint(api_bp)
 
+    from controllers.commands import register_commands
+    register_commands(app)
+
+    from controllers.metrics import metrics
+    metrics.init_app(app)  # latency / SQL / template timings per route, served on /metrics
+
     with app.app_context():
         from models.models import User, ParkingLot, ParkingSpot, Reservation
         db.create_all()
+        # create_all can't change existing tables, migrations add new columns/indexes
+        from models import migrations
+        migrations.upgrade()
         
         # make sure admin user exists - this is for testing purposes
         admin_user = User.query.filter_by(username='admin').first()
         if not admin_user:
             # default admin password is 'admin' - change this later
             # got this idea from a tutorial but simplified it
-            admin_user = User(username='admin', password=generate_password_hash('admin'), role='admin')
+            from controllers.security import hash_password
+            admin_user = User(username='admin', password=hash_password('admin'), role='admin')
             db.session.add(admin_user)
         else:
             admin_user.role = 'admin'  # just in case - sometimes the role gets reset
         db.session.commit()
 
+        # load the free spot lists so booking doesn't need to scan the spots table
+        from controllers.availability import availability
+        availability.rebuild()
+
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        # cached id/username/role instead of a User query on every request
+        from controllers.security import load_session_user
+        return load_session_user(int(user_id))
 
     @app.route('/')
     def home():
-        from models.models import ParkingLot, ParkingSpot, Reservation
         from flask_login import current_user
         
         # get some stats for the homepage - only show to logged in users
         stats = {}
         if current_user.is_authenticated:
-            total_lots = ParkingLot.query.count()
-            total_spots = ParkingSpot.query.count()
-            total_users = User.query.filter_by(role='user').count()
+            from models.catalogue import home_stats
+            cached = home_stats()  # cached, these barely change
+            total_lots = cached['total_lots']
+            total_spots = cached['total_spots']
+            total_users = cached['total_users']
             
             # TODO: implement actual rating system later
             avg_rating = 4.8  # hardcoded for now - will add real ratings later
@@ -84,5 +110,5 @@ def create_app():
 
 if __name__ == '__main__':
     app = create_app()
-    app.run(debug=True)  # remember to set debug=False in production
+    app.run(debug=app.config['RUN_DEBUG'])  # PARKING_CONFIG=production turns debug off
     # learned about debug mode from Flask documentation 
\ No newline at end of file
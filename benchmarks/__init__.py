@@ -0,0 +1,3 @@
+# Benchmarks for ParkingPro
+# These are plain scripts, run them from the project root, e.g.
+#   python -m benchmarks.bench_provisioning
@@ -0,0 +1,66 @@
+# How long does it take to create the spots of a lot?
+# Compares the old one-ORM-object-per-spot loop with the bulk insert in
+# models/provisioning.py for a few lot sizes, each on a fresh SQLite file.
+#
+#   python -m benchmarks.bench_provisioning --sizes 100 1000 5000 20000
+
+import argparse
+import os
+import tempfile
+import time
+
+from flask import Flask
+from controllers.extensions import db
+
+
+def make_app(db_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def provision_orm(lot_id, count):
+    from models.models import ParkingSpot
+    for _ in range(count):
+        db.session.add(ParkingSpot(lot_id=lot_id, status='A'))
+
+
+def provision_bulk(lot_id, count):
+    from models.provisioning import provision_spots
+    provision_spots(lot_id, count)
+
+
+def time_one(method, size):
+    from models.models import ParkingLot
+    with tempfile.TemporaryDirectory() as tmp:
+        app = make_app(os.path.join(tmp, 'bench.db'))
+        with app.app_context():
+            db.create_all()
+            lot = ParkingLot('Bench Lot', 10.0, '1 Bench Road', '000000', size)
+            db.session.add(lot)
+            db.session.commit()
+            start = time.perf_counter()
+            method(lot.id, size)
+            db.session.commit()
+            elapsed = time.perf_counter() - start
+            db.session.remove()
+            db.engine.dispose()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time spot provisioning for different lot sizes.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000, 20000])
+    args = parser.parse_args()
+
+    print(f'{"spots":>8}  {"orm loop (s)":>12}  {"bulk (s)":>10}  {"speedup":>8}')
+    for size in args.sizes:
+        orm = time_one(provision_orm, size)
+        bulk = time_one(provision_bulk, size)
+        print(f'{size:>8}  {orm:>12.4f}  {bulk:>10.4f}  {orm / bulk if bulk else 0:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# Route benchmark
+# Drives the Flask test client against the main pages and api endpoints of a
+# database made by generate_data.py and reports p50/p95 latency and SQL
+# statements per request. Results can be saved as JSON and compared with an
+# earlier run to see whether a change made things faster or slower.
+#
+#   python -m benchmarks.bench_routes --db /tmp/bench.db --requests 50 --output before.json
+#   ... change something ...
+#   python -m benchmarks.bench_routes --db /tmp/bench.db --requests 50 --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import time
+from datetime import datetime
+
+from benchmarks.generate_data import PASSWORD
+from benchmarks.stress_booking import make_config
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def pick_targets(app):
+    # a busy lot and a user with a long history, so the numbers reflect the worst pages
+    from controllers.extensions import db
+    from models.models import ParkingLot, Reservation, User
+    from sqlalchemy import func
+    with app.app_context():
+        lot_id = (db.session.query(ParkingLot.id)
+                  .order_by(ParkingLot.maximum_number_of_spots.desc(), ParkingLot.id).limit(1).scalar())
+        user_id = (db.session.query(Reservation.user_id)
+                   .group_by(Reservation.user_id)
+                   .order_by(func.count(Reservation.id).desc()).limit(1).scalar())
+        if user_id is None:
+            user_id = db.session.query(User.id).filter(User.role == 'user').order_by(User.id).limit(1).scalar()
+        username = db.session.get(User, user_id).username
+        sizes = {
+            'lots': db.session.query(func.count(ParkingLot.id)).scalar(),
+            'reservations': db.session.query(func.count(Reservation.id)).scalar(),
+        }
+    return lot_id, user_id, username, sizes
+
+
+def scenarios(lot_id, user_id):
+    # (name, who, method, url) - who is the session the request runs in
+    return [
+        ('home', 'anon', 'GET', '/'),
+        ('admin_dashboard', 'admin', 'GET', '/admin/dashboard'),
+        ('admin_lots', 'admin', 'GET', '/admin/lots'),
+        ('admin_view_spots', 'admin', 'GET', f'/admin/lots/{lot_id}/spots'),
+        ('lot_summary', 'admin', 'GET', f'/admin/lots/{lot_id}/summary'),
+        ('lot_summary_rle', 'admin', 'GET', f'/admin/lots/{lot_id}/summary?format=rle'),
+        ('user_dashboard', 'user', 'GET', '/user/dashboard'),
+        ('user_lots', 'user', 'GET', '/user/lots'),
+        ('user_reservations', 'user', 'GET', '/user/reservations'),
+        ('book_spot', 'user', 'POST', f'/user/lots/{lot_id}/book'),
+        ('api_parking_lots', 'anon', 'GET', '/parking-lots'),
+        ('api_lot_spots', 'anon', 'GET', f'/parking-lot/{lot_id}/spots'),
+        ('api_lot_spots_bitmap', 'anon', 'GET', f'/parking-lot/{lot_id}/spots?format=bitmap'),
+        ('api_user_reservations', 'anon', 'GET', f'/user/{user_id}/reservations'),
+    ]
+
+
+def run(app, requests, warmup, only):
+    from models.queries import count_queries
+    lot_id, user_id, username, sizes = pick_targets(app)
+    clients = {'anon': app.test_client(), 'admin': app.test_client(), 'user': app.test_client()}
+    clients['admin'].post('/login', data={'username': 'admin', 'password': 'admin'})
+    clients['user'].post('/login', data={'username': username, 'password': PASSWORD})
+
+    results = {}
+    for name, who, method, url in scenarios(lot_id, user_id):
+        if only and name not in only:
+            continue
+        client = clients[who]
+        timings, statements, statuses = [], [], set()
+        for i in range(warmup + requests):
+            # same counter as the query budget tests, one per request
+            with app.app_context(), count_queries() as counter:
+                started = time.perf_counter()
+                response = client.open(url, method=method)
+                elapsed = time.perf_counter() - started
+            if i >= warmup:
+                timings.append(elapsed * 1000)
+                statements.append(counter.count)
+                statuses.add(response.status_code)
+            if name == 'book_spot':
+                _release_open(app, user_id)
+        results[name] = {
+            'url': url,
+            'p50_ms': round(percentile(timings, 50), 3),
+            'p95_ms': round(percentile(timings, 95), 3),
+            'mean_ms': round(statistics.fmean(timings), 3),
+            'queries': max(statements),
+            'status': sorted(statuses),
+        }
+        print(f'{name:24} p50 {results[name]["p50_ms"]:9.2f} ms  p95 {results[name]["p95_ms"]:9.2f} ms  '
+              f'{results[name]["queries"]:4} queries  {results[name]["status"]}')
+    return {'sizes': sizes, 'lot_id': lot_id, 'user_id': user_id}, results
+
+
+def _release_open(app, user_id):
+    # undo the booking so every book_spot run sees the same lot
+    from models import booking
+    from models.models import Reservation
+    with app.app_context():
+        for reservation in (Reservation.query
+                            .filter(Reservation.user_id == user_id, Reservation.leaving_timestamp.is_(None))
+                            .order_by(Reservation.id.desc()).limit(5)):
+            booking.release_reservation(reservation)
+
+
+def compare(old, new):
+    print(f'\n{"route":24} {"p50 before":>11} {"p50 now":>9} {"change":>8}   queries')
+    for name, now in new.items():
+        before = old.get(name)
+        if before is None:
+            continue
+        change = (now['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100 if before['p50_ms'] else 0.0
+        print(f'{name:24} {before["p50_ms"]:11.2f} {now["p50_ms"]:9.2f} {change:+7.1f}%   '
+              f'{before["queries"]} -> {now["queries"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='p50/p95 latency and query counts per route.')
+    parser.add_argument('--db', default=os.path.join('instance', 'bench.db'), help='database made by generate_data')
+    parser.add_argument('--requests', type=int, default=30, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed requests per route first (fills caches)')
+    parser.add_argument('--only', nargs='*', help='only run these scenarios')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file from an earlier run to compare against')
+    args = parser.parse_args()
+    if not os.path.exists(args.db):
+        parser.error(f'{args.db} not found, create it with python -m benchmarks.generate_data')
+
+    from app import create_app
+    app = create_app(make_config(os.path.abspath(args.db)))
+    meta, results = run(app, args.requests, args.warmup, args.only)
+    meta.update({'when': datetime.utcnow().isoformat(timespec='seconds'), 'requests': args.requests,
+                 'python': platform.python_version(), 'db': args.db})
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'routes': results}, f, indent=2)
+        print(f'\nsaved to {args.output}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f)['routes'], results)
+
+
+if __name__ == '__main__':
+    main()
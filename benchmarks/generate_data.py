@@ -0,0 +1,158 @@
+# Synthetic data for benchmarks
+# Fills a fresh SQLite file with lots, spots, users and a reservation history
+# of whatever size you ask for, using executemany bulk inserts in chunks so
+# even tens of millions of rows don't need an ORM object each.
+# Every user's password is "bench" (one hash shared by all of them), the
+# admin is admin/admin as usual. bench_routes.py runs against the result.
+#
+#   python -m benchmarks.generate_data --db /tmp/bench.db --lots 500 --spots 1000000 \
+#       --users 100000 --reservations 20000000
+
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+
+from benchmarks.stress_booking import make_config
+
+PASSWORD = 'bench'
+
+
+def _chunks(total, size):
+    start = 0
+    while start < total:
+        yield start, min(size, total - start)
+        start += size
+
+
+def _insert(table, rows_for, total, chunk, label):
+    # rows_for(start, count) -> list of dicts, one executemany + commit per chunk
+    from controllers.extensions import db
+    started = time.perf_counter()
+    for start, count in _chunks(total, chunk):
+        db.session.execute(insert(table), rows_for(start, count))
+        db.session.commit()
+        done = start + count
+        if done == total or done // chunk % 10 == 0:
+            rate = done / max(time.perf_counter() - started, 1e-9)
+            print(f'  {label}: {done}/{total} ({rate:.0f} rows/s)')
+
+
+def generate(app, lots, spots, users, reservations, days, active, chunk, seed):
+    from controllers.extensions import db
+    from models import billing, rollups
+    from models.models import ParkingLot, ParkingSpot, Reservation, User
+    from models.occupancy import repair_lot_counts
+
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    with app.app_context():
+        tariff = billing.tariff()
+
+        print(f'{lots} lots')
+        _insert(ParkingLot.__table__, lambda start, count: [{
+            'prime_location_name': f'Bench Lot {start + i}',
+            'price': float(rng.choice((20, 30, 40, 50, 60, 80, 100))),
+            'address': f'{start + i} Benchmark Road',
+            'pin_code': f'{560000 + (start + i) % 1000:06d}',
+            'maximum_number_of_spots': 0,
+            'available_count': 0,
+            'occupied_count': 0,
+            'change_version': 0,
+        } for i in range(count)], lots, chunk, 'lots')
+        lot_rows = db.session.query(ParkingLot.id, ParkingLot.price).order_by(ParkingLot.id).all()
+        lot_ids = [lot_id for lot_id, _ in lot_rows]
+        prices = dict(lot_rows)
+
+        # spots are spread evenly, the first few lots get the remainder
+        per_lot, extra = divmod(spots, len(lot_ids))
+        sizes = [per_lot + (1 if i < extra else 0) for i in range(len(lot_ids))]
+        spot_lots = [lot_id for lot_id, size in zip(lot_ids, sizes) for _ in range(size)]
+        print(f'{spots} spots')
+        _insert(ParkingSpot.__table__, lambda start, count: [
+            {'lot_id': spot_lots[start + i], 'status': 'A'} for i in range(count)], spots, chunk, 'spots')
+        for lot_id, size in zip(lot_ids, sizes):
+            db.session.query(ParkingLot).filter(ParkingLot.id == lot_id).update(
+                {ParkingLot.maximum_number_of_spots: size}, synchronize_session=False)
+        db.session.commit()
+        spot_rows = db.session.query(ParkingSpot.id, ParkingSpot.lot_id).order_by(ParkingSpot.id).all()
+
+        print(f'{users} users')
+        password = generate_password_hash(PASSWORD)
+        _insert(User.__table__, lambda start, count: [
+            {'username': f'bench{start + i}', 'password': password, 'role': 'user', 'reservations_version': 0}
+            for i in range(count)], users, chunk, 'users')
+        user_ids = [uid for (uid,) in db.session.query(User.id).filter(User.role == 'user').order_by(User.id)]
+
+        # the last `active` reservations are open stays on distinct spots, the rest is history
+        active = min(active, len(spot_rows), reservations)
+        active_spots = rng.sample(range(len(spot_rows)), active)
+        history = reservations - active
+        span = days * 86400
+
+        def reservation_rows(start, count):
+            rows = []
+            for n in range(start, start + count):
+                if n < history:
+                    spot_id, lot_id = spot_rows[rng.randrange(len(spot_rows))]
+                    parked = now - timedelta(seconds=rng.randrange(span))
+                    left = min(parked + timedelta(minutes=rng.randint(15, 600)), now)
+                    cost = tariff.cost(parked, left, prices[lot_id])
+                else:
+                    spot_id, lot_id = spot_rows[active_spots[n - history]]
+                    parked, left, cost = now - timedelta(minutes=rng.randint(5, 600)), None, None
+                rows.append({'spot_id': spot_id, 'user_id': user_ids[rng.randrange(len(user_ids))],
+                             'parking_timestamp': parked, 'leaving_timestamp': left, 'parking_cost': cost,
+                             'start_time': None, 'end_time': None})
+            return rows
+
+        print(f'{reservations} reservations ({active} active)')
+        _insert(Reservation.__table__, reservation_rows, reservations, chunk, 'reservations')
+
+        table = ParkingSpot.__table__
+        for start, count in _chunks(active, chunk):
+            ids = [spot_rows[i][0] for i in active_spots[start:start + count]]
+            db.session.execute(table.update().where(table.c.id.in_(ids)).values(status='O'))
+        db.session.commit()
+
+        print('counters and rollups')
+        repair_lot_counts()
+        rollups.rebuild()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fill a database with synthetic parking data.')
+    parser.add_argument('--db', default=os.path.join('instance', 'bench.db'), help='SQLite file to create')
+    parser.add_argument('--lots', type=int, default=50)
+    parser.add_argument('--spots', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--reservations', type=int, default=200000)
+    parser.add_argument('--active', type=int, default=None, help='open stays (default: a third of the spots)')
+    parser.add_argument('--days', type=int, default=365, help='how far back the history goes')
+    parser.add_argument('--chunk', type=int, default=50000, help='rows per executemany')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--force', action='store_true', help='overwrite the database file if it exists')
+    args = parser.parse_args()
+    if args.lots < 1 or args.spots < args.lots or args.users < 1:
+        parser.error('need at least one lot, one spot per lot and one user')
+
+    if os.path.exists(args.db):
+        if not args.force:
+            parser.error(f'{args.db} already exists, pass --force to replace it')
+        os.remove(args.db)
+    os.makedirs(os.path.dirname(os.path.abspath(args.db)), exist_ok=True)
+
+    from app import create_app
+    app = create_app(make_config(os.path.abspath(args.db)))
+    active = args.spots // 3 if args.active is None else args.active
+    started = time.perf_counter()
+    generate(app, args.lots, args.spots, args.users, args.reservations, args.days, active, args.chunk, args.seed)
+    print(f'done in {time.perf_counter() - started:.1f}s -> {args.db}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# Concurrent booking stress test
+# Fires lots of parallel "book any spot in lot X" requests at one lot and
+# checks that no spot ended up with two open reservations, that the lot's
+# counters match the spot table, and reports bookings per second.
+# --processes runs the workers as separate processes (each with its own
+# free-list, like gunicorn workers) instead of threads.
+#
+#   python -m benchmarks.stress_booking --spots 500 --bookings 2000 --workers 16
+
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from controllers.config import Config
+
+_app = None
+
+
+def make_config(db_path):
+    return type('StressConfig', (Config,), {
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{db_path}',
+        'TESTING': True,
+    })
+
+
+def _get_app(db_path):
+    # one app per process, created lazily in the worker
+    global _app
+    if _app is None:
+        from app import create_app
+        _app = create_app(make_config(db_path))
+    return _app
+
+
+def book_once(db_path, lot_id, user_id, max_attempts):
+    from models import booking
+    app = _get_app(db_path)
+    with app.app_context():
+        reservation = booking.book_in_lot(lot_id, user_id, max_attempts)
+        return reservation.spot_id if reservation else None
+
+
+def setup(db_path, spots, users):
+    from controllers.extensions import db
+    from models.models import ParkingLot, User
+    from models.provisioning import provision_spots
+    from sqlalchemy import insert
+    app = _get_app(db_path)
+    with app.app_context():
+        lot = ParkingLot('Stress Lot', 5.0, '1 Busy Street', '000000', spots)
+        db.session.add(lot)
+        db.session.flush()
+        provision_spots(lot.id, spots)
+        db.session.execute(insert(User.__table__),
+                           [{'username': f'stress{i}', 'password': 'x', 'role': 'user'} for i in range(users)])
+        db.session.commit()
+        user_ids = [uid for (uid,) in db.session.query(User.id).filter(User.role == 'user')]
+        from controllers.availability import availability
+        availability.rebuild()
+        return lot.id, user_ids
+
+
+def check(db_path, lot_id):
+    from controllers.extensions import db
+    from models.models import ParkingLot, ParkingSpot, Reservation
+    from sqlalchemy import func
+    app = _get_app(db_path)
+    with app.app_context():
+        duplicates = (db.session.query(Reservation.spot_id)
+                      .filter(Reservation.leaving_timestamp.is_(None))
+                      .group_by(Reservation.spot_id)
+                      .having(func.count(Reservation.id) > 1)
+                      .all())
+        open_reservations = Reservation.query.filter(Reservation.leaving_timestamp.is_(None)).count()
+        occupied = ParkingSpot.query.filter_by(lot_id=lot_id, status='O').count()
+        lot = db.session.get(ParkingLot, lot_id)
+        return {
+            'duplicate_spots': [spot_id for (spot_id,) in duplicates],
+            'open_reservations': open_reservations,
+            'occupied_spots': occupied,
+            'counters': (lot.available_count, lot.occupied_count),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel booking stress test against one lot.')
+    parser.add_argument('--spots', type=int, default=500)
+    parser.add_argument('--bookings', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--attempts', type=int, default=Config.BOOKING_MAX_ATTEMPTS)
+    parser.add_argument('--processes', action='store_true', help='use processes instead of threads')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'stress.db')
+        lot_id, user_ids = setup(db_path, args.spots, args.users)
+        global _app
+        _app = None  # workers (and this process afterwards) build their own app
+        pool_class = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+        start = time.perf_counter()
+        with pool_class(max_workers=args.workers) as pool:
+            futures = [pool.submit(book_once, db_path, lot_id, user_ids[i % len(user_ids)], args.attempts)
+                       for i in range(args.bookings)]
+            results = [f.result() for f in futures]
+        elapsed = time.perf_counter() - start
+
+        booked = [spot_id for spot_id in results if spot_id is not None]
+        state = check(db_path, lot_id)
+        expected = min(args.spots, args.bookings)
+        print(f'{args.bookings} booking requests, {args.workers} {"processes" if args.processes else "threads"}, '
+              f'{args.spots} spots')
+        print(f'  booked {len(booked)} (expected {expected}), rejected {len(results) - len(booked)}')
+        print(f'  {elapsed:.2f}s, {len(results) / elapsed:.0f} requests/s, {len(booked) / elapsed:.0f} bookings/s')
+        print(f'  open reservations {state["open_reservations"]}, occupied spots {state["occupied_spots"]}, '
+              f'counters available/occupied {state["counters"]}')
+
+        problems = []
+        if len(set(booked)) != len(booked) or state['duplicate_spots']:
+            problems.append(f'double booked spots: {state["duplicate_spots"] or "in results"}')
+        if len(booked) != expected:
+            problems.append(f'booked {len(booked)} spots, expected {expected}')
+        if state['open_reservations'] != state['occupied_spots'] or state['counters'] != (args.spots - len(booked), len(booked)):
+            problems.append('counters / spot table / reservations disagree')
+        if problems:
+            raise SystemExit('FAILED: ' + '; '.join(problems))
+        print('  OK - no duplicates')
+
+
+if __name__ == '__main__':
+    main()
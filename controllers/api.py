@@ -3,9 +3,22 @@
 # Using REST API style - learned this from a web development course
 # Not fully implemented yet but the structure is there
 
-from flask import Blueprint, jsonify, request
+import hashlib
+import json
+from flask import Blueprint, Response, jsonify, request, current_app
 from models.models import ParkingLot, ParkingSpot, Reservation, User
 from controllers.extensions import db
+from models import billing, queries, catalogue, versions
+from controllers.cache import cache
+from controllers.pagination import reservation_args, lot_search_args
+from models.booking import (BatchError, reserve_batch, release_batch, book_spot_by_id, book_window,
+                            cancel_window, check_in)
+from models.occupancy import lot_counts
+from controllers.events import hub
+from controllers.spotmap import FORMATS, spot_maps
+from controllers.etags import conditional, make_etag
+from controllers.windows import windows
+from controllers.lotsearch import lot_search
 from datetime import datetime
 
 api_bp = Blueprint('api', __name__)
@@ -13,61 +26,306 @@ api_bp = Blueprint('api', __name__)
 # get all parking lots - for mobile app
 @api_bp.route('/parking-lots', methods=['GET'])
 def get_parking_lots():
-    lots = ParkingLot.query.all()
-    result = []
-    for lot in lots:
-        # count available spots
-        available_spots = sum(1 for spot in lot.spots if spot.status == 'A')
-        result.append({
-            'id': lot.id,
-            'location': lot.prime_location_name,
-            'price': lot.price,
-            'address': lot.address,
-            'pin_code': lot.pin_code,
-            'available_spots': available_spots,
-            'total_spots': len(lot.spots)
-        })
-    return jsonify(result)
+    def build():
+        lots = catalogue.lots_with_counts()  # cached lot info + live counters
+        result = []
+        for lot in lots:
+            result.append({
+                'id': lot['id'],
+                'location': lot['prime_location_name'],
+                'price': lot['price'],
+                'address': lot['address'],
+                'pin_code': lot['pin_code'],
+                'available_spots': lot['available_count'],
+                'total_spots': lot['available_count'] + lot['occupied_count']
+            })
+        return jsonify(result)
+    return conditional(make_etag('lots', versions.all_lots_version()), build)
+
+# search lots by pin code / name / address words, with price and free-spot filters
+# ?q=&min_price=&max_price=&min_free=&page=&limit= - best matches first
+@api_bp.route('/parking-lots/search', methods=['GET'])
+def search_parking_lots():
+    try:
+        search_args, page = lot_search_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    lots, total = lot_search.search(**search_args)
+    return jsonify({
+        'lots': [{
+            'id': lot['id'],
+            'location': lot['prime_location_name'],
+            'price': lot['price'],
+            'address': lot['address'],
+            'pin_code': lot['pin_code'],
+            'available_spots': lot['available_count'],
+            'total_spots': lot['available_count'] + lot['occupied_count']
+        } for lot in lots],
+        'total': total,
+        'page': page,
+        'next_page': page + 1 if search_args['offset'] + len(lots) < total else None,
+    })
 
 # get spots in a specific lot
+# ?format=bitmap or ?format=rle gives the compact map instead of one dict per spot
 @api_bp.route('/parking-lot/<int:lot_id>/spots', methods=['GET'])
 def get_parking_spots(lot_id):
-    spots = ParkingSpot.query.filter_by(lot_id=lot_id).all()
-    return jsonify([{'id': s.id, 'status': s.status} for s in spots])
+    fmt = request.args.get('format', 'json')
+    if fmt not in FORMATS:
+        return jsonify({'error': f'format must be one of {", ".join(FORMATS)}'}), 400
+    version = versions.lot_version(lot_id)
+    if version is None:
+        return jsonify([])  # same as before for an unknown lot
+
+    def build():
+        if fmt != 'json':
+            return jsonify(spot_maps.get(lot_id, version).encode(fmt))
+        spots = queries.lot_spots(lot_id)
+        return jsonify([{'id': s.id, 'status': s.status} for s in spots])
+    return conditional(make_etag('lot', lot_id, 'v', version, fmt), build)
+
+def _sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def _lot_snapshot(lot_id):
+    counts = lot_counts(lot_id)
+    if counts is None:
+        return None
+    spots = (db.session.query(ParkingSpot.id, ParkingSpot.status)
+             .filter(ParkingSpot.lot_id == lot_id, ParkingSpot.status != 'R')
+             .order_by(ParkingSpot.id)
+             .all())
+    return {'lot_id': lot_id, 'available': counts[0], 'occupied': counts[1],
+            'spots': [{'id': spot_id, 'status': status} for spot_id, status in spots]}
+
+
+# live availability for one lot as Server-Sent Events
+# sends a "snapshot" first, then a "delta" whenever a spot changes; "resync" means reload everything
+@api_bp.route('/parking-lot/<int:lot_id>/stream', methods=['GET'])
+def stream_lot(lot_id):
+    ParkingLot.query.get_or_404(lot_id)
+    app = current_app._get_current_object()
+    heartbeat = app.config['STREAM_HEARTBEAT_SECONDS']
+    # subscribe before taking the snapshot so nothing that happens in between is missed
+    subscriber = hub.subscribe(lot_id, app.config['STREAM_QUEUE_SIZE'])
+
+    def snapshot():
+        with app.app_context():
+            data = _lot_snapshot(lot_id)
+            db.session.remove()  # give the connection back, this stream can stay open for hours
+        return data
+
+    def generate():
+        try:
+            data = snapshot()
+            if data is None:
+                yield _sse('closed', {'lot_id': lot_id})
+                return
+            yield _sse('snapshot', data)
+            last_counts = (data['available'], data['occupied'])
+            while True:
+                event = subscriber.next_event(heartbeat)
+                if event is None:
+                    # quiet: one cheap counter read picks up changes made by other workers
+                    with app.app_context():
+                        counts = lot_counts(lot_id)
+                        db.session.remove()
+                    if counts is None:
+                        yield _sse('closed', {'lot_id': lot_id})
+                        return
+                    if counts != last_counts:
+                        last_counts = counts
+                        yield _sse('counts', {'lot_id': lot_id, 'available': counts[0], 'occupied': counts[1]})
+                    else:
+                        yield ': keep-alive\n\n'
+                elif event == 'resync' or event['type'] == 'resync':
+                    data = snapshot()
+                    if data is None:
+                        yield _sse('closed', {'lot_id': lot_id})
+                        return
+                    last_counts = (data['available'], data['occupied'])
+                    yield _sse('snapshot', data)
+                elif event['type'] == 'closed':
+                    yield _sse('closed', event)
+                    return
+                else:
+                    if 'available' in event:
+                        last_counts = (event['available'], event['occupied'])
+                    yield _sse('delta', event)
+        finally:
+            hub.unsubscribe(subscriber)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# make a reservation for one spot, starting now
+def _window(values):
+    # (start, end) from start_time/end_time (ISO 8601, UTC), (None, None) if neither was given
+    start, end = values.get('start_time'), values.get('end_time')
+    if not start and not end:
+        return None, None
+    try:
+        start, end = datetime.fromisoformat(start), datetime.fromisoformat(end)
+    except (TypeError, ValueError):
+        raise ValueError('start_time and end_time must both be ISO dates, e.g. 2024-05-01T09:00')
+    if start.tzinfo or end.tzinfo:
+        raise ValueError('start_time and end_time are UTC and must not carry a timezone')
+    if end <= start:
+        raise ValueError('end_time must be after start_time')
+    if start < datetime.utcnow():
+        raise ValueError('start_time is in the past')
+    return start, end
 
-# make a reservation - not fully implemented yet
-# this is just a basic version - would need more error handling
+
+# make a reservation - now for one spot, or for a future window with start_time/end_time
+# (a window can ask for a spot_id or for any spot in a lot_id)
 @api_bp.route('/reserve', methods=['POST'])
 def make_reservation():
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     user_id = data.get('user_id')
     spot_id = data.get('spot_id')
-    start_time = datetime.strptime(data.get('start_time'), '%Y-%m-%d %H:%M:%S')
-    end_time = datetime.strptime(data.get('end_time'), '%Y-%m-%d %H:%M:%S')
+    lot_id = data.get('lot_id')
+    try:
+        start, end = _window(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not user_id or not (spot_id or (lot_id and start)):
+        return jsonify({'error': 'user_id and spot_id are required'}), 400
+    if not db.session.get(User, user_id):
+        return jsonify({'error': 'User not found'}), 404
 
-    spot = ParkingSpot.query.get(spot_id)
-    if spot.status != 'A':
-        return jsonify({'error': 'Spot already occupied'}), 400
+    if start:
+        reservation, error = book_window(user_id, start, end, current_app.config['BOOKING_MAX_ATTEMPTS'],
+                                         spot_id=spot_id, lot_id=lot_id)
+        if error == 'not_found':
+            return jsonify({'error': 'Spot not found' if spot_id else 'Lot not found'}), 404
+        if error == 'unavailable':
+            return jsonify({'error': 'No spot is free for that window'}), 409
+        # nothing is charged until the stay ends, this is what the whole window would cost
+        estimate = billing.tariff().cost(start, end, reservation.spot.lot.price)
+        return jsonify({'message': 'Reservation successful', 'reservation_id': reservation.id,
+                        'spot_id': reservation.spot_id, 'start_time': start.isoformat(),
+                        'end_time': end.isoformat(), 'estimated_cost': estimate})
 
-    reservation = Reservation(user_id=user_id, spot_id=spot_id,
-                              start_time=start_time, end_time=end_time)
-    spot.status = 'O'
-    db.session.add(reservation)
-    db.session.commit()
+    # compare-and-set on the spot row so two requests can't both get it
+    reservation, error = book_spot_by_id(spot_id, user_id)
+    if error == 'not_found':
+        return jsonify({'error': 'Spot not found'}), 404
+    if error == 'occupied':
+        return jsonify({'error': 'Spot already occupied'}), 400
+    if error == 'booked':
+        return jsonify({'error': 'Spot is booked in advance for the next while'}), 400
 
     return jsonify({'message': 'Reservation successful', 'reservation_id': reservation.id})
 
-# get user's reservations
+def _own_reservation(reservation_id):
+    # the reservation, or an error response - user_id in the body (if given) must own it
+    reservation = db.session.get(Reservation, reservation_id)
+    if reservation is None:
+        return None, (jsonify({'error': 'Reservation not found'}), 404)
+    data = request.get_json(silent=True) or {}
+    if 'user_id' in data and data['user_id'] != reservation.user_id:
+        return None, (jsonify({'error': 'Reservation belongs to another user'}), 403)
+    return reservation, None
+
+# start an advance booking - the driver is at the spot
+@api_bp.route('/reservations/<int:reservation_id>/check-in', methods=['POST'])
+def check_in_reservation(reservation_id):
+    reservation, error = _own_reservation(reservation_id)
+    if error:
+        return error
+    failed = check_in(reservation)
+    if failed == 'occupied':
+        return jsonify({'error': 'The spot is still occupied'}), 409
+    if failed:
+        messages = {'not_upcoming': 'Only advance bookings that have not started can be checked in',
+                    'too_early': 'Too early to check in', 'expired': 'The booking window is over'}
+        return jsonify({'error': messages[failed]}), 400
+    return jsonify({'message': 'Checked in', 'reservation_id': reservation.id, 'spot_id': reservation.spot_id})
+
+# cancel an advance booking that hasn't started
+@api_bp.route('/reservations/<int:reservation_id>/cancel', methods=['POST'])
+def cancel_reservation(reservation_id):
+    reservation, error = _own_reservation(reservation_id)
+    if error:
+        return error
+    if not cancel_window(reservation):
+        return jsonify({'error': 'Only advance bookings that have not started can be cancelled'}), 400
+    return jsonify({'message': 'Reservation cancelled', 'reservation_id': reservation_id})
+
+# which spots in a lot are free for a future window - ?start_time=...&end_time=...
+@api_bp.route('/parking-lot/<int:lot_id>/availability', methods=['GET'])
+def lot_window_availability(lot_id):
+    try:
+        start, end = _window(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if start is None:
+        return jsonify({'error': 'start_time and end_time are required'}), 400
+    if versions.lot_version(lot_id) is None:
+        return jsonify({'error': 'Lot not found'}), 404
+    free = windows.free_spots(lot_id, start, end)
+    return jsonify({'lot_id': lot_id, 'start_time': start.isoformat(), 'end_time': end.isoformat(),
+                    'free_spots': len(free), 'spot_ids': free})
+
+# book many spots in one request - body: {"reservations": [{"user_id": 1, "spot_id": 5}, {"user_id": 1, "lot_id": 2}]}
+# spot_id books that spot, lot_id books any free spot in the lot
+@api_bp.route('/api/reservations:batch', methods=['POST'])
+def reserve_many():
+    data = request.get_json(silent=True) or {}
+    try:
+        results = reserve_batch(data.get('reservations'), current_app.config['API_MAX_BATCH_SIZE'])
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    reserved = sum(1 for r in results if r['status'] == 'reserved')
+    return jsonify({'reserved': reserved, 'failed': len(results) - reserved, 'results': results})
+
+# release many reservations at once - body: {"releases": [{"reservation_id": 7}, ...]}
+@api_bp.route('/api/releases:batch', methods=['POST'])
+def release_many():
+    data = request.get_json(silent=True) or {}
+    try:
+        results = release_batch(data.get('releases'), current_app.config['API_MAX_BATCH_SIZE'])
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    released = sum(1 for r in results if r['status'] == 'released')
+    return jsonify({'released': released, 'failed': len(results) - released, 'results': results})
+
+# get user's reservations - one page at a time, pass next_cursor back as ?cursor= for the next one
+# also takes limit, start/end (YYYY-MM-DD), lot_id and active=1
 @api_bp.route('/user/<int:user_id>/reservations', methods=['GET'])
 def get_user_reservations(user_id):
-    reservations = Reservation.query.filter_by(user_id=user_id).all()
-    result = []
-    for r in reservations:
-        result.append({
-            'id': r.id,
-            'spot_id': r.spot_id,
-            'lot_id': r.spot.lot_id,
-            'start_time': r.start_time.strftime('%Y-%m-%d %H:%M:%S'),
-            'end_time': r.end_time.strftime('%Y-%m-%d %H:%M:%S')
-        })
-    return jsonify(result)
+    try:
+        args = reservation_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def build():
+        try:
+            reservations, next_cursor = queries.reservation_page(user_id, **args)
+        except ValueError as e:  # bad cursor
+            return jsonify({'error': str(e)}), 400
+        result = []
+        for r in reservations:
+            # start/end time are only set for advance bookings
+            result.append({
+                'id': r.id,
+                'status': 'upcoming' if r.upcoming else 'completed' if r.leaving_timestamp else 'active',
+                'spot_id': r.spot_id,
+                'lot_id': r.spot.lot_id,
+                'parking_timestamp': r.parking_timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                'leaving_timestamp': r.leaving_timestamp.strftime('%Y-%m-%d %H:%M:%S') if r.leaving_timestamp else None,
+                'start_time': r.start_time.strftime('%Y-%m-%d %H:%M:%S') if r.start_time else None,
+                'end_time': r.end_time.strftime('%Y-%m-%d %H:%M:%S') if r.end_time else None,
+                'parking_cost': r.parking_cost
+            })
+        return jsonify({'reservations': result, 'next_cursor': next_cursor})
+    # every page/filter combination is its own resource, so the query string is part of the tag
+    query = hashlib.blake2b(request.query_string, digest_size=6).hexdigest()
+    return conditional(make_etag('user', user_id, 'v', versions.user_version(user_id) or 0, query), build)
+
+# cache hit/miss numbers - for monitoring
+@api_bp.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(cache.stats())
@@ -0,0 +1,101 @@
+# In-memory availability index for parking spots
+# Keeps a free-list of spot ids per lot so booking doesn't have to scan
+# the parking_spot table every time someone clicks "Book Spot".
+# The database is still the source of truth - this is just a fast lookup
+# that gets rebuilt at startup and kept in step by the routes.
+
+import threading
+
+
+class AvailabilityIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free = {}  # lot_id -> list of free spot ids (used as a stack)
+        self._members = {}  # lot_id -> set of the ids that are really free
+        # discard() only drops the id from _members, the stale copy left in the
+        # list is skipped when claim() pops it (lazy deletion, so every update is O(1))
+
+    def rebuild(self):
+        # load every free spot from the db in one query
+        from models.models import ParkingLot, ParkingSpot
+        from controllers.extensions import db
+        free = {lot_id: [] for (lot_id,) in db.session.query(ParkingLot.id).all()}
+        rows = (db.session.query(ParkingSpot.lot_id, ParkingSpot.id)
+                .filter(ParkingSpot.status == 'A')
+                .order_by(ParkingSpot.lot_id, ParkingSpot.id.desc())
+                .all())
+        for lot_id, spot_id in rows:
+            free.setdefault(lot_id, []).append(spot_id)
+        with self._lock:
+            self._free = free
+            self._members = {lot_id: set(ids) for lot_id, ids in free.items()}
+
+    def refresh_lot(self, lot_id):
+        # reload one lot from the db - used when this process' view might be stale
+        # (another worker could have released spots we don't know about)
+        from models.models import ParkingSpot
+        from controllers.extensions import db
+        ids = [spot_id for (spot_id,) in db.session.query(ParkingSpot.id)
+               .filter(ParkingSpot.lot_id == lot_id, ParkingSpot.status == 'A')
+               .order_by(ParkingSpot.id.desc())
+               .all()]
+        self.set_lot(lot_id, ids)
+
+    def set_lot(self, lot_id, spot_ids):
+        # spot_ids are handed out lowest id first, same order as the old .first() query
+        ids = sorted(spot_ids, reverse=True)
+        with self._lock:
+            self._free[lot_id] = ids
+            self._members[lot_id] = set(ids)
+
+    def remove_lot(self, lot_id):
+        with self._lock:
+            self._free.pop(lot_id, None)
+            self._members.pop(lot_id, None)
+
+    def claim(self, lot_id):
+        # atomically take a free spot off the list, returns None if the lot is full
+        with self._lock:
+            free = self._free.get(lot_id)
+            if not free:
+                return None
+            members = self._members[lot_id]
+            while free:
+                spot_id = free.pop()
+                if spot_id in members:
+                    members.discard(spot_id)
+                    return spot_id
+            return None
+
+    def release(self, lot_id, spot_id):
+        # put a spot back on the free list (no-op if it's already there)
+        with self._lock:
+            members = self._members.get(lot_id)
+            if members is None or spot_id in members:
+                return
+            members.add(spot_id)
+            self._free[lot_id].append(spot_id)
+
+    def discard(self, lot_id, spot_id):
+        # a spot was booked without going through claim() (e.g. by id from the api)
+        with self._lock:
+            members = self._members.get(lot_id)
+            if members is None or spot_id not in members:
+                return
+            members.discard(spot_id)
+            free = self._free[lot_id]
+            if len(free) > 2 * len(members) + 64:
+                # mostly stale copies (spots booked by id and never popped), compact it
+                self._free[lot_id] = [i for i in free if i in members]
+
+    def free_count(self, lot_id):
+        with self._lock:
+            return len(self._members.get(lot_id, ()))
+
+    def __contains__(self, lot_id):
+        with self._lock:
+            return lot_id in self._free
+
+
+# one index per process, same idea as the db object in extensions.py
+availability = AvailabilityIndex()
@@ -0,0 +1,137 @@
+# Small application cache for data that hardly ever changes
+# (the lot catalogue, homepage stats). Entries expire after a TTL and the
+# in-process backend also evicts the least recently used entry when full.
+# With several gunicorn workers each one has its own memory cache, so set
+# CACHE_BACKEND=redis to share one cache (and its invalidations) between them.
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryBackend:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (expires_at, value), oldest use first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # returns (found, value)
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return False, None
+            expires_at, value = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisBackend:
+    # works with redis.Redis or anything with the same get/set/delete methods
+    # (a fake client can stand in for it locally). Values are stored as JSON.
+    def __init__(self, client, prefix='parking:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return False, None
+        return True, json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, json.dumps(value), ex=int(ttl) if ttl else None)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class Cache:
+    def __init__(self, backend=None, default_ttl=60):
+        self.backend = backend or MemoryBackend()
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def init_app(self, app):
+        name = app.config['CACHE_BACKEND']
+        if name == 'memory':
+            self.backend = MemoryBackend(max_entries=app.config['CACHE_MAX_ENTRIES'])
+        elif name == 'redis':
+            import redis  # only needed when the shared backend is switched on
+            self.backend = RedisBackend(redis.Redis.from_url(app.config['CACHE_REDIS_URL']))
+        else:
+            raise ValueError(f'Unknown CACHE_BACKEND {name!r}')
+        self.default_ttl = app.config['CACHE_DEFAULT_TTL']
+
+    def get(self, key):
+        found, value = self.backend.get(key)
+        with self._stats_lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found, value
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, ttl or self.default_ttl)
+
+    def get_or_set(self, key, compute, ttl=None):
+        # return the cached value, or compute it, cache it and return it
+        found, value = self.get(key)
+        if found:
+            return value
+        value = compute()
+        self.set(key, value, ttl)
+        return value
+
+    def invalidate(self, *keys):
+        self.backend.delete(*keys)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / total, 4) if total else 0.0,
+        }
+
+
+# shared instance, configured in create_app
+cache = Cache()
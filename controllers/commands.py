@@ -0,0 +1,137 @@
+# Command line tools for maintenance jobs
+# Run them with the flask cli, e.g. `flask --app app repair-counters`
+
+import click
+from flask import g
+
+
+def register_commands(app):
+    @app.cli.command('repair-counters')
+    @click.option('--dry-run', is_flag=True, help='Only report lots whose counters are wrong.')
+    def repair_counters(dry_run):
+        """Check ParkingLot occupancy counters against the parking_spot table."""
+        from models.occupancy import repair_lot_counts
+        mismatched = repair_lot_counts(dry_run=dry_run)
+        for lot_id, stored, real in mismatched:
+            click.echo(f'lot {lot_id}: counters {stored[0]}/{stored[1]} -> spots {real[0]}/{real[1]}')
+        action = 'found' if dry_run else 'fixed'
+        click.echo(f'{len(mismatched)} lot(s) {action}')
+
+    @app.cli.command('compact-rollups')
+    @click.option('--days', type=int, default=None, help='Only rebuild the last N days (default: everything).')
+    def compact_rollups(days):
+        """Rebuild the daily lot rollups from the raw reservations."""
+        from models import rollups
+        if days is None:
+            rows = rollups.rebuild()
+        else:
+            rows = rollups.backfill_window(days)
+        click.echo(f'{rows} rollup row(s) written')
+
+    @app.cli.command('recompute-costs')
+    @click.option('--batch-size', type=int, default=5000, show_default=True, help='Reservations priced per transaction.')
+    @click.option('--only-missing', is_flag=True, help='Only price reservations that have no cost yet.')
+    def recompute_costs(batch_size, only_missing):
+        """Price completed reservations with the current tariff and rebuild the rollups they feed."""
+        from controllers.extensions import db
+        from models import billing, rollups, versions
+        priced, lot_ids, earliest = billing.recompute_costs(batch_size, only_missing, echo=click.echo)
+        if priced:
+            for lot_id in lot_ids:
+                versions.bump_lot(lot_id)  # lot summaries show revenue
+            db.session.commit()
+            rows = rollups.rebuild(since=earliest)
+            click.echo(f'{rows} rollup row(s) rebuilt from {earliest}')
+        click.echo(f'{priced} reservation(s) priced')
+
+    @app.cli.command('archive-reservations')
+    @click.option('--older-than', type=int, default=None,
+                  help='Archive stays that ended more than this many days ago (default: ARCHIVE_AFTER_DAYS).')
+    @click.option('--batch-size', type=int, default=5000, show_default=True, help='Reservations moved per transaction.')
+    def archive_reservations(older_than, batch_size):
+        """Move old completed reservations into the monthly archive files."""
+        from models import archive
+        days = app.config['ARCHIVE_AFTER_DAYS'] if older_than is None else older_than
+        moved, lot_ids, _ = archive.archive_reservations(days, batch_size, echo=click.echo)
+        for month, rows in sorted(moved.items()):
+            click.echo(f'{month:%Y-%m}: {rows} reservation(s)')
+        click.echo(f'{sum(moved.values())} reservation(s) archived from {len(lot_ids)} lot(s) '
+                   f'into {archive.archive_dir()}')
+
+    @app.cli.command('advance-windows')
+    def advance_windows():
+        """Check in advance bookings whose window has started and end the ones whose window is over."""
+        from models import booking
+        counts = booking.advance_windows()
+        click.echo(f"{counts['checked_in']} checked in, {counts['ended']} ended, "
+                   f"{counts['expired']} expired without the spot coming free")
+
+    @app.cli.command('db-upgrade')
+    def db_upgrade():
+        """Apply pending schema migrations to the database."""
+        from models import migrations
+        applied = migrations.upgrade(echo=click.echo)
+        click.echo(f'{len(applied)} migration(s) applied')
+
+    @app.cli.command('db-status')
+    def db_status():
+        """List schema migrations and whether they have been applied."""
+        from models import migrations
+        done = migrations.applied_versions()
+        for version, description, _ in migrations.MIGRATIONS:
+            mark = 'x' if version in done else ' '
+            click.echo(f'[{mark}] {version:04d} {description}')
+
+    @app.cli.command('check-query-plans')
+    def check_query_plans():
+        """Run EXPLAIN QUERY PLAN on the queries behind each GET route and flag full scans."""
+        from controllers.extensions import db, is_sqlite
+        from models import query_plans
+        from models.models import User, ParkingLot
+        if not is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+            raise click.ClickException('EXPLAIN QUERY PLAN checks only work on SQLite')
+
+        admin_user = User.query.filter_by(role='admin').first()
+        normal_user = User.query.filter_by(role='user').first()
+        lot = ParkingLot.query.first()
+        lot_id = lot.id if lot else 1
+        routes = [(admin_user, url) for url in (
+            '/admin/dashboard', '/admin/lots', f'/admin/lots/{lot_id}/spots', f'/admin/lots/{lot_id}/summary')]
+        routes += [(normal_user, url) for url in ('/user/dashboard', '/user/lots', '/user/reservations')]
+        routes += [(None, url) for url in (
+            '/parking-lots', f'/parking-lot/{lot_id}/spots',
+            f'/user/{normal_user.id if normal_user else 1}/reservations')]
+
+        problems = 0
+        client = app.test_client()
+        for who, url in routes:
+            if who is None and url.startswith(('/admin', '/user/d', '/user/l', '/user/r')):
+                continue
+            # the cli app context is shared with the test requests, so drop
+            # flask-login's cached user or every request sees the first one
+            g.pop('_login_user', None)
+            with client.session_transaction() as session:
+                session.clear()
+                if who is not None:
+                    session['_user_id'] = str(who.id)
+                    session['_fresh'] = True
+            with query_plans.capture_statements() as captured:
+                response = client.get(url)
+            click.echo(f'{url} -> {response.status_code}, {len(captured)} select(s)')
+            seen = set()
+            for statement, parameters in captured:
+                if statement in seen:
+                    continue
+                seen.add(statement)
+                scans = query_plans.full_scans(query_plans.explain(statement, parameters))
+                hot = [table for table in scans if table in query_plans.HOT_TABLES]
+                if hot:
+                    problems += 1
+                    click.echo(f'  FULL SCAN of {", ".join(hot)}:')
+                    click.echo('    ' + ' '.join(statement.split()))
+                elif scans:
+                    click.echo(f'  scan of small table(s) {", ".join(scans)} (ok)')
+        db.session.rollback()
+        if problems:
+            raise click.ClickException(f'{problems} quer(y/ies) scan a hot table')
+        click.echo('no full scans of hot tables')
@@ -0,0 +1,24 @@
+# Conditional GET helpers
+# The tag is built from a change version (models/versions.py) before any of
+# the real work, so if the client sent it back in If-None-Match we answer 304
+# without loading spots or reservations at all.
+
+from flask import Response, make_response, request
+
+
+def make_etag(*parts):
+    # e.g. make_etag('lot', 3, 'v', 17) -> "lot-3-v-17"
+    return '-'.join(str(part) for part in parts)
+
+
+def conditional(etag, build):
+    # build() is only called when the client's copy is out of date
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response  # errors don't get a tag
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate, a 304 is cheap
+    return response
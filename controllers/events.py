@@ -0,0 +1,80 @@
+# In-process publish/subscribe hub for live lot occupancy
+# Every watcher of a lot (signage screen, phone) gets its own small bounded
+# queue. Publishing only touches the subscribers of that one lot, and a
+# watcher that is asleep costs nothing but its open connection.
+# If a slow client lets its queue fill up we stop queueing for it and send it
+# a single "resync" instead, so one slow client can't eat memory or hold up
+# the request that changed the spot.
+
+import queue
+import threading
+
+
+class Subscriber:
+    def __init__(self, lot_id, max_queue):
+        self.lot_id = lot_id
+        self.events = queue.Queue(maxsize=max_queue)
+        self.overflowed = False  # set when events were dropped, the stream sends a resync
+
+    def offer(self, event):
+        # never blocks the publisher
+        if self.overflowed:
+            return
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+            # drop what's queued - it's out of date once we resync anyway
+            try:
+                while True:
+                    self.events.get_nowait()
+            except queue.Empty:
+                pass
+
+    def next_event(self, timeout):
+        # returns the next event, 'resync' if events were dropped, or None on timeout
+        if self.overflowed:
+            self.overflowed = False
+            return 'resync'
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return 'resync' if self.overflowed else None
+
+
+class EventHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # lot_id -> set of Subscriber
+
+    def subscribe(self, lot_id, max_queue=100):
+        subscriber = Subscriber(lot_id, max_queue)
+        with self._lock:
+            self._subscribers.setdefault(lot_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            watchers = self._subscribers.get(subscriber.lot_id)
+            if watchers is not None:
+                watchers.discard(subscriber)
+                if not watchers:
+                    del self._subscribers[subscriber.lot_id]
+
+    def has_subscribers(self, lot_id):
+        # cheap check so publishers can skip building events nobody will read
+        return lot_id in self._subscribers
+
+    def publish(self, lot_id, event):
+        with self._lock:
+            watchers = list(self._subscribers.get(lot_id, ()))
+        for subscriber in watchers:
+            subscriber.offer(event)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(watchers) for watchers in self._subscribers.values())
+
+
+# one hub per process
+hub = EventHub()
@@ -1,3 +1,55 @@
 # database instance - keeping it simple
 from flask_sqlalchemy import SQLAlchemy
-db = SQLAlchemy() 
\ No newline at end of file
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+db = SQLAlchemy()
+
+
+def is_sqlite(uri):
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+def engine_options(config):
+    # pool settings for SQLALCHEMY_ENGINE_OPTIONS, built from the app config
+    uri = config['SQLALCHEMY_DATABASE_URI']
+    url = make_url(uri)
+    if is_sqlite(uri):
+        if url.database in (None, '', ':memory:'):
+            return {}  # flask-sqlalchemy uses a StaticPool for in-memory dbs
+        return {
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_timeout': config['DB_POOL_TIMEOUT'],
+            # sqlite3's own lock wait, on top of the busy_timeout pragma
+            'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT_MS'] / 1000},
+        }
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }
+
+
+def install_sqlite_pragmas(app):
+    # runs the tuning pragmas on every new SQLite connection
+    # needs an app context because db.engine is per app
+    if not is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+        return
+    pragmas = [
+        f"PRAGMA journal_mode={app.config['SQLITE_JOURNAL_MODE']}",
+        f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}",
+        f"PRAGMA busy_timeout={int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}",
+        f"PRAGMA mmap_size={int(app.config['SQLITE_MMAP_SIZE'])}",
+        f"PRAGMA cache_size={int(app.config['SQLITE_CACHE_SIZE'])}",
+    ]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    event.listen(db.engine, 'connect', set_pragmas)
@@ -0,0 +1,69 @@
+# Lot list view model and rendered per-lot fragments
+# The lot pages show the same card / table row for every lot and used to
+# re-render all of them (plus sums over the whole list in Jinja) on each
+# request. lot_list() does the page totals in one pass in Python and renders
+# each lot's fragment from templates/fragments/ only when the lot changed:
+# fragments are stored under the lot's change_version (bumped on every
+# counter or detail change, see models/versions.py), so nothing needs
+# invalidating - an old fragment simply stops matching and gets replaced.
+
+from flask import render_template
+from markupsafe import Markup
+from controllers.cache import MemoryBackend
+
+USER_CARD = 'fragments/user_lot_card.html'
+ADMIN_ROW = 'fragments/admin_lot_row.html'
+
+
+class FragmentCache:
+    def __init__(self, max_entries=2000):
+        self._store = MemoryBackend(max_entries)  # (template, lot_id) -> (change_version, html)
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self._store = MemoryBackend(app.config['FRAGMENT_CACHE_SIZE'])
+
+    def render(self, template, lot):
+        key = (template, lot['id'])
+        found, entry = self._store.get(key)
+        if found and entry[0] == lot['change_version']:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        html = Markup(render_template(template, lot=lot))
+        self._store.set(key, (lot['change_version'], html))
+        return html
+
+    def clear(self):
+        self._store.clear()
+
+
+# one cache per process
+fragments = FragmentCache()
+
+
+def lot_list(lots, template, shown=None):
+    # {'fragments': [html per lot], 'totals': {...}} for user_lots.html / admin_lots.html
+    # the totals cover all of `lots`, fragments are only rendered for `shown`
+    # (one page of search results) if given
+    total_spots = available_spots = active_lots = 0
+    price_sum = 0.0
+    for lot in lots:
+        lot['bookable'] = lot['available_count'] > 0
+        total_spots += lot['maximum_number_of_spots']
+        available_spots += lot['available_count']
+        price_sum += lot['price']
+        if lot['maximum_number_of_spots']:
+            active_lots += 1
+    rendered = [fragments.render(template, lot) for lot in (lots if shown is None else shown)]
+    return {
+        'fragments': rendered,
+        'totals': {
+            'lot_count': len(lots),
+            'total_spots': total_spots,
+            'available_spots': available_spots,
+            'avg_price': price_sum / len(lots) if lots else 0,
+            'active_lots': active_lots,
+        },
+    }
@@ -0,0 +1,127 @@
+# Background export jobs
+# Big exports run on a small thread pool (EXPORT_WORKERS threads per process)
+# instead of inside the request, and write their result to EXPORT_DIR. Each
+# job's state (status, rows written, total) lives next to the result as
+# <id>.json, so any worker sharing that folder can answer the status and
+# download requests, not just the one that started the job. Finished files
+# are removed after EXPORT_RETENTION_HOURS.
+
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+_JOB_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+class ExportJobs:
+    def __init__(self):
+        self.app = None
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def init_app(self, app):
+        self.app = app
+        self.folder = app.config['EXPORT_DIR'] or os.path.join(app.instance_path, 'exports')
+        self.workers = app.config['EXPORT_WORKERS']
+        self.batch_size = app.config['EXPORT_BATCH_SIZE']
+        self.retention = app.config['EXPORT_RETENTION_HOURS'] * 3600
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='export')
+            return self._executor
+
+    def _state_path(self, job_id):
+        return os.path.join(self.folder, f'{job_id}.json')
+
+    def result_path(self, job):
+        return os.path.join(self.folder, f'{job["id"]}.{job["format"]}')
+
+    def _save(self, job):
+        job['updated_at'] = datetime.utcnow().isoformat(timespec='seconds')
+        tmp = self._state_path(job['id']) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp, self._state_path(job['id']))  # readers never see half a file
+
+    def status(self, job_id):
+        if not _JOB_ID.match(job_id):
+            return None
+        try:
+            with open(self._state_path(job_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def submit(self, fmt, start=None, end=None, lot_id=None):
+        os.makedirs(self.folder, exist_ok=True)
+        self.prune()
+        job = {
+            'id': uuid.uuid4().hex,
+            'format': fmt,
+            'filters': {'start': start.isoformat() if start else None,
+                        'end': end.isoformat() if end else None,
+                        'lot_id': lot_id},
+            'status': 'queued',
+            'rows': 0,
+            'total': None,
+            'error': None,
+            'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        }
+        self._save(job)
+        self._pool().submit(self._run, dict(job), start, end, lot_id)  # the worker keeps its own copy
+        return job
+
+    def _run(self, job, start, end, lot_id):
+        from controllers.extensions import db
+        from models import exports
+        path = self.result_path(job)
+        with self.app.app_context():
+            try:
+                job['status'] = 'running'
+                job['total'] = exports.count(start, end, lot_id)
+                self._save(job)
+
+                def progress(rows):
+                    job['rows'] = rows
+                    self._save(job)
+                with open(path + '.part', 'w', newline='') as f:
+                    for chunk in exports.encode(job['format'],
+                                                exports.batches(start, end, lot_id, self.batch_size),
+                                                progress):
+                        f.write(chunk)
+                os.replace(path + '.part', path)
+                job['status'] = 'done'
+            except Exception as e:
+                self.app.logger.exception('export %s failed', job['id'])
+                job['status'] = 'failed'
+                job['error'] = str(e)
+                if os.path.exists(path + '.part'):
+                    os.remove(path + '.part')
+            finally:
+                db.session.remove()
+            self._save(job)
+
+    def prune(self):
+        # drop results (and their state) older than the retention period
+        if not os.path.isdir(self.folder):
+            return
+        cutoff = time.time() - self.retention
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.endswith('.json') and os.path.getmtime(path) < cutoff:
+                job = self.status(name[:-len('.json')])
+                if job and job['status'] in ('done', 'failed'):
+                    if os.path.exists(self.result_path(job)):
+                        os.remove(self.result_path(job))
+                    os.remove(path)
+
+
+# one pool per process
+export_jobs = ExportJobs()
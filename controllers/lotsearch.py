@@ -0,0 +1,179 @@
+# In-memory search index over the lot catalogue
+# Pin codes go in a digit trie (every node keeps the ids below it, so a
+# prefix lookup is one walk down the trie) and the words of each lot's name
+# and address go in token -> ids maps with a sorted vocabulary for prefix
+# matches. A search only reads the rows of the lots that matched (details,
+# live counters and change version together), never any spots.
+# create/edit/delete of a lot calls catalogue.invalidate(), which drops this
+# index too; other workers pick the change up after LOT_SEARCH_TTL seconds.
+
+import bisect
+import re
+import threading
+import time
+
+_TOKEN = re.compile(r'[a-z0-9]+')
+
+# how much a query word is worth depending on where it matched
+PIN_EXACT, PIN_PREFIX = 10, 6
+NAME_EXACT, NAME_PREFIX = 5, 3
+ADDRESS_EXACT, ADDRESS_PREFIX = 2, 1
+
+
+def tokens(text):
+    return _TOKEN.findall((text or '').lower())
+
+
+class PinTrie:
+    def __init__(self):
+        self.root = {'ids': set(), 'next': {}}
+
+    def add(self, pin, lot_id):
+        node = self.root
+        for ch in pin:
+            node = node['next'].setdefault(ch, {'ids': set(), 'next': {}})
+            node['ids'].add(lot_id)
+
+    def prefix(self, digits):
+        node = self.root
+        for ch in digits:
+            node = node['next'].get(ch)
+            if node is None:
+                return set()
+        return node['ids']
+
+
+class TokenIndex:
+    def __init__(self):
+        self.ids = {}  # token -> set of lot ids
+        self.vocabulary = []  # sorted tokens, for prefix lookups
+
+    def add(self, text, lot_id):
+        for token in tokens(text):
+            self.ids.setdefault(token, set()).add(lot_id)
+
+    def freeze(self):
+        self.vocabulary = sorted(self.ids)
+
+    def exact(self, token):
+        return self.ids.get(token, set())
+
+    def prefix(self, token):
+        found = set()
+        i = bisect.bisect_left(self.vocabulary, token)
+        while i < len(self.vocabulary) and self.vocabulary[i].startswith(token):
+            found |= self.ids[self.vocabulary[i]]
+            i += 1
+        return found
+
+
+class LotIndex:
+    def __init__(self, entries):
+        self.built_at = time.monotonic()
+        self.lots = {entry['id']: entry for entry in entries}
+        self.pins = PinTrie()
+        self.pin_codes = {}
+        self.names = TokenIndex()
+        self.addresses = TokenIndex()
+        for entry in entries:
+            pin = (entry['pin_code'] or '').strip()
+            self.pins.add(pin, entry['id'])
+            self.pin_codes[entry['id']] = pin
+            self.names.add(entry['prime_location_name'], entry['id'])
+            self.addresses.add(entry['address'], entry['id'])
+        self.names.freeze()
+        self.addresses.freeze()
+
+    def _word_scores(self, word):
+        # {lot_id: best score for this word}
+        scores = {}
+
+        def mark(ids, score):
+            for lot_id in ids:
+                if scores.get(lot_id, 0) < score:
+                    scores[lot_id] = score
+        mark(self.addresses.prefix(word), ADDRESS_PREFIX)
+        mark(self.addresses.exact(word), ADDRESS_EXACT)
+        mark(self.names.prefix(word), NAME_PREFIX)
+        mark(self.names.exact(word), NAME_EXACT)
+        if word.isdigit():
+            ids = self.pins.prefix(word)
+            mark(ids, PIN_PREFIX)
+            mark((lot_id for lot_id in ids if self.pin_codes[lot_id] == word), PIN_EXACT)
+        return scores
+
+    def match(self, query):
+        # {lot_id: score} for the lots matching every word of the query (all lots for an empty query)
+        words = tokens(query)
+        if not words:
+            return dict.fromkeys(self.lots, 0)
+        matched = None
+        for word in words:
+            scores = self._word_scores(word)
+            if matched is None:
+                matched = scores
+            else:
+                matched = {lot_id: score + scores[lot_id] for lot_id, score in matched.items() if lot_id in scores}
+            if not matched:
+                break
+        return matched
+
+
+class LotSearch:
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._index = None
+
+    def init_app(self, app):
+        self.ttl = app.config['LOT_SEARCH_TTL']
+
+    def _current(self):
+        with self._lock:
+            index = self._index
+        if index is None or time.monotonic() - index.built_at >= self.ttl:
+            from models import catalogue
+            index = LotIndex(catalogue.lot_catalogue())
+            with self._lock:
+                self._index = index
+        return index
+
+    def search(self, query='', min_price=None, max_price=None, min_free=None, offset=0, limit=20):
+        # (page of lot dicts with live counters, total matches), best match first
+        found = self.matches(query, min_price, max_price, min_free)
+        return found[offset:offset + limit], len(found)
+
+    def matches(self, query='', min_price=None, max_price=None, min_free=None):
+        # every matching lot dict with live counters, best match first
+        from models.models import ParkingLot
+        from models.catalogue import LIST_COLUMNS, list_entry
+        from controllers.extensions import db
+        index = self._current()
+        matched = index.match(query)
+        ids = [lot_id for lot_id in matched
+               if (min_price is None or index.lots[lot_id]['price'] >= min_price)
+               and (max_price is None or index.lots[lot_id]['price'] <= max_price)]
+        if not ids:
+            return []
+        rows = db.session.query(*LIST_COLUMNS)
+        if len(ids) < len(index.lots):
+            rows = rows.filter(ParkingLot.id.in_(ids))
+        if min_free:
+            rows = rows.filter(ParkingLot.available_count >= min_free)
+        wanted = set(ids)
+        # matching goes by the index, what we show (and the price filter) by the row itself
+        found = [lot for lot in map(list_entry, rows)
+                 if lot['id'] in wanted  # not filtered out above or created since the index was built
+                 and (min_price is None or lot['price'] >= min_price)
+                 and (max_price is None or lot['price'] <= max_price)]
+        # best text match, then most free spots, then cheapest
+        found.sort(key=lambda lot: (-matched[lot['id']], -lot['available_count'], lot['price'], lot['id']))
+        return found
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+
+
+# one index per process
+lot_search = LotSearch()
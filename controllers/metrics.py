@@ -0,0 +1,190 @@
+# Per-route performance metrics
+# For every endpoint we keep a latency histogram, the number of SQL statements
+# and the time spent in them (SQLAlchemy engine events) and the time spent
+# rendering templates (Flask's template signals). GET /metrics serves it all
+# in the Prometheus text format so it can be scraped or just read with curl.
+# With PROFILE_SLOW_REQUESTS on, every request runs under cProfile and the
+# PROFILE_KEEP slowest ones are dumped to PROFILE_DIR (open them with
+# `python -m pstats file.prof`). That costs real time, so it's off by default.
+
+import cProfile
+import heapq
+import os
+import re
+import threading
+import time
+from flask import Response, g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+
+# seconds - the upper bound of each latency bucket
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class EndpointStats:
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)  # not cumulative, summed up when exported
+        self.count = 0
+        self.seconds = 0.0
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.statuses = {}  # (method, status code) -> count
+
+    def observe(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}  # endpoint name -> EndpointStats
+        self.profile_dir = None
+        self.profile_keep = 0
+        self._slowest = []  # min-heap of (seconds, path of the dumped profile)
+
+    def init_app(self, app):
+        if not app.config['METRICS_ENABLED']:
+            return
+        if app.config['PROFILE_SLOW_REQUESTS']:
+            self.profile_dir = app.config['PROFILE_DIR'] or os.path.join(app.instance_path, 'profiles')
+            self.profile_keep = max(app.config['PROFILE_KEEP'], 1)
+            os.makedirs(self.profile_dir, exist_ok=True)
+        app.before_request(self._start)
+        app.after_request(self._status)
+        app.teardown_request(self._finish)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_done, app)
+        with app.app_context():
+            from controllers.extensions import db
+            event.listen(db.engine, 'before_cursor_execute', self._sql_started)
+            event.listen(db.engine, 'after_cursor_execute', self._sql_done)
+        app.add_url_rule('/metrics', 'metrics', self.export)
+
+    def _start(self):
+        g._metrics = {'started': time.perf_counter(), 'sql_statements': 0, 'sql_seconds': 0.0,
+                      'template_seconds': 0.0, 'status': 500}
+        if self.profile_dir:
+            g._metrics['profile'] = profile = cProfile.Profile()
+            profile.enable()
+
+    def _status(self, response):
+        if '_metrics' in g:
+            g._metrics['status'] = response.status_code
+        return response
+
+    def _finish(self, exc):
+        data = g.pop('_metrics', None)
+        if data is None:
+            return
+        seconds = time.perf_counter() - data['started']
+        endpoint = request.endpoint or 'unmatched'
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.observe(seconds)
+            stats.sql_statements += data['sql_statements']
+            stats.sql_seconds += data['sql_seconds']
+            stats.template_seconds += data['template_seconds']
+            key = (request.method, data['status'] if exc is None else 500)
+            stats.statuses[key] = stats.statuses.get(key, 0) + 1
+        profile = data.get('profile')
+        if profile is not None:
+            profile.disable()
+            self._keep_profile(profile, seconds, endpoint)
+
+    def _keep_profile(self, profile, seconds, endpoint):
+        # only dump it if it's one of the slowest PROFILE_KEEP requests so far
+        with self._lock:
+            if len(self._slowest) >= self.profile_keep and seconds <= self._slowest[0][0]:
+                return
+            name = re.sub(r'[^A-Za-z0-9_.-]', '_', endpoint)
+            path = os.path.join(self.profile_dir, f'{int(seconds * 1000):06d}ms-{name}-{time.time_ns()}.prof')
+            heapq.heappush(self._slowest, (seconds, path))
+            evicted = heapq.heappop(self._slowest) if len(self._slowest) > self.profile_keep else None
+        if evicted is not None and evicted[1] == path:
+            return
+        profile.dump_stats(path)
+        if evicted is not None and os.path.exists(evicted[1]):
+            os.remove(evicted[1])
+
+    def _sql_started(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['_metrics_started'] = time.perf_counter()  # a connection runs one statement at a time
+
+    def _sql_done(self, conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and '_metrics' in g:
+            g._metrics['sql_statements'] += 1
+            g._metrics['sql_seconds'] += time.perf_counter() - conn.info.pop('_metrics_started', time.perf_counter())
+
+    def _template_started(self, sender, template, context, **extra):
+        if '_metrics' in g:
+            g._metrics.setdefault('template_started', []).append(time.perf_counter())
+
+    def _template_done(self, sender, template, context, **extra):
+        if '_metrics' in g and g._metrics.get('template_started'):
+            g._metrics['template_seconds'] += time.perf_counter() - g._metrics['template_started'].pop()
+
+    def render(self):
+        # the Prometheus text exposition format
+        with self._lock:
+            snapshot = {name: (list(s.buckets), s.count, s.seconds, s.sql_statements, s.sql_seconds,
+                               s.template_seconds, dict(s.statuses))
+                        for name, s in self.endpoints.items()}
+        lines = [
+            '# HELP parking_request_duration_seconds Time spent handling each request.',
+            '# TYPE parking_request_duration_seconds histogram',
+        ]
+        for name, (buckets, count, seconds, *_) in sorted(snapshot.items()):
+            running = 0
+            for bound, n in zip(BUCKETS, buckets):
+                running += n
+                lines.append(f'parking_request_duration_seconds_bucket{{endpoint="{_label(name)}",le="{bound}"}} {running}')
+            lines.append(f'parking_request_duration_seconds_bucket{{endpoint="{_label(name)}",le="+Inf"}} {count}')
+            lines.append(f'parking_request_duration_seconds_sum{{endpoint="{_label(name)}"}} {seconds:.6f}')
+            lines.append(f'parking_request_duration_seconds_count{{endpoint="{_label(name)}"}} {count}')
+        lines += ['# HELP parking_requests_total Requests by endpoint, method and status code.',
+                  '# TYPE parking_requests_total counter']
+        for name, stats in sorted(snapshot.items()):
+            for (method, status), n in sorted(stats[6].items()):
+                lines.append(f'parking_requests_total{{endpoint="{_label(name)}",method="{method}",status="{status}"}} {n}')
+        totals = (
+            ('parking_sql_statements_total', 'SQL statements sent to the database.', 3, '{}'),
+            ('parking_sql_seconds_total', 'Time spent waiting on SQL statements.', 4, '{:.6f}'),
+            ('parking_template_seconds_total', 'Time spent rendering templates.', 5, '{:.6f}'),
+        )
+        for metric, help_text, field, fmt in totals:
+            lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+            for name, stats in sorted(snapshot.items()):
+                lines.append(f'{metric}{{endpoint="{_label(name)}"}} {fmt.format(stats[field])}')
+        from controllers.cache import cache
+        cache_stats = cache.stats()
+        lines += ['# HELP parking_cache_requests_total Application cache lookups.',
+                  '# TYPE parking_cache_requests_total counter',
+                  f'parking_cache_requests_total{{result="hit"}} {cache_stats["hits"]}',
+                  f'parking_cache_requests_total{{result="miss"}} {cache_stats["misses"]}']
+        from controllers.fragments import fragments
+        lines += ['# HELP parking_fragment_renders_total Lot card/row fragments served from cache or rendered.',
+                  '# TYPE parking_fragment_renders_total counter',
+                  f'parking_fragment_renders_total{{result="hit"}} {fragments.hits}',
+                  f'parking_fragment_renders_total{{result="miss"}} {fragments.misses}']
+        return '\n'.join(lines) + '\n'
+
+    def export(self):
+        return Response(self.render(), mimetype='text/plain; version=0.0.4')
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+
+
+# one registry per process - with several gunicorn workers each one reports its own numbers
+metrics = Metrics()
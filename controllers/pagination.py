@@ -0,0 +1,81 @@
+# Reading the page-size / cursor / filter query-string arguments for the
+# reservation history pages and the lot search (shared by the html views and
+# the json api)
+
+from datetime import datetime, timedelta
+from flask import current_app
+
+
+def _parse_day(value, name):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f'{name} must look like YYYY-MM-DD')
+
+
+def reservation_args(args):
+    # returns the keyword arguments for queries.reservation_page()
+    # raises ValueError with a readable message for bad input
+    default_size = current_app.config['RESERVATIONS_PAGE_SIZE']
+    max_size = current_app.config['RESERVATIONS_MAX_PAGE_SIZE']
+    try:
+        limit = int(args.get('limit') or default_size)
+    except ValueError:
+        raise ValueError('limit must be a number')
+    filters = {'limit': max(1, min(limit, max_size))}
+    if args.get('cursor'):
+        filters['cursor'] = args['cursor']
+    if args.get('start'):
+        filters['start'] = _parse_day(args['start'], 'start')
+    if args.get('end'):
+        # the end day is included, so stop at midnight after it
+        filters['end'] = _parse_day(args['end'], 'end') + timedelta(days=1)
+    if args.get('lot_id'):
+        try:
+            filters['lot_id'] = int(args['lot_id'])
+        except ValueError:
+            raise ValueError('lot_id must be a number')
+    filters['active_only'] = args.get('active', '').lower() in ('1', 'true', 'yes', 'on')
+    return filters
+
+
+def date_range(args):
+    # (start, end) datetimes from ?start=YYYY-MM-DD&end=YYYY-MM-DD, end day included
+    start = _parse_day(args['start'], 'start') if args.get('start') else None
+    end = _parse_day(args['end'], 'end') + timedelta(days=1) if args.get('end') else None
+    return start, end
+
+
+def _number(args, name, kind=float):
+    if not args.get(name):
+        return None
+    try:
+        return kind(args[name])
+    except ValueError:
+        raise ValueError(f'{name} must be a number')
+
+
+def lot_search_args(args):
+    # returns the keyword arguments for lot_search.search() plus the page number
+    default_size = current_app.config['LOT_SEARCH_PAGE_SIZE']
+    max_size = current_app.config['LOT_SEARCH_MAX_PAGE_SIZE']
+    limit = max(1, min(_number(args, 'limit', int) or default_size, max_size))
+    page = max(1, _number(args, 'page', int) or 1)
+    return {
+        'query': args.get('q', '').strip(),
+        'min_price': _number(args, 'min_price'),
+        'max_price': _number(args, 'max_price'),
+        'min_free': _number(args, 'min_free', int),
+        'offset': (page - 1) * limit,
+        'limit': limit,
+    }, page
+
+
+def filter_params(args):
+    # the filter args to carry over into "next page" links (everything but the cursor)
+    return {key: args[key] for key in ('limit', 'start', 'end', 'lot_id', 'active') if args.get(key)}
+
+
+def search_params(args):
+    # same for the lot search (everything but the page)
+    return {key: args[key] for key in ('q', 'min_price', 'max_price', 'min_free', 'limit') if args.get(key)}
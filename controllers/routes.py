@@ -3,11 +3,24 @@
 # I split it into blueprints to keep things organized
 # Got this idea from a Flask tutorial but modified it for my needs
 
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app, Response, send_file, stream_with_context
 from flask_login import login_required, current_user, login_user, logout_user
-from werkzeug.security import generate_password_hash, check_password_hash
-from models.models import ParkingLot, ParkingSpot, Reservation, User
+from controllers.security import check_password, forget_user, hash_password
+from models.models import ParkingLot, Reservation, User
 from controllers.extensions import db
+from controllers.availability import availability
+from controllers.spotmap import FORMATS, spot_maps
+from controllers.windows import windows
+from controllers.etags import conditional, make_etag
+from models import booking
+from models.occupancy import announce
+from models import queries, aggregates, rollups, catalogue, versions, reports, exports
+from models.provisioning import provision_spots, resize_lot
+from controllers.pagination import reservation_args, filter_params, date_range, lot_search_args, search_params
+from controllers.lotsearch import lot_search
+from controllers.jobs import export_jobs
+from controllers.fragments import ADMIN_ROW, USER_CARD, lot_list
+from sqlalchemy import func
 from datetime import datetime
 
 # Admin Blueprint - handles all admin stuff
@@ -23,20 +36,18 @@ def admin_dashboard():
     
     # get some stats for the dashboard
     total_lots = ParkingLot.query.count()
-    total_spots = ParkingSpot.query.count()
-    occupied_spots = ParkingSpot.query.filter_by(status='O').count()
-    total_revenue = 0  # money made so far - this could be improved later
-    
-    # calculate money made from parking
-    completed_reservations = Reservation.query.filter(Reservation.leaving_timestamp.isnot(None)).all()
-    for reservation in completed_reservations:
-        total_revenue += reservation.parking_cost or reservation.spot.lot.price or 0
+    # read the per-lot counters instead of counting the whole spot table
+    total_spots, occupied_spots = db.session.query(
+        func.coalesce(func.sum(ParkingLot.available_count + ParkingLot.occupied_count), 0),
+        func.coalesce(func.sum(ParkingLot.occupied_count), 0)).one()
+    # money made so far from completed stays - old days come from the daily rollups
+    total_revenue = rollups.overall_totals()['revenue']
     
     # get recent activity for the feed (max 5 items)
     recent_activity = []
     
     # get recent bookings (3 max) - this shows what's happening lately
-    recent_reservations = Reservation.query.order_by(Reservation.parking_timestamp.desc()).limit(3).all()
+    recent_reservations = queries.recent_reservations(3)
     
     # add bookings to activity - this could be done better but it works
     for reservation in recent_reservations:
@@ -79,8 +90,8 @@ def admin_lots():
     if current_user.role != 'admin':
         flash('Access denied.')
         return redirect(url_for('auth.login'))
-    lots = ParkingLot.query.all()
-    return render_template('admin_lots.html', lots=lots)
+    lots = catalogue.lots_with_counts()
+    return render_template('admin_lots.html', view=lot_list(lots, ADMIN_ROW))
 
 @admin.route('/admin/lots/create', methods=['GET', 'POST'])
 @login_required
@@ -109,15 +120,18 @@ def create_lot():
             flash('Invalid number for spots or price.')
             return redirect(url_for('admin.create_lot'))
         # this validation could be better but it works for now
+        if max_spots < 1:
+            flash('A lot needs at least one spot.')
+            return redirect(url_for('admin.create_lot'))
         lot = ParkingLot(prime_location_name=name, price=price, address=address, pin_code=pin_code, maximum_number_of_spots=max_spots)
         db.session.add(lot)
-        db.session.commit()
+        db.session.flush()  # need lot.id for the spots
         
-        # create parking spots for this lot
-        for i in range(max_spots):
-            spot = ParkingSpot(lot_id=lot.id, status='A')
-            db.session.add(spot)
+        # create parking spots for this lot - one bulk insert, same transaction as the lot
+        provision_spots(lot.id, max_spots)
         db.session.commit()
+        availability.refresh_lot(lot.id)
+        catalogue.invalidate()
         flash('Parking lot created successfully!')
         return redirect(url_for('admin.admin_lots'))
     return render_template('admin_create_lot.html')
@@ -129,7 +143,7 @@ def view_spots(lot_id):
         flash('Access denied.')
         return redirect(url_for('auth.login'))
     lot = ParkingLot.query.get_or_404(lot_id)
-    spots = ParkingSpot.query.filter_by(lot_id=lot.id).all()
+    spots = queries.lot_spots(lot.id)
     return render_template('admin_view_spots.html', lot=lot, spots=spots)
 
 @admin.route('/admin/lots/<int:lot_id>/edit', methods=['GET', 'POST'])
@@ -144,7 +158,24 @@ def edit_lot(lot_id):
         lot.price = float(request.form.get('price'))
         lot.address = request.form.get('address')
         lot.pin_code = request.form.get('pin_code')
+        max_spots_str = request.form.get('maximum_number_of_spots')
+        if max_spots_str:
+            try:
+                max_spots = int(max_spots_str)
+                if max_spots < 1:
+                    raise ValueError('A lot needs at least one spot.')
+                resize_lot(lot, max_spots)
+            except ValueError as e:
+                db.session.rollback()
+                flash(f'Could not change capacity: {e}')
+                return redirect(url_for('admin.edit_lot', lot_id=lot_id))
+        versions.bump_lot(lot.id)
         db.session.commit()
+        if max_spots_str:
+            availability.refresh_lot(lot.id)
+            windows.drop(lot.id)
+            announce(lot.id, kind='resync')  # spots came or went, watchers reload the whole lot
+        catalogue.invalidate()
         flash('Parking lot updated successfully!')
         return redirect(url_for('admin.admin_lots'))
     return render_template('admin_edit_lot.html', lot=lot)
@@ -156,12 +187,22 @@ def delete_lot(lot_id):
         flash('Access denied.')
         return redirect(url_for('auth.login'))
     lot = ParkingLot.query.get_or_404(lot_id)
-    occupied_spots = any(spot.status == 'O' for spot in lot.spots)
+    occupied_spots = queries.lot_has_occupied_spots(lot.id)
     if occupied_spots:
         flash('Cannot delete lot: Some spots are occupied.')
         return redirect(url_for('admin.admin_lots'))
+    if queries.lot_has_upcoming_bookings(lot.id):
+        flash('Cannot delete lot: Some spots are booked in advance.')
+        return redirect(url_for('admin.admin_lots'))
+    versions.bump_lot_users(lot_id)  # their history loses this lot's spots
     db.session.delete(lot)
+    rollups.delete_lot_rollups(lot_id)
     db.session.commit()
+    availability.remove_lot(lot_id)
+    spot_maps.drop(lot_id)
+    windows.drop(lot_id)
+    announce(lot_id, kind='closed')
+    catalogue.invalidate()
     flash('Parking lot deleted successfully!')
     return redirect(url_for('admin.admin_lots'))
 
@@ -170,31 +211,50 @@ def delete_lot(lot_id):
 def lot_summary(lot_id):
     if current_user.role != 'admin':
         return jsonify({'error': 'Access denied'}), 403
-    lot = ParkingLot.query.get_or_404(lot_id)
-    spot_ids = [spot.id for spot in lot.spots]
-    reservations = Reservation.query.filter(Reservation.spot_id.in_(spot_ids)).all()
-    revenue = sum(r.parking_cost or lot.price for r in reservations if r.parking_cost or lot.price)
-    booking_count = len(reservations)
+    fmt = request.args.get('format', 'json')
+    if fmt not in FORMATS:
+        return jsonify({'error': f'format must be one of {", ".join(FORMATS)}'}), 400
+    try:
+        start, end = date_range(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    version = versions.lot_version(lot_id)
+    if version is None:
+        return jsonify({'error': 'Lot not found'}), 404
+    etag = make_etag('summary', lot_id, 'v', version, fmt,
+                     request.args.get('start', ''), request.args.get('end', ''))
+    return conditional(etag, lambda: _lot_summary(lot_id, version, fmt, start, end))
+
+
+def _lot_summary(lot_id, version, fmt, start=None, end=None):
+    lot = db.session.get(ParkingLot, lot_id)
+    # bookings in the date range, older ones come from the archive
+    reservations = reports.lot_bookings(lot.id, start, end)
+    totals = rollups.lot_totals(lot.id, include_active=True)
+    revenue = totals['revenue']
+    booking_count = totals['bookings']
     bookings = [
         {
-            'username': r.user.username if r.user else 'Unknown',
-            'parking_timestamp': r.parking_timestamp.strftime('%Y-%m-%d %H:%M'),
-            'leaving_timestamp': r.leaving_timestamp.strftime('%Y-%m-%d %H:%M') if r.leaving_timestamp else None
+            'username': r['username'],
+            'parking_timestamp': r['parking_timestamp'].strftime('%Y-%m-%d %H:%M'),
+            'leaving_timestamp': r['leaving_timestamp'].strftime('%Y-%m-%d %H:%M') if r['leaving_timestamp'] else None,
+            'upcoming': r['upcoming']
         }
         for r in reservations
     ]
-    spots_info = [
-        {
-            'id': spot.id,
-            'number': idx + 1,
-            'status': 'Booked' if spot.status == 'O' else 'Available'
-        }
-        for idx, spot in enumerate(lot.spots)
-    ]
-    map_data = {
-        'total_spots': lot.maximum_number_of_spots,
-        'spots': spots_info
-    }
+    map_data = {'total_spots': lot.maximum_number_of_spots}
+    if fmt == 'json':
+        map_data['spots'] = [
+            {
+                'id': spot.id,
+                'number': idx + 1,
+                'status': 'Booked' if spot.status == 'O' else 'Available'
+            }
+            for idx, spot in enumerate(queries.lot_spots(lot.id))
+        ]
+    else:
+        # compact map built from the cached arrays, see controllers/spotmap.py
+        map_data['compact'] = spot_maps.get(lot.id, version).encode(fmt)
     return jsonify({
         'revenue': revenue,
         'booking_count': booking_count,
@@ -203,6 +263,88 @@ def lot_summary(lot_id):
         'lot_name': lot.prime_location_name
     })
 
+@admin.route('/admin/reports/daily')
+@login_required
+def daily_report():
+    # bookings and revenue per day, archived stays included
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Access denied'}), 403
+    try:
+        start, end = date_range(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    lot_id = request.args.get('lot_id', type=int)
+    days = reports.daily_totals(start, end, lot_id)
+    return jsonify({'days': [dict(totals, day=day) for day, totals in days]})
+
+def _export_args(values):
+    fmt = values.get('format', 'csv')
+    if fmt not in exports.FORMATS:
+        raise ValueError(f'format must be one of {", ".join(exports.FORMATS)}')
+    start, end = date_range(values)
+    try:
+        lot_id = int(values['lot_id']) if values.get('lot_id') else None
+    except (TypeError, ValueError):
+        raise ValueError('lot_id must be a number')
+    return fmt, start, end, lot_id
+
+@admin.route('/admin/reservations/export')
+@login_required
+def export_reservations():
+    # streamed straight to the client, one batch of rows at a time
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Access denied'}), 403
+    try:
+        fmt, start, end, lot_id = _export_args(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    body = exports.encode(fmt, exports.batches(start, end, lot_id, batch_size))
+    return Response(stream_with_context(body), mimetype=exports.MIMETYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename=reservations.{fmt}'})
+
+@admin.route('/admin/exports', methods=['POST'])
+@login_required
+def start_export():
+    # big exports: run on the background pool, poll the status url, then download
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Access denied'}), 403
+    try:
+        fmt, start, end, lot_id = _export_args(request.get_json(silent=True) or request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    job = export_jobs.submit(fmt, start, end, lot_id)
+    return jsonify(_job_json(job)), 202
+
+def _job_json(job):
+    data = dict(job, status_url=url_for('admin.export_status', job_id=job['id']))
+    if job['status'] == 'done':
+        data['download_url'] = url_for('admin.download_export', job_id=job['id'])
+    return data
+
+@admin.route('/admin/exports/<job_id>')
+@login_required
+def export_status(job_id):
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Access denied'}), 403
+    job = export_jobs.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Export not found'}), 404
+    return jsonify(_job_json(job))
+
+@admin.route('/admin/exports/<job_id>/download')
+@login_required
+def download_export(job_id):
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Access denied'}), 403
+    job = export_jobs.status(job_id)
+    if job is None:
+        return jsonify({'error': 'Export not found'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': f'Export is {job["status"]}'}), 409
+    return send_file(export_jobs.result_path(job), mimetype=exports.MIMETYPES[job['format']],
+                     as_attachment=True, download_name=f'reservations-{job["id"][:8]}.{job["format"]}')
+
 @admin.route('/admin/edit_admin_info', methods=['POST'])
 @login_required
 def edit_admin_info():
@@ -211,11 +353,13 @@ def edit_admin_info():
         return redirect(url_for('admin.admin_dashboard'))
     username = request.form.get('username')
     password = request.form.get('password')
+    admin_user = db.session.get(User, current_user.id)  # current_user is only the cached session copy
     if username:
-        current_user.username = username
+        admin_user.username = username
     if password:
-        current_user.password = generate_password_hash(password)
+        admin_user.password = hash_password(password)
     db.session.commit()
+    forget_user(admin_user.id)
     flash('Admin info updated successfully!')
     return redirect(url_for('admin.admin_dashboard'))
 
@@ -241,9 +385,10 @@ def register():
         
         # create new user - hash the password for security
         # learned about password hashing from a security tutorial
-        new_user = User(username=username, password=generate_password_hash(password), role='user')
+        new_user = User(username=username, password=hash_password(password), role='user')
         db.session.add(new_user)
         db.session.commit()
+        catalogue.invalidate_home_stats()  # user count changed
         flash('Registration successful! Please log in.')
         return redirect(url_for('auth.login'))
     return render_template('register.html')
@@ -257,7 +402,8 @@ def login():
             flash('Username and password are required')
             return redirect(url_for('auth.login'))
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
+        if user and check_password(user, password):
+            db.session.commit()  # saves the new hash if check_password upgraded it
             login_user(user)
             flash('Logged in successfully!')
             if user.role == 'admin':
@@ -286,26 +432,18 @@ def user_dashboard():
         flash('Access denied.')
         return redirect(url_for('auth.login'))
     
-    # get user's booking stats
-    user_reservations = Reservation.query.filter_by(user_id=current_user.id).all()
-    total_bookings = len(user_reservations)
-    active_bookings = len([r for r in user_reservations if not r.leaving_timestamp])  # bookings that are still active
-    # this could be optimized with a database query but it works for now
-    
-    # calculate how much money they spent
-    total_spent = 0
-    for reservation in user_reservations:
-        if reservation.leaving_timestamp:  # only completed bookings
-            total_spent += reservation.parking_cost or reservation.spot.lot.price or 0
-    # this calculation could be more sophisticated but it works for now
+    # get user's booking stats - counted in the database instead of loading every booking
+    totals = aggregates.user_stats(current_user.id)
+    total_bookings = totals['bookings']
+    active_bookings = totals['active']  # bookings that are still active
+    total_spent = totals['revenue']  # only completed bookings
     
     # get number of available lots
     available_lots = ParkingLot.query.count()
     
     # get recent bookings - limit to 5 to keep the page fast
-    last_reservations = Reservation.query.filter_by(user_id=current_user.id).order_by(Reservation.parking_timestamp.desc()).limit(5).all()
-    
-    # TODO: add pagination for reservations later
+    last_reservations = queries.user_reservations(current_user.id, limit=5)
+
     
     return render_template('user_dashboard.html', 
                          user=current_user, 
@@ -321,8 +459,23 @@ def user_lots():
     if current_user.role != 'user':
         flash('Access denied.')
         return redirect(url_for('auth.login'))
-    lots = ParkingLot.query.all()
-    return render_template('user_lots.html', lots=lots)
+    search = search_params(request.args)
+    if not search:
+        lots = catalogue.lots_with_counts()
+        return render_template('user_lots.html', view=lot_list(lots, USER_CARD), search=search)
+    # searching: only the matching lots, one page at a time (controllers/lotsearch.py)
+    try:
+        search_args, page = lot_search_args(request.args)
+    except ValueError as e:
+        flash(str(e))
+        return redirect(url_for('user.user_lots'))
+    offset, limit = search_args.pop('offset'), search_args.pop('limit')
+    lots = lot_search.matches(**search_args)
+    shown = lots[offset:offset + limit]
+    # the stats cards cover every match, the cards just this page
+    return render_template('user_lots.html', view=lot_list(lots, USER_CARD, shown=shown),
+                           search=search, page=page, total=len(lots),
+                           has_next=offset + len(shown) < len(lots))
 
 @user.route('/user/lots/<int:lot_id>/book', methods=['POST'])
 @login_required
@@ -331,15 +484,12 @@ def book_spot(lot_id):
         flash('Access denied.')
         return redirect(url_for('auth.login'))
     lot = ParkingLot.query.get_or_404(lot_id)
-    spot = ParkingSpot.query.filter_by(lot_id=lot.id, status='A').first()
-    if not spot:
+    # atomic compare-and-set on the spot row, retries on another spot if someone beats us to it
+    reservation = booking.book_in_lot(lot.id, current_user.id, current_app.config['BOOKING_MAX_ATTEMPTS'])
+    if not reservation:
         flash('No available spots in this lot.')
         return redirect(url_for('user.user_lots'))
-    spot.status = 'O'
-    reservation = Reservation(spot_id=spot.id, user_id=current_user.id, parking_timestamp=datetime.utcnow())
-    db.session.add(reservation)
-    db.session.commit()
-    flash(f'Spot {spot.id} booked successfully!')
+    flash(f'Spot {reservation.spot_id} booked successfully!')
     return redirect(url_for('user.reservations'))
 
 @user.route('/user/reservations')
@@ -348,8 +498,25 @@ def reservations():
     if current_user.role != 'user':
         flash('Access denied.')
         return redirect(url_for('auth.login'))
-    reservations = Reservation.query.filter_by(user_id=current_user.id).order_by(Reservation.parking_timestamp.desc()).all()
-    return render_template('user_reservations.html', reservations=reservations)
+    try:
+        page_args = reservation_args(request.args)
+    except ValueError as e:
+        flash(str(e))
+        return redirect(url_for('user.reservations'))
+    try:
+        reservations, next_cursor = queries.reservation_page(current_user.id, **page_args)
+    except ValueError:
+        flash('That page link is no longer valid.')
+        return redirect(url_for('user.reservations', **filter_params(request.args)))
+    totals = aggregates.user_stats(current_user.id)  # the stats cards cover all bookings, not just this page
+    lots = catalogue.lot_catalogue()
+    return render_template('user_reservations.html',
+                           reservations=reservations,
+                           next_cursor=next_cursor,
+                           filters=filter_params(request.args),
+                           is_first_page=not request.args.get('cursor'),
+                           totals=totals,
+                           lots=lots)
 
 @user.route('/user/reservations/<int:reservation_id>/release', methods=['POST'])
 @login_required
@@ -358,15 +525,49 @@ def release_spot(reservation_id):
         flash('Access denied.')
         return redirect(url_for('auth.login'))
     reservation = Reservation.query.get_or_404(reservation_id)
-    if reservation.user_id != current_user.id or reservation.leaving_timestamp:
+    if reservation.user_id != current_user.id or reservation.leaving_timestamp or reservation.upcoming:
         flash('Invalid operation.')
         return redirect(url_for('user.reservations'))
-    spot = ParkingSpot.query.get(reservation.spot_id)
-    if not spot:
-        flash('Spot not found.')
+    if not booking.release_reservation(reservation):
+        flash('Invalid operation.')  # released by another request in the meantime
         return redirect(url_for('user.reservations'))
-    spot.status = 'A'
-    reservation.leaving_timestamp = datetime.utcnow()
-    db.session.commit()
-    flash('Spot released successfully!')
+    if reservation.parking_cost is not None:
+        flash(f'Spot released successfully! Parking cost: ${reservation.parking_cost:.2f}')
+    else:
+        flash('Spot released successfully!')
+    return redirect(url_for('user.reservations'))
+
+# advance bookings: check in when you get there, or cancel before it starts
+@user.route('/user/reservations/<int:reservation_id>/check-in', methods=['POST'])
+@login_required
+def check_in(reservation_id):
+    if current_user.role != 'user':
+        flash('Access denied.')
+        return redirect(url_for('auth.login'))
+    reservation = Reservation.query.get_or_404(reservation_id)
+    if reservation.user_id != current_user.id:
+        flash('Invalid operation.')
+        return redirect(url_for('user.reservations'))
+    error = booking.check_in(reservation)
+    if error == 'too_early':
+        flash('Too early to check in for this booking.')
+    elif error == 'occupied':
+        flash('The spot is still occupied, try again in a few minutes.')
+    elif error:
+        flash('Invalid operation.')
+    else:
+        flash(f'Checked in to spot {reservation.spot_id}.')
+    return redirect(url_for('user.reservations'))
+
+@user.route('/user/reservations/<int:reservation_id>/cancel', methods=['POST'])
+@login_required
+def cancel_booking(reservation_id):
+    if current_user.role != 'user':
+        flash('Access denied.')
+        return redirect(url_for('auth.login'))
+    reservation = Reservation.query.get_or_404(reservation_id)
+    if reservation.user_id != current_user.id or not booking.cancel_window(reservation):
+        flash('Invalid operation.')
+        return redirect(url_for('user.reservations'))
+    flash('Booking cancelled.')
     return redirect(url_for('user.reservations')) 
\ No newline at end of file
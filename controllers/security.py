@@ -0,0 +1,71 @@
+# Password hashing and the logged-in user cache
+# Password hashes use PASSWORD_HASH_METHOD (any werkzeug method string, e.g.
+# "scrypt:32768:8:1" or "pbkdf2:sha256:600000"). When the setting changes,
+# old hashes keep working and are re-hashed the next time that user logs in.
+#
+# Flask-Login calls load_user on every request just to know who is logged in
+# and what their role is. Instead of a User query each time we keep
+# {id, username, role} in the app cache for SESSION_USER_TTL seconds and build
+# a small SessionUser from it. Anything that changes a user must call
+# forget_user() - and code that needs to modify the user loads the real row.
+
+from functools import lru_cache
+from flask import current_app
+from flask_login import UserMixin
+from werkzeug.security import check_password_hash, generate_password_hash
+from controllers.cache import cache
+from controllers.extensions import db
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'])
+
+
+@lru_cache(maxsize=8)
+def _method_prefix(method):
+    # what werkzeug writes before the first "$" for this method, e.g. "scrypt" -> "scrypt:32768:8:1"
+    return generate_password_hash('', method=method).split('$', 1)[0]
+
+
+def needs_rehash(pwhash):
+    return pwhash.split('$', 1)[0] != _method_prefix(current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def check_password(user, password):
+    # verifies the password and upgrades the stored hash if the settings changed
+    # the caller commits (login does anyway)
+    if not check_password_hash(user.password, password):
+        return False
+    if needs_rehash(user.password):
+        user.password = hash_password(password)
+    return True
+
+
+class SessionUser(UserMixin):
+    # what current_user is on normal requests - enough for the role checks and templates
+    def __init__(self, id, username, role):
+        self.id = id
+        self.username = username
+        self.role = role
+
+
+def _key(user_id):
+    return f'session-user:{user_id}'
+
+
+def load_session_user(user_id):
+    found, data = cache.get(_key(user_id))
+    if not found:
+        from models.models import User
+        row = (db.session.query(User.id, User.username, User.role)
+               .filter(User.id == user_id)
+               .first())
+        if row is None:
+            return None  # not cached, so a deleted user is logged out straight away
+        data = {'id': row.id, 'username': row.username, 'role': row.role}
+        cache.set(_key(user_id), data, current_app.config['SESSION_USER_TTL'])
+    return SessionUser(data['id'], data['username'], data['role'])
+
+
+def forget_user(user_id):
+    cache.invalidate(_key(user_id))
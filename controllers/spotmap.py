@@ -0,0 +1,101 @@
+# Compact spot maps for big lots
+# Instead of one JSON dict per spot we keep each lot as two flat arrays
+# (spot ids in number order + one status byte per spot) and encode them as
+# either a packed bitmap (1 bit per spot, set = occupied, base64) or
+# run-length "A"/"O" runs. A 10k spot lot is ~1.3KB as a bitmap.
+# The arrays are built with one tuple query and tagged with the lot's
+# change_version (models/versions.py); once the lot's version moves on, the
+# next request rebuilds them, whichever worker made the change.
+
+import base64
+import threading
+
+FORMATS = ('json', 'bitmap', 'rle')
+
+
+class SpotMap:
+    def __init__(self, lot_id, version, spot_ids, statuses):
+        self.lot_id = lot_id
+        self.version = version
+        self.ids = spot_ids  # spot number n is ids[n - 1]
+        self.statuses = bytes(statuses)  # b'A' or b'O' per spot
+        self._encoded = {}  # format -> payload
+        self._lock = threading.Lock()
+
+    def id_runs(self):
+        # spot ids as [first_id, length] runs - usually one run per resize
+        runs = []
+        for spot_id in self.ids:
+            if runs and runs[-1][0] + runs[-1][1] == spot_id:
+                runs[-1][1] += 1
+            else:
+                runs.append([spot_id, 1])
+        return runs
+
+    def bitmap(self):
+        # bit (n - 1) is spot number n, least significant bit first in each byte
+        packed = bytearray((len(self.statuses) + 7) // 8)
+        for i, status in enumerate(self.statuses):
+            if status == 79:  # 'O'
+                packed[i >> 3] |= 1 << (i & 7)
+        return bytes(packed)
+
+    def status_runs(self):
+        runs = []
+        for status in self.statuses.decode():
+            if runs and runs[-1][0] == status:
+                runs[-1][1] += 1
+            else:
+                runs.append([status, 1])
+        return runs
+
+    def encode(self, fmt):
+        with self._lock:
+            return self._encoded.get(fmt) or self._encode(fmt)
+
+    def _encode(self, fmt):
+        occupied = self.statuses.count(b'O')
+        payload = {'lot_id': self.lot_id, 'format': fmt, 'count': len(self.ids),
+                   'available': len(self.ids) - occupied, 'occupied': occupied,
+                   'ids': self.id_runs(), 'version': self.version}
+        if fmt == 'bitmap':
+            payload['occupied_bits'] = base64.b64encode(self.bitmap()).decode()
+        else:
+            payload['runs'] = self.status_runs()
+        self._encoded[fmt] = payload
+        return payload
+
+
+class SpotMapCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._maps = {}  # lot_id -> SpotMap
+
+    def get(self, lot_id, version):
+        # returns the lot's SpotMap, rebuilding it if it's missing or older than `version`
+        with self._lock:
+            spot_map = self._maps.get(lot_id)
+        if spot_map is not None and spot_map.version == version:
+            return spot_map
+        spot_map = self._build(lot_id, version)
+        with self._lock:
+            self._maps[lot_id] = spot_map
+        return spot_map
+
+    def _build(self, lot_id, version):
+        from models.models import ParkingSpot
+        from controllers.extensions import db
+        rows = (db.session.query(ParkingSpot.id, ParkingSpot.status)
+                .filter(ParkingSpot.lot_id == lot_id, ParkingSpot.status != 'R')
+                .order_by(ParkingSpot.id)
+                .all())
+        return SpotMap(lot_id, version, [spot_id for spot_id, _ in rows],
+                       ''.join(status for _, status in rows).encode())
+
+    def drop(self, lot_id):
+        with self._lock:
+            self._maps.pop(lot_id, None)
+
+
+# one cache per process
+spot_maps = SpotMapCache()
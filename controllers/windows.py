@@ -0,0 +1,126 @@
+# Interval index for advance bookings
+# An advance booking holds a spot for a window [start_time, end_time). For
+# every lot we keep, per spot, the upcoming windows sorted by start, so
+# "does this spot clash with [t1, t2)?" is a binary search instead of a scan
+# over every reservation the spot ever had, and "which spots in lot X are free
+# for [t1, t2)?" is one binary search per spot.
+# Like the free list in availability.py this only suggests - advance and
+# walk-in bookings both re-check the reservation table inside their
+# transaction before committing (models/booking.py). Lots are reloaded after
+# WINDOW_INDEX_TTL seconds so windows booked by other workers show up.
+
+import bisect
+import threading
+import time
+from datetime import datetime
+
+
+class SpotWindows:
+    # the windows of one spot never overlap, so sorting by start sorts them by end too
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, start, end):
+        i = bisect.bisect_left(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+
+    def remove(self, start, end):
+        i = bisect.bisect_left(self.starts, start)
+        if i < len(self.starts) and self.ends[i] == end:
+            del self.starts[i]
+            del self.ends[i]
+
+    def overlaps(self, start, end):
+        # first window that ends after `start` is the only one that can clash
+        i = bisect.bisect_right(self.ends, start)
+        return i < len(self.starts) and self.starts[i] < end
+
+    def __len__(self):
+        return len(self.starts)
+
+
+class LotWindows:
+    def __init__(self, spot_ids):
+        self.built_at = time.monotonic()
+        self.spot_ids = spot_ids  # every bookable spot, lowest id first
+        self.windows = {}  # spot_id -> SpotWindows, only spots that have any
+
+
+class WindowIndex:
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._lots = {}  # lot_id -> LotWindows
+
+    def init_app(self, app):
+        self.ttl = app.config['WINDOW_INDEX_TTL']
+
+    def _build(self, lot_id):
+        from models.models import ParkingSpot, Reservation
+        from controllers.extensions import db
+        spot_ids = [spot_id for (spot_id,) in db.session.query(ParkingSpot.id)
+                    .filter(ParkingSpot.lot_id == lot_id, ParkingSpot.status != 'R')
+                    .order_by(ParkingSpot.id)]
+        lot = LotWindows(spot_ids)
+        rows = (db.session.query(Reservation.spot_id, Reservation.start_time, Reservation.end_time)
+                .join(ParkingSpot, Reservation.spot_id == ParkingSpot.id)
+                .filter(ParkingSpot.lot_id == lot_id,
+                        Reservation.end_time.isnot(None),
+                        Reservation.end_time > datetime.utcnow(),  # past windows can't clash any more
+                        Reservation.leaving_timestamp.is_(None)))  # nor ones that ended early
+        for spot_id, start, end in rows:
+            lot.windows.setdefault(spot_id, SpotWindows()).add(start, end)
+        return lot
+
+    def _lot(self, lot_id):
+        with self._lock:
+            lot = self._lots.get(lot_id)
+        if lot is None or time.monotonic() - lot.built_at >= self.ttl:
+            lot = self._build(lot_id)
+            with self._lock:
+                self._lots[lot_id] = lot
+        return lot
+
+    def conflicts(self, lot_id, spot_id, start, end):
+        lot = self._lot(lot_id)
+        with self._lock:
+            windows = lot.windows.get(spot_id)
+            return windows is not None and windows.overlaps(start, end)
+
+    def free_spots(self, lot_id, start, end, limit=None):
+        # spot ids in the lot with nothing booked during [start, end), lowest first
+        lot = self._lot(lot_id)
+        free = []
+        with self._lock:
+            for spot_id in lot.spot_ids:
+                windows = lot.windows.get(spot_id)
+                if windows is None or not windows.overlaps(start, end):
+                    free.append(spot_id)
+                    if limit and len(free) >= limit:
+                        break
+        return free
+
+    def add(self, lot_id, spot_id, start, end):
+        # record a window this process just committed
+        with self._lock:
+            lot = self._lots.get(lot_id)
+            if lot is not None:
+                lot.windows.setdefault(spot_id, SpotWindows()).add(start, end)
+
+    def remove(self, lot_id, spot_id, start, end):
+        # forget a window this process just cancelled or ended
+        with self._lock:
+            lot = self._lots.get(lot_id)
+            windows = lot.windows.get(spot_id) if lot is not None else None
+            if windows is not None:
+                windows.remove(start, end)
+
+    def drop(self, lot_id):
+        with self._lock:
+            self._lots.pop(lot_id, None)
+
+
+# one index per process
+windows = WindowIndex()
@@ -0,0 +1,115 @@
+# Revenue and booking numbers computed in SQL
+# The dashboards used to load every Reservation and add things up in Python,
+# which gets slower every day as history piles up. These functions push the
+# sums and counts into grouped queries and only hand back plain numbers.
+
+from sqlalchemy import case, func, not_
+from controllers.extensions import db
+from models.models import ParkingLot, ParkingSpot, Reservation
+
+# a reservation is worth its stored cost, or the lot's price if no cost was saved
+revenue_expr = func.coalesce(Reservation.parking_cost, ParkingLot.price, 0)
+# advance bookings nobody has checked in for yet aren't stays, none of the totals count them
+upcoming_expr = Reservation.upcoming_clause()
+active_expr = case((Reservation.leaving_timestamp.is_(None), 1), else_=0)
+completed_expr = case((Reservation.leaving_timestamp.isnot(None), 1), else_=0)
+
+
+def _revenue_sum(include_active):
+    if include_active:
+        return func.coalesce(func.sum(revenue_expr), 0)
+    return func.coalesce(func.sum(case((Reservation.leaving_timestamp.isnot(None), revenue_expr), else_=0)), 0)
+
+
+def _totals_query(include_active=False):
+    return (db.session.query(
+                func.count(Reservation.id),
+                func.coalesce(func.sum(active_expr), 0),
+                func.coalesce(func.sum(completed_expr), 0),
+                _revenue_sum(include_active))
+            .select_from(Reservation)
+            .join(ParkingSpot, Reservation.spot_id == ParkingSpot.id)
+            .join(ParkingLot, ParkingSpot.lot_id == ParkingLot.id)
+            .filter(not_(upcoming_expr)))
+
+
+def _as_totals(row):
+    bookings, active, completed, revenue = row
+    return {
+        'bookings': bookings or 0,
+        'active': active or 0,
+        'completed': completed or 0,
+        'revenue': float(revenue or 0),
+    }
+
+
+def overall_totals(include_active=False, since=None):
+    # revenue only counts completed stays unless include_active is set
+    # `since` limits it to bookings made from that datetime on
+    query = _totals_query(include_active)
+    if since is not None:
+        query = query.filter(Reservation.parking_timestamp >= since)
+    return _as_totals(query.one())
+
+
+def total_revenue():
+    return overall_totals()['revenue']
+
+
+def user_totals(user_id, include_active=False):
+    # stays moved to the archive still count (they're all completed)
+    from models import archive
+    totals = _as_totals(_totals_query(include_active).filter(Reservation.user_id == user_id).one())
+    bookings, revenue = archive.user_totals(user_id)
+    totals['bookings'] += bookings
+    totals['completed'] += bookings
+    totals['revenue'] += revenue
+    return totals
+
+
+def user_stats(user_id):
+    # user_totals for the stat cards, cached under the user's reservations_version
+    # (bumped by every booking and release of theirs), so paging through a long
+    # history reads one integer instead of re-counting all of it on every page
+    from controllers.cache import cache
+    from models import versions
+    version = versions.user_version(user_id) or 0
+    return cache.get_or_set(f'user-stats:{user_id}:v{version}', lambda: user_totals(user_id))
+
+
+def lot_totals(lot_id, include_active=False, since=None):
+    query = _totals_query(include_active).filter(ParkingSpot.lot_id == lot_id)
+    if since is not None:
+        query = query.filter(Reservation.parking_timestamp >= since)
+    return _as_totals(query.one())
+
+
+def totals_by_lot(include_active=False):
+    # {lot_id: totals} for every lot that has at least one booking
+    rows = (_totals_query(include_active)
+            .add_columns(ParkingSpot.lot_id)
+            .group_by(ParkingSpot.lot_id)
+            .all())
+    return {row[-1]: _as_totals(row[:-1]) for row in rows}
+
+
+def totals_by_user(include_active=False):
+    rows = (_totals_query(include_active)
+            .add_columns(Reservation.user_id)
+            .group_by(Reservation.user_id)
+            .all())
+    return {row[-1]: _as_totals(row[:-1]) for row in rows}
+
+
+def totals_by_day(start=None, end=None, lot_id=None, include_active=False):
+    # list of (day, totals) ordered by day, grouped on the booking date
+    day = func.date(Reservation.parking_timestamp)
+    query = _totals_query(include_active).add_columns(day)
+    if start is not None:
+        query = query.filter(Reservation.parking_timestamp >= start)
+    if end is not None:
+        query = query.filter(Reservation.parking_timestamp < end)
+    if lot_id is not None:
+        query = query.filter(ParkingSpot.lot_id == lot_id)
+    rows = query.group_by(day).order_by(day).all()
+    return [(row[-1], _as_totals(row[:-1])) for row in rows]
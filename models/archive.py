@@ -0,0 +1,269 @@
+# Cold storage for old reservations
+# `flask archive-reservations` moves stays that ended more than
+# ARCHIVE_AFTER_DAYS ago out of the reservation table into one SQLite file per
+# month of parking_timestamp (ARCHIVE_DIR/reservations-YYYY-MM.db). The hot
+# table then only holds recent history and the open stays, so its indexes
+# stay small and backups stay quick.
+# Each archived row keeps the lot it was in and the revenue it counted for at
+# the time, so reports don't need the spot or lot to still exist.
+# Readers below only open the month files that overlap the dates asked for.
+
+import os
+import re
+import sqlite3
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from flask import current_app
+from sqlalchemy import case
+from controllers.extensions import db
+from models.models import ParkingLot, ParkingSpot, Reservation
+
+_FILE = re.compile(r'^reservations-(\d{4})-(\d{2})\.db$')
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS reservation ('
+    ' id INTEGER PRIMARY KEY, spot_id INTEGER, lot_id INTEGER, user_id INTEGER,'
+    ' parking_timestamp TEXT NOT NULL, leaving_timestamp TEXT NOT NULL,'
+    ' parking_cost REAL, revenue REAL NOT NULL, start_time TEXT, end_time TEXT)',
+    'CREATE INDEX IF NOT EXISTS ix_archive_lot_parked ON reservation (lot_id, parking_timestamp)',
+    'CREATE INDEX IF NOT EXISTS ix_archive_parked ON reservation (parking_timestamp)',
+    'CREATE INDEX IF NOT EXISTS ix_archive_user ON reservation (user_id)',
+]
+
+_COLUMNS = ('id', 'spot_id', 'lot_id', 'user_id', 'parking_timestamp', 'leaving_timestamp',
+            'parking_cost', 'revenue', 'start_time', 'end_time')
+
+
+def archive_dir():
+    return current_app.config['ARCHIVE_DIR'] or os.path.join(current_app.instance_path, 'archive')
+
+
+def _ts(value):
+    # same text format SQLite uses for the hot table, so string comparisons sort by time
+    return value.isoformat(sep=' ') if value is not None else None
+
+
+def _month(value):
+    return date(value.year, value.month, 1)
+
+
+def partitions(start=None, end=None):
+    # [(first day of month, path)] for the archived months overlapping [start, end)
+    folder = archive_dir()
+    if not os.path.isdir(folder):
+        return []
+    found = []
+    for name in sorted(os.listdir(folder)):
+        match = _FILE.match(name)
+        if not match:
+            continue
+        month = date(int(match.group(1)), int(match.group(2)), 1)
+        next_month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+        if start is not None and next_month <= start.date():
+            continue
+        if end is not None and month >= end.date() + timedelta(days=1 if end.time() else 0):
+            continue
+        found.append((month, os.path.join(folder, name)))
+    return found
+
+
+def _open(path, readonly=True):
+    if readonly:
+        return sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    connection = sqlite3.connect(path)
+    for statement in _SCHEMA:
+        connection.execute(statement)
+    return connection
+
+
+def _range_filter(start, end, lot_id=None):
+    where, params = [], []
+    if lot_id is not None:
+        where.append('lot_id = ?')
+        params.append(lot_id)
+    if start is not None:
+        where.append('parking_timestamp >= ?')
+        params.append(_ts(start))
+    if end is not None:
+        where.append('parking_timestamp < ?')
+        params.append(_ts(end))
+    return (' WHERE ' + ' AND '.join(where)) if where else '', params
+
+
+def _copy_rows(connection, month_rows):
+    # INSERT OR IGNORE the rows into one month file, returns the ids that are safely in it
+    # - a row ignored because a crashed run copied it already counts, one ignored because
+    # an older reservation with the same id is there (SQLite reuses the highest id once
+    # it's deleted) does not, and must stay in the hot table
+    inserted = connection.executemany(
+        f'INSERT OR IGNORE INTO reservation ({", ".join(_COLUMNS)}) '
+        f'VALUES ({", ".join("?" * len(_COLUMNS))})', month_rows).rowcount
+    ids = [row[0] for row in month_rows]
+    if inserted == len(month_rows):
+        return ids
+    stored = {(rid, user_id, parked) for rid, user_id, parked in connection.execute(
+        f'SELECT id, user_id, parking_timestamp FROM reservation WHERE id IN ({", ".join("?" * len(ids))})', ids)}
+    return [row[0] for row in month_rows if (row[0], row[3], row[4]) in stored]
+
+
+def archive_reservations(older_than_days, batch_size=5000, echo=None):
+    # moves completed stays that ended before the cutoff, one batch per transaction
+    # the month files are written (and committed) before the rows are deleted, so
+    # a crash half way just means the next run copies a few rows again
+    # returns ({month: rows}, lot ids touched, user ids touched)
+    from models import versions
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    folder = archive_dir()
+    os.makedirs(folder, exist_ok=True)
+    revenue = case((Reservation.parking_cost.isnot(None), Reservation.parking_cost),
+                   else_=ParkingLot.price)
+    query = (db.session.query(Reservation.id, Reservation.spot_id, ParkingSpot.lot_id, Reservation.user_id,
+                              Reservation.parking_timestamp, Reservation.leaving_timestamp,
+                              Reservation.parking_cost, revenue, Reservation.start_time, Reservation.end_time)
+             .outerjoin(ParkingSpot, Reservation.spot_id == ParkingSpot.id)
+             .outerjoin(ParkingLot, ParkingSpot.lot_id == ParkingLot.id)
+             .filter(Reservation.leaving_timestamp.isnot(None), Reservation.leaving_timestamp < cutoff)
+             .order_by(Reservation.id))
+    moved = defaultdict(int)
+    lots, users = set(), set()
+    last_id = 0
+    while True:
+        rows = query.filter(Reservation.id > last_id).limit(batch_size).all()
+        if not rows:
+            break
+        by_month = defaultdict(list)
+        for row in rows:
+            (rid, spot_id, lot_id, user_id, parked, left, cost, value, start, end) = row
+            by_month[_month(parked)].append((rid, spot_id, lot_id, user_id, _ts(parked), _ts(left),
+                                             cost, value or 0, _ts(start), _ts(end)))
+        copied = set()
+        for month, month_rows in by_month.items():
+            connection = _open(os.path.join(folder, f'reservations-{month:%Y-%m}.db'), readonly=False)
+            try:
+                with connection:
+                    month_ids = _copy_rows(connection, month_rows)
+            finally:
+                connection.close()
+            copied.update(month_ids)
+            if month_ids:
+                moved[month] += len(month_ids)
+            if echo and len(month_ids) < len(month_rows):
+                echo(f'{len(month_rows) - len(month_ids)} reservation(s) kept: their id is already '
+                     f'taken in the {month:%Y-%m} archive')
+        last_id = rows[-1][0]
+        ids = [row[0] for row in rows if row[0] in copied]
+        if ids:
+            batch_lots = {row[2] for row in rows if row[0] in copied and row[2] is not None}
+            batch_users = {row[3] for row in rows if row[0] in copied}
+            db.session.execute(Reservation.__table__.delete().where(Reservation.__table__.c.id.in_(ids)))
+            # lot summaries and user histories change, so their ETags move in the same commit
+            for lot_id in batch_lots:
+                versions.bump_lot(lot_id)
+            versions.bump_users(batch_users)
+            db.session.commit()
+            lots |= batch_lots
+            users |= batch_users
+        if echo:
+            echo(f'archived {sum(moved.values())} reservations (up to id {last_id})')
+    return dict(moved), lots, users
+
+
+def lot_reservations(lot_id, start=None, end=None):
+    # archived bookings of a lot as plain dicts, oldest first
+    found = []
+    where, params = _range_filter(start, end, lot_id)
+    for _, path in partitions(start, end):
+        connection = _open(path)
+        try:
+            cursor = connection.execute(
+                'SELECT id, user_id, parking_timestamp, leaving_timestamp, parking_cost FROM reservation'
+                f'{where} ORDER BY id', params)
+            found.extend({'id': rid, 'user_id': user_id,
+                          'parking_timestamp': datetime.fromisoformat(parked),
+                          'leaving_timestamp': datetime.fromisoformat(left),
+                          'parking_cost': cost}
+                         for rid, user_id, parked, left, cost in cursor)
+        finally:
+            connection.close()
+    return found
+
+
+def totals_by_day(start=None, end=None, lot_id=None):
+    # {day 'YYYY-MM-DD': (bookings, revenue, occupied minutes)} - everything archived is completed
+    totals = {}
+    where, params = _range_filter(start, end, lot_id)
+    for _, path in partitions(start, end):
+        connection = _open(path)
+        try:
+            for day, bookings, revenue, minutes in connection.execute(
+                    'SELECT date(parking_timestamp), count(*), sum(revenue),'
+                    ' sum((julianday(leaving_timestamp) - julianday(parking_timestamp)) * 1440)'
+                    f' FROM reservation{where} GROUP BY 1', params):
+                old = totals.get(day, (0, 0.0, 0.0))
+                totals[day] = (old[0] + bookings, old[1] + (revenue or 0), old[2] + max(minutes or 0, 0))
+        finally:
+            connection.close()
+    return totals
+
+
+def user_totals(user_id):
+    # (bookings, revenue) archived for one user, across every month file
+    bookings, revenue = 0, 0.0
+    for _, path in partitions():
+        connection = _open(path)
+        try:
+            count, total = connection.execute(
+                'SELECT count(*), sum(revenue) FROM reservation WHERE user_id = ?', (user_id,)).fetchone()
+        finally:
+            connection.close()
+        bookings += count
+        revenue += total or 0
+    return bookings, revenue
+
+
+def rollup_totals(since=None):
+    # {(lot_id, day): (bookings, revenue, minutes)} for rebuilding lot_daily_rollup
+    start = datetime(since.year, since.month, since.day) if since is not None else None
+    where, params = _range_filter(start, None)
+    where = (where + ' AND' if where else ' WHERE') + ' lot_id IS NOT NULL'
+    totals = defaultdict(lambda: (0, 0.0, 0.0))
+    for _, path in partitions(start, None):
+        connection = _open(path)
+        try:
+            for lot_id, day, bookings, revenue, minutes in connection.execute(
+                    'SELECT lot_id, date(parking_timestamp), count(*), sum(revenue),'
+                    ' sum((julianday(leaving_timestamp) - julianday(parking_timestamp)) * 1440)'
+                    f' FROM reservation{where} GROUP BY 1, 2', params):
+                old = totals[(lot_id, day)]
+                totals[(lot_id, day)] = (old[0] + bookings, old[1] + (revenue or 0), old[2] + max(minutes or 0, 0))
+        finally:
+            connection.close()
+    return dict(totals)
+
+
+def iter_reservations(start=None, end=None, lot_id=None, batch_size=5000):
+    # archived rows as lists of dicts, batch_size at a time, month by month (for exports)
+    where, params = _range_filter(start, end, lot_id)
+    for _, path in partitions(start, end):
+        connection = _open(path)
+        try:
+            cursor = connection.execute(f'SELECT {", ".join(_COLUMNS)} FROM reservation{where} ORDER BY id', params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [dict(zip(_COLUMNS, row)) for row in rows]
+        finally:
+            connection.close()
+
+
+def count_reservations(start=None, end=None, lot_id=None):
+    where, params = _range_filter(start, end, lot_id)
+    total = 0
+    for _, path in partitions(start, end):
+        connection = _open(path)
+        try:
+            total += connection.execute(f'SELECT count(*) FROM reservation{where}', params).fetchone()[0]
+        finally:
+            connection.close()
+    return total
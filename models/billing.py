@@ -0,0 +1,139 @@
+# Working out what a stay costs
+# ParkingLot.price is per hour. A stay is billed in steps of
+# BILLING_INCREMENT_MINUTES (rounded up, at least one step), and no single day
+# costs more than BILLING_DAILY_CAP_HOURS hours of parking. The cost is stored
+# on the reservation when it's released so revenue doesn't have to guess.
+#
+# `flask recompute-costs` prices old reservations in bulk: on SQLite each batch
+# of ids is priced by one UPDATE with the tariff written out as a SQL
+# expression (Tariff.cost_expression), so no rows come back to Python. The
+# maths is done in whole microseconds and cents the same way in cost() and in
+# the SQL so both give the same number; tests/test_billing.py checks that.
+# Other databases fall back to pricing each row with cost().
+
+import math
+from datetime import timedelta
+from flask import current_app
+from sqlalchemy import Float, Integer, String, bindparam, case, cast, func, select
+from controllers.extensions import db
+from models.models import ParkingLot, ParkingSpot, Reservation
+
+MICROSECOND = timedelta(microseconds=1)
+DAY_MICROS = 24 * 3600 * 1000000
+
+
+def round_cents(amount):
+    # half a cent rounds up - written so SQLite gets the same float maths (see cost_expression)
+    return math.floor(amount * 100 + 0.5) / 100
+
+
+def _sql_micros(ts):
+    # a SQLite timestamp ('YYYY-MM-DD HH:MM:SS.ffffff') as whole microseconds since 1970
+    # (strftime would round the fraction to milliseconds, so seconds and micros are read separately)
+    text = cast(ts, String)
+    return (cast(func.strftime('%s', func.substr(text, 1, 19)), Integer) * 1000000
+            + cast(func.substr(text.concat('000000'), 21, 6), Integer))
+
+
+class Tariff:
+    def __init__(self, increment_minutes=15, daily_cap_hours=None):
+        if increment_minutes < 1:
+            raise ValueError('increment_minutes must be at least 1')
+        self.increment_minutes = increment_minutes
+        self.daily_cap_hours = daily_cap_hours  # None or 0 means no cap
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['BILLING_INCREMENT_MINUTES'], config['BILLING_DAILY_CAP_HOURS'])
+
+    def billable_hours(self, micros):
+        # hours we charge for a stay of `micros` microseconds
+        days, rest = divmod(max(micros, 0), DAY_MICROS)
+        rest = (rest + 30) // 60  # to the nearest millionth of a minute, so 30.0000001 minutes isn't 3 steps
+        step = self.increment_minutes * 1000000
+        steps = (rest + step - 1) // step
+        if days == 0:
+            steps = max(steps, 1)  # even a quick in-and-out pays one step
+        last_day = min(steps * self.increment_minutes, 1440) / 60
+        full_day = 24
+        if self.daily_cap_hours:
+            last_day = min(last_day, self.daily_cap_hours)
+            full_day = min(full_day, self.daily_cap_hours)
+        return days * full_day + last_day
+
+    def cost(self, parked, left, rate):
+        if rate is None:
+            return None
+        return round_cents(self.billable_hours((left - parked) // MICROSECOND) * rate)
+
+    def cost_expression(self, parked, left, rate):
+        # cost() as a SQLite expression over columns - same steps, same order of float operations
+        micros = func.max(_sql_micros(left) - _sql_micros(parked), 0)
+        days = micros // DAY_MICROS
+        rest = (micros % DAY_MICROS + 30) // 60
+        step = self.increment_minutes * 1000000
+        steps = func.max((rest + step - 1) // step, case((days == 0, 1), else_=0))
+        last_day = cast(func.min(steps * self.increment_minutes, 1440), Float) / 60
+        full_day = 24
+        if self.daily_cap_hours:
+            last_day = func.min(last_day, self.daily_cap_hours)
+            full_day = min(full_day, self.daily_cap_hours)
+        amount = (days * full_day + last_day) * rate
+        return cast(amount * 100 + 0.5, Integer) / 100.0  # NULL rate gives NULL, like cost()
+
+
+def tariff():
+    return Tariff.from_config(current_app.config)
+
+
+def recompute_costs(batch_size=5000, only_missing=False, echo=None):
+    # re-price every completed reservation with the current tariff and lot prices
+    # returns (priced, lot_ids touched, earliest parking day touched)
+    rules = tariff()
+    set_based = db.session.get_bind().dialect.name == 'sqlite'
+    table = Reservation.__table__
+    query = (db.session.query(Reservation.id)
+             .join(ParkingSpot, Reservation.spot_id == ParkingSpot.id)
+             .join(ParkingLot, ParkingSpot.lot_id == ParkingLot.id)
+             .filter(Reservation.leaving_timestamp.isnot(None)))
+    if only_missing:
+        query = query.filter(Reservation.parking_cost.is_(None))
+    priced, lots, earliest = 0, set(), None
+    last_id = 0
+    while True:
+        # the batch is the next batch_size matching ids: (last_id, upto]
+        upto = (query.filter(Reservation.id > last_id).order_by(Reservation.id)
+                .offset(batch_size - 1).limit(1).scalar())
+        if upto is None:
+            upto = query.filter(Reservation.id > last_id).with_entities(func.max(Reservation.id)).scalar()
+            if upto is None:
+                break
+        in_batch = query.filter(Reservation.id > last_id, Reservation.id <= upto)
+        # per lot: how many, and the first day - for the rollup rebuild
+        for lot_id, count, first in (in_batch.with_entities(ParkingLot.id, func.count(Reservation.id),
+                                                              func.min(Reservation.parking_timestamp))
+                                     .group_by(ParkingLot.id)):
+            priced += count
+            lots.add(lot_id)
+            earliest = first.date() if earliest is None else min(earliest, first.date())
+        if set_based:
+            price = (select(ParkingLot.price)
+                     .join(ParkingSpot, ParkingSpot.lot_id == ParkingLot.id)
+                     .where(ParkingSpot.id == table.c.spot_id)
+                     .scalar_subquery())
+            db.session.execute(table.update()
+                               .where(table.c.id.in_(in_batch.subquery().select()))
+                               .values(parking_cost=rules.cost_expression(
+                                   table.c.parking_timestamp, table.c.leaving_timestamp, price)))
+        else:
+            rows = in_batch.with_entities(Reservation.id, Reservation.parking_timestamp,
+                                          Reservation.leaving_timestamp, ParkingLot.price).all()
+            db.session.execute(table.update()
+                               .where(table.c.id == bindparam('reservation_id'))
+                               .values(parking_cost=bindparam('cost')),
+                               [{'reservation_id': i, 'cost': rules.cost(p, l, r)} for i, p, l, r in rows])
+        db.session.commit()
+        last_id = upto
+        if echo:
+            echo(f'priced {priced} reservations (up to id {last_id})')
+    return priced, lots, earliest
@@ -0,0 +1,578 @@
+# Booking and releasing spots
+# Spots are claimed with a compare-and-set UPDATE (... WHERE status='A') and
+# the rowcount tells us whether we won, so two requests can never end up with
+# the same spot even across gunicorn workers. The in-memory free list only
+# suggests which spot to try next.
+#
+# The batch functions are for the api: a gate controller can send dozens of
+# spots at once - every item is checked first, the spots are claimed with one
+# conditional UPDATE, all reservations are inserted in one go and everything is
+# committed once. Each item gets its own result, so one taken spot doesn't fail
+# the batch.
+#
+# Advance bookings (book_window) hold a spot for a future [start, end) window.
+# Until it starts the reservation is "upcoming": only start_time/end_time are
+# set, it has no cost and none of the totals or rollups count it, and it can
+# be cancelled. check_in() turns it into a normal stay (spot occupied, priced
+# on release) - the driver can check in up to WALKIN_HOLD_MINUTES early, and
+# `flask advance-windows` checks in windows that have started, ends them at
+# end_time and drops ones whose spot never came free. Walk-ins skip spots whose
+# window starts within WALKIN_HOLD_MINUTES: the window index suggests, and the
+# reservation table is checked again in the same transaction as the booking.
+
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, bindparam, or_
+from sqlalchemy.orm.attributes import set_committed_value
+from controllers.availability import availability
+from controllers.extensions import db
+from controllers.windows import windows
+from models.models import ParkingLot, ParkingSpot, Reservation, User
+from models.occupancy import adjust_lot_counts, announce, occupy_spot, vacate_spot
+from models import billing, rollups, versions
+
+
+class BatchError(ValueError):
+    # the payload as a whole is unusable (not a list, too big, ...)
+    pass
+
+
+def _as_int(value):
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _check_items(items, max_items, key):
+    if not isinstance(items, list) or not items:
+        raise BatchError(f'"{key}" must be a non-empty list')
+    if len(items) > max_items:
+        raise BatchError(f'at most {max_items} items per batch')
+    if not all(isinstance(item, dict) for item in items):
+        raise BatchError(f'every item in "{key}" must be an object')
+
+
+def _set_spot_status(spot_ids, from_status, to_status):
+    # flips every spot in spot_ids that still has from_status, returns {spot_id: lot_id} for the ones flipped
+    if not spot_ids:
+        return {}
+    table = ParkingSpot.__table__
+    stmt = (table.update()
+            .where(table.c.id.in_(spot_ids), table.c.status == from_status)
+            .values(status=to_status))
+    if db.session.get_bind().dialect.update_returning:
+        return dict(db.session.execute(stmt.returning(table.c.id, table.c.lot_id)).all())
+    # no RETURNING (e.g. MySQL): fall back to one compare-and-set per spot, still one transaction
+    lot_ids = dict(db.session.query(ParkingSpot.id, ParkingSpot.lot_id).filter(ParkingSpot.id.in_(spot_ids)))
+    flipped = {}
+    for spot_id in spot_ids:
+        result = db.session.execute(stmt.where(table.c.id == spot_id))
+        if result.rowcount:
+            flipped[spot_id] = lot_ids[spot_id]
+    return flipped
+
+
+def _is_stay(table):
+    # open reservations that are stays - walk-ins, or advance bookings that were checked in
+    return and_(table.c.leaving_timestamp.is_(None),
+                or_(table.c.start_time.is_(None), table.c.checked_in_at.isnot(None)))
+
+
+def _end_reservations(reservation_ids, now):
+    # sets leaving_timestamp on the ones still open, returns the set of ids it ended
+    if not reservation_ids:
+        return set()
+    table = Reservation.__table__
+    stmt = (table.update()
+            .where(table.c.id.in_(reservation_ids), _is_stay(table))
+            .values(leaving_timestamp=now))
+    if db.session.get_bind().dialect.update_returning:
+        return {rid for (rid,) in db.session.execute(stmt.returning(table.c.id))}
+    return {rid for rid in reservation_ids if db.session.execute(stmt.where(table.c.id == rid)).rowcount}
+
+
+def _walkin_window():
+    # a walk-in has no end, so it clashes with anything booked to start soon
+    now = datetime.utcnow()
+    return now, now + timedelta(minutes=current_app.config['WALKIN_HOLD_MINUTES'])
+
+
+def _booked_spots(spot_ids, start, end):
+    # the spots in spot_ids with an advance booking (not ended yet) overlapping [start, end)
+    # - the database's answer, the index may not know about other workers' bookings yet
+    if not spot_ids:
+        return set()
+    return {spot_id for (spot_id,) in db.session.query(Reservation.spot_id)
+            .filter(Reservation.spot_id.in_(spot_ids),
+                    Reservation.end_time > start,
+                    Reservation.start_time < end,
+                    Reservation.leaving_timestamp.is_(None))
+            .distinct()}
+
+
+def _claim_other_than(lot_id, taken):
+    # next free spot in the lot that isn't already asked for by id in this batch
+    # and isn't about to be used by an advance booking
+    start, end = _walkin_window()
+    held = []  # free but booked soon - back on the free list once we're done
+    refreshed = False
+    try:
+        while True:
+            spot_id = availability.claim(lot_id)
+            if spot_id is None:
+                if refreshed:
+                    return None
+                availability.refresh_lot(lot_id)
+                refreshed = True
+            elif spot_id in taken:
+                continue
+            elif windows.conflicts(lot_id, spot_id, start, end):
+                held.append(spot_id)
+            else:
+                return spot_id
+    finally:
+        for spot_id in held:
+            availability.release(lot_id, spot_id)
+
+
+def _add_reservation(spot_id, lot_id, user_id):
+    reservation = Reservation(spot_id=spot_id, user_id=user_id, parking_timestamp=datetime.utcnow())
+    db.session.add(reservation)
+    rollups.record_booking(lot_id, reservation)
+    versions.bump_users([user_id])
+    return reservation
+
+
+def book_in_lot(lot_id, user_id, max_attempts):
+    # book any free spot in the lot, returns the Reservation or None if the lot is full
+    # if another request beats us to a spot we move on to the next one, at most max_attempts times
+    spot_id = None
+    attempts = 0
+    refreshed = False
+    try:
+        while attempts < max_attempts:
+            spot_id = _claim_other_than(lot_id, ())
+            if spot_id is None:
+                break
+            if occupy_spot(spot_id, lot_id):
+                if _booked_spots([spot_id], *_walkin_window()):
+                    # another worker booked it in advance and our window index hasn't seen it yet
+                    db.session.rollback()
+                    availability.release(lot_id, spot_id)
+                    windows.drop(lot_id)
+                    spot_id = None
+                    attempts += 1
+                    continue
+                reservation = _add_reservation(spot_id, lot_id, user_id)
+                db.session.commit()
+                announce(lot_id, [(spot_id, 'O')])
+                return reservation
+            spot_id = None  # lost the race (or a stale free-list entry) - nothing to undo
+            if refreshed:
+                attempts += 1
+            else:
+                # the first miss usually means other workers booked spots our free list
+                # still has - reload the lot once, only misses after that count
+                availability.refresh_lot(lot_id)
+                refreshed = True
+    except Exception:
+        db.session.rollback()
+        if spot_id is not None:
+            availability.release(lot_id, spot_id)
+        raise
+    db.session.rollback()
+    return None
+
+
+def book_spot_by_id(spot_id, user_id):
+    # book one exact spot - returns (reservation, None) or (None, 'not_found' / 'occupied')
+    lot_id = db.session.query(ParkingSpot.lot_id).filter(ParkingSpot.id == spot_id).scalar()
+    if lot_id is None:
+        return None, 'not_found'
+    if windows.conflicts(lot_id, spot_id, *_walkin_window()):
+        return None, 'booked'
+    if not occupy_spot(spot_id, lot_id):
+        db.session.rollback()
+        return None, 'occupied'
+    try:
+        if _booked_spots([spot_id], *_walkin_window()):
+            db.session.rollback()
+            windows.drop(lot_id)  # the index is behind, re-read the lot next time
+            return None, 'booked'
+        reservation = _add_reservation(spot_id, lot_id, user_id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    availability.discard(lot_id, spot_id)
+    announce(lot_id, [(spot_id, 'O')])
+    return reservation, None
+
+
+def release_reservation(reservation, now=None):
+    # end a stay and price it, returns False if it was already released (e.g. a double click)
+    # or is an advance booking that hasn't started (those are cancelled, not released)
+    now = now or datetime.utcnow()
+    window = (reservation.start_time, reservation.end_time)
+    row = (db.session.query(ParkingSpot.lot_id, ParkingLot.price)
+           .join(ParkingLot, ParkingSpot.lot_id == ParkingLot.id)
+           .filter(ParkingSpot.id == reservation.spot_id)
+           .first())  # None if the lot has been deleted since
+    cost = billing.tariff().cost(reservation.parking_timestamp, now, row.price) if row else None
+    table = Reservation.__table__
+    result = db.session.execute(
+        table.update()
+        .where(table.c.id == reservation.id, _is_stay(table))
+        .values(leaving_timestamp=now, parking_cost=cost))
+    if result.rowcount != 1:
+        db.session.rollback()
+        return False
+    set_committed_value(reservation, 'leaving_timestamp', now)
+    set_committed_value(reservation, 'parking_cost', cost)
+    try:
+        versions.bump_users([reservation.user_id])
+        if row is not None:
+            lot_id = row.lot_id
+            vacate_spot(reservation.spot_id, lot_id)
+            rollups.record_release(lot_id, reservation, cost)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if row is not None:
+        availability.release(lot_id, reservation.spot_id)
+        if window[1] is not None:
+            windows.remove(lot_id, reservation.spot_id, *window)
+        announce(lot_id, [(reservation.spot_id, 'A')])
+    return True
+
+
+def book_window(user_id, start, end, max_attempts, spot_id=None, lot_id=None):
+    # advance booking of one spot (or any spot in lot_id) for [start, end)
+    # returns (reservation, None) or (None, 'not_found' / 'unavailable')
+    if spot_id is not None:
+        lot_id = db.session.query(ParkingSpot.lot_id).filter(ParkingSpot.id == spot_id).scalar()
+    if lot_id is None or db.session.get(ParkingLot, lot_id) is None:
+        return None, 'not_found'
+    if spot_id is not None:
+        candidates = [spot_id] if not windows.conflicts(lot_id, spot_id, start, end) else []
+    else:
+        candidates = windows.free_spots(lot_id, start, end, limit=max_attempts)
+    # a window that starts soon also needs the spot to be free right now
+    starts_soon = start < _walkin_window()[1]
+    table = ParkingSpot.__table__
+    for candidate in candidates:
+        try:
+            # no-op UPDATE so the spot row (SQLite: the database) is locked before we check for clashes -
+            # two workers booking the same window can't both pass the check
+            lock = table.update().where(table.c.id == candidate).values(status=table.c.status)
+            lock = lock.where(table.c.status == 'A') if starts_soon else lock.where(table.c.status != 'R')
+            if db.session.execute(lock).rowcount != 1 or _booked_spots([candidate], start, end):
+                db.session.rollback()
+                windows.drop(lot_id)  # someone else got there first, re-read the lot next time
+                continue
+            # just the window for now - check_in() makes it a stay, the rollups count it from then
+            reservation = Reservation(spot_id=candidate, user_id=user_id, parking_timestamp=start,
+                                      start_time=start, end_time=end)
+            db.session.add(reservation)
+            versions.bump_users([user_id])
+            versions.bump_lot(lot_id)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        windows.add(lot_id, candidate, start, end)
+        return reservation, None
+    return None, 'unavailable'
+
+
+def check_in(reservation, now=None, started=None):
+    # start an advance booking: the spot is occupied and the stay runs (and is priced) from
+    # `started`, default now. Returns None or 'not_upcoming' / 'too_early' / 'expired' / 'occupied'.
+    now = now or datetime.utcnow()
+    if not reservation.upcoming:
+        return 'not_upcoming'
+    if now < reservation.start_time - timedelta(minutes=current_app.config['WALKIN_HOLD_MINUTES']):
+        return 'too_early'
+    if now >= reservation.end_time:
+        return 'expired'
+    lot_id = db.session.query(ParkingSpot.lot_id).filter(ParkingSpot.id == reservation.spot_id).scalar()
+    started = started or now
+    try:
+        if lot_id is None or not occupy_spot(reservation.spot_id, lot_id):
+            db.session.rollback()
+            return 'occupied'  # the previous driver hasn't left yet
+        table = Reservation.__table__
+        result = db.session.execute(
+            table.update()
+            .where(table.c.id == reservation.id, table.c.checked_in_at.is_(None),
+                   table.c.leaving_timestamp.is_(None))
+            .values(checked_in_at=now, parking_timestamp=started))
+        if result.rowcount != 1:
+            db.session.rollback()
+            return 'not_upcoming'  # checked in or cancelled by another request
+        set_committed_value(reservation, 'checked_in_at', now)
+        set_committed_value(reservation, 'parking_timestamp', started)
+        rollups.record_booking(lot_id, reservation)
+        versions.bump_users([reservation.user_id])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    availability.discard(lot_id, reservation.spot_id)
+    announce(lot_id, [(reservation.spot_id, 'O')])
+    return None
+
+
+def cancel_window(reservation):
+    # drop an advance booking that hasn't started, returns False if it has (or is gone already)
+    table = Reservation.__table__
+    upcoming = and_(table.c.start_time.isnot(None), table.c.checked_in_at.is_(None),
+                    table.c.leaving_timestamp.is_(None))
+    spot_id, start, end = reservation.spot_id, reservation.start_time, reservation.end_time
+    lot_id = db.session.query(ParkingSpot.lot_id).filter(ParkingSpot.id == spot_id).scalar()
+    try:
+        result = db.session.execute(table.delete().where(table.c.id == reservation.id, upcoming))
+        if result.rowcount != 1:
+            db.session.rollback()
+            return False
+        versions.bump_users([reservation.user_id])
+        if lot_id is not None:
+            versions.bump_lot(lot_id)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    db.session.expunge(reservation)
+    if lot_id is not None:
+        windows.remove(lot_id, spot_id, start, end)
+    return True
+
+
+def advance_windows(now=None):
+    # run from cron (`flask advance-windows`): checks in advance bookings whose window
+    # has started, ends checked-in ones at their end_time and drops ones that ran out
+    # without the spot ever coming free. Returns {'checked_in': n, 'ended': n, 'expired': n}.
+    now = now or datetime.utcnow()
+    counts = Counter(checked_in=0, ended=0, expired=0)
+    due = (Reservation.query
+           .filter(Reservation.upcoming_clause(), Reservation.start_time <= now)
+           .order_by(Reservation.start_time)
+           .all())
+    for reservation in due:
+        if reservation.end_time <= now:
+            counts['expired'] += cancel_window(reservation)
+        elif check_in(reservation, now=now, started=reservation.start_time) is None:
+            counts['checked_in'] += 1
+    overdue = (Reservation.query
+               .filter(Reservation.checked_in_at.isnot(None), Reservation.leaving_timestamp.is_(None),
+                       Reservation.end_time <= now)
+               .all())
+    for reservation in overdue:
+        counts['ended'] += release_reservation(reservation, now=reservation.end_time)
+    return dict(counts)
+
+
+def reserve_batch(items, max_items):
+    # items: [{"user_id": 1, "spot_id": 5}, {"user_id": 1, "lot_id": 2}, ...]
+    # spot_id books that exact spot, lot_id books any free spot in the lot
+    _check_items(items, max_items, 'reservations')
+    results = [None] * len(items)
+
+    user_ids = {_as_int(item.get('user_id')) for item in items}
+    known_users = {uid for (uid,) in db.session.query(User.id).filter(User.id.in_(user_ids - {None}))}
+    lot_ids = {_as_int(item.get('lot_id')) for item in items if 'lot_id' in item}
+    known_lots = {lid for (lid,) in db.session.query(ParkingLot.id).filter(ParkingLot.id.in_(lot_ids - {None}))}
+
+    # work out which spot each item wants - explicit spot ids first so the
+    # "any spot in lot X" items can't be handed one of them
+    wanted = {}  # item index -> spot id
+    claimed_from_index = {}  # item index -> lot id, for spots we took off the free list
+    lot_items = []
+    for i, item in enumerate(items):
+        user_id = _as_int(item.get('user_id'))
+        if user_id not in known_users:
+            results[i] = {'index': i, 'status': 'invalid', 'error': 'unknown user_id'}
+        elif 'spot_id' in item:
+            spot_id = _as_int(item.get('spot_id'))
+            if spot_id is None:
+                results[i] = {'index': i, 'status': 'invalid', 'error': 'spot_id must be a number'}
+            elif spot_id in wanted.values():
+                results[i] = {'index': i, 'status': 'unavailable', 'error': 'spot requested twice in this batch'}
+            else:
+                wanted[i] = spot_id
+        elif 'lot_id' in item:
+            lot_items.append(i)
+        else:
+            results[i] = {'index': i, 'status': 'invalid', 'error': 'spot_id or lot_id is required'}
+
+    # exact spots follow the same walk-in hold as book_spot_by_id
+    if wanted:
+        spot_lots = dict(db.session.query(ParkingSpot.id, ParkingSpot.lot_id)
+                         .filter(ParkingSpot.id.in_(set(wanted.values()))))
+        start, end = _walkin_window()
+        for i, spot_id in list(wanted.items()):
+            lot_id = spot_lots.get(spot_id)
+            if lot_id is not None and windows.conflicts(lot_id, spot_id, start, end):
+                results[i] = {'index': i, 'status': 'unavailable', 'error': 'spot is booked in advance'}
+                del wanted[i]
+
+    requested_spots = set(wanted.values())
+    for i in lot_items:
+        lot_id = _as_int(items[i].get('lot_id'))
+        if lot_id not in known_lots:
+            results[i] = {'index': i, 'status': 'invalid', 'error': 'unknown lot_id'}
+            continue
+        spot_id = _claim_other_than(lot_id, requested_spots)
+        if spot_id is None:
+            results[i] = {'index': i, 'status': 'unavailable', 'error': 'no free spots in this lot'}
+        else:
+            wanted[i] = spot_id
+            requested_spots.add(spot_id)
+            claimed_from_index[i] = lot_id
+
+    held = set()
+    try:
+        flipped = _set_spot_status(list(wanted.values()), 'A', 'O')
+        # the window index may be behind other workers - the database has the last word
+        held = _booked_spots(list(flipped), *_walkin_window())
+        if held:
+            _set_spot_status(list(held), 'O', 'A')
+        now = datetime.utcnow()
+        booked = []
+        for i, spot_id in wanted.items():
+            if spot_id in held:
+                results[i] = {'index': i, 'status': 'unavailable', 'error': 'spot is booked in advance'}
+                continue
+            if spot_id not in flipped:
+                # taken already (or doesn't exist) - index entries for those were stale anyway
+                results[i] = {'index': i, 'status': 'unavailable', 'error': 'spot is not available'}
+                continue
+            reservation = Reservation(spot_id=spot_id, user_id=_as_int(items[i]['user_id']), parking_timestamp=now)
+            booked.append((i, flipped[spot_id], reservation))
+        db.session.add_all([reservation for _, _, reservation in booked])
+        db.session.flush()  # one multi-row INSERT, gives us the ids
+
+        per_lot = Counter(lot_id for _, lot_id, _ in booked)
+        for lot_id, count in per_lot.items():
+            adjust_lot_counts(lot_id, available_delta=-count, occupied_delta=count)
+            rollups.record_totals(lot_id, now.date(), bookings=count)
+        versions.bump_users(reservation.user_id for _, _, reservation in booked)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        for i, lot_id in claimed_from_index.items():
+            availability.release(lot_id, wanted[i])
+        raise
+
+    for lot_id in {flipped[spot_id] for spot_id in held}:
+        windows.drop(lot_id)
+    for i, lot_id in claimed_from_index.items():
+        if wanted[i] in held:
+            availability.release(lot_id, wanted[i])  # still free, just not for a walk-in
+
+    changes = defaultdict(list)
+    for i, lot_id, reservation in booked:
+        if i not in claimed_from_index:
+            availability.discard(lot_id, reservation.spot_id)
+        changes[lot_id].append((reservation.spot_id, 'O'))
+        results[i] = {'index': i, 'status': 'reserved', 'reservation_id': reservation.id,
+                      'spot_id': reservation.spot_id, 'lot_id': lot_id}
+    for lot_id, spots in changes.items():
+        announce(lot_id, spots)
+    return results
+
+
+def release_batch(items, max_items):
+    # items: [{"reservation_id": 7}, ...] - optionally with "user_id" to check ownership
+    _check_items(items, max_items, 'releases')
+    results = [None] * len(items)
+    ids = [_as_int(item.get('reservation_id')) for item in items]
+    found = {r.id: r for r in Reservation.query.filter(Reservation.id.in_({i for i in ids if i is not None}))}
+
+    to_release = {}  # item index -> reservation
+    released_ids = set()
+    released_spots = set()
+    for i, (item, reservation_id) in enumerate(zip(items, ids)):
+        reservation = found.get(reservation_id)
+        if reservation is None:
+            results[i] = {'index': i, 'status': 'invalid', 'error': 'unknown reservation_id'}
+        elif 'user_id' in item and _as_int(item['user_id']) != reservation.user_id:
+            results[i] = {'index': i, 'status': 'invalid', 'error': 'reservation belongs to another user'}
+        elif reservation.leaving_timestamp is not None or reservation.id in released_ids:
+            results[i] = {'index': i, 'status': 'invalid', 'error': 'reservation already released'}
+        elif reservation.upcoming:
+            results[i] = {'index': i, 'status': 'invalid',
+                          'error': 'advance booking has not started - cancel it instead'}
+        elif reservation.spot_id in released_spots:
+            results[i] = {'index': i, 'status': 'invalid', 'error': 'spot released twice in this batch'}
+        else:
+            to_release[i] = reservation
+            released_ids.add(reservation.id)
+            released_spots.add(reservation.spot_id)
+
+    try:
+        # end the stays first, guarded like release_reservation - a stay someone else
+        # released since we loaded it is skipped, and so is its spot (it may be rebooked)
+        now = datetime.utcnow()
+        ended = _end_reservations([r.id for r in to_release.values()], now)
+        flipped = _set_spot_status([r.spot_id for r in to_release.values() if r.id in ended], 'O', 'A')
+        spot_lots = dict(db.session.query(ParkingSpot.id, ParkingSpot.lot_id)
+                         .filter(ParkingSpot.id.in_({r.spot_id for r in to_release.values()})))
+        prices = dict(db.session.query(ParkingLot.id, ParkingLot.price)
+                      .filter(ParkingLot.id.in_(set(spot_lots.values()))))
+        rules = billing.tariff()
+        released = []
+        costs = []
+        per_lot = Counter()
+        per_day = defaultdict(lambda: {'completed': 0, 'revenue': 0.0, 'occupied_minutes': 0.0})
+        for i, reservation in to_release.items():
+            if reservation.id not in ended:
+                results[i] = {'index': i, 'status': 'invalid', 'error': 'reservation already released'}
+                continue
+            lot_id = spot_lots.get(reservation.spot_id)
+            cost = rules.cost(reservation.parking_timestamp, now, prices.get(lot_id))
+            costs.append({'reservation_id': reservation.id, 'cost': cost})
+            set_committed_value(reservation, 'leaving_timestamp', now)
+            set_committed_value(reservation, 'parking_cost', cost)
+            released.append((i, lot_id, reservation))
+            if lot_id is None:
+                continue  # the lot has been deleted since, like release_reservation
+            if reservation.spot_id in flipped:
+                per_lot[lot_id] += 1
+            minutes = max((now - reservation.parking_timestamp).total_seconds() / 60, 0)
+            totals = per_day[(lot_id, reservation.parking_timestamp.date())]
+            totals['completed'] += 1
+            totals['revenue'] += cost or 0
+            totals['occupied_minutes'] += minutes
+        if costs:
+            table = Reservation.__table__
+            db.session.execute(table.update()
+                               .where(table.c.id == bindparam('reservation_id'))
+                               .values(parking_cost=bindparam('cost')), costs)
+        for lot_id, count in per_lot.items():
+            adjust_lot_counts(lot_id, available_delta=count, occupied_delta=-count)
+        for (lot_id, day), totals in per_day.items():
+            rollups.record_totals(lot_id, day, **totals)
+        versions.bump_users(reservation.user_id for _, _, reservation in released)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    changes = defaultdict(list)
+    for i, lot_id, reservation in released:
+        if reservation.spot_id in flipped:
+            availability.release(lot_id, reservation.spot_id)
+            changes[lot_id].append((reservation.spot_id, 'A'))
+        if lot_id is not None and reservation.end_time is not None:
+            windows.remove(lot_id, reservation.spot_id, reservation.start_time, reservation.end_time)
+        results[i] = {'index': i, 'status': 'released', 'reservation_id': reservation.id,
+                      'spot_id': reservation.spot_id, 'lot_id': lot_id}
+    for lot_id, spots in changes.items():
+        announce(lot_id, spots)
+    return results
@@ -0,0 +1,73 @@
+# Cached lot catalogue and homepage stats
+# Lot name/price/address/pin almost never change, so the list of lots is
+# cached as plain dicts for the places that only need the names (filters, the
+# search index). The lot pages read the details together with the live
+# counters and change version in one query instead, so another worker's edit
+# can't pair an old name with a new version. create_lot / edit_lot /
+# delete_lot call invalidate(), which also drops the lot search index built
+# from it (controllers/lotsearch.py).
+
+from controllers.cache import cache
+from controllers.lotsearch import lot_search
+from controllers.extensions import db
+from models.models import ParkingLot, User
+
+CATALOGUE_KEY = 'lots:catalogue'
+HOME_STATS_KEY = 'home:stats'
+
+
+def _load_catalogue():
+    lots = ParkingLot.query.order_by(ParkingLot.id).all()
+    return [{
+        'id': lot.id,
+        'prime_location_name': lot.prime_location_name,
+        'price': lot.price,
+        'address': lot.address,
+        'pin_code': lot.pin_code,
+        'maximum_number_of_spots': lot.maximum_number_of_spots,
+    } for lot in lots]
+
+
+def lot_catalogue():
+    # lot metadata only - no availability numbers
+    return cache.get_or_set(CATALOGUE_KEY, _load_catalogue)
+
+
+LIST_COLUMNS = (ParkingLot.id, ParkingLot.prime_location_name, ParkingLot.price, ParkingLot.address,
+                ParkingLot.pin_code, ParkingLot.maximum_number_of_spots, ParkingLot.available_count,
+                ParkingLot.occupied_count, ParkingLot.change_version)
+
+
+def list_entry(row):
+    return dict(zip(('id', 'prime_location_name', 'price', 'address', 'pin_code', 'maximum_number_of_spots',
+                     'available_count', 'occupied_count', 'change_version'), row))
+
+
+def lots_with_counts():
+    # lot details + the current counters and change version, read together in one narrow query
+    # (not from the cached catalogue: the version tags pages and fragments built from
+    # these fields, so they must come from the same row - see controllers/fragments.py)
+    return [list_entry(row) for row in db.session.query(*LIST_COLUMNS).order_by(ParkingLot.id)]
+
+
+def _load_home_stats():
+    total_spots = db.session.query(
+        db.func.coalesce(db.func.sum(ParkingLot.available_count + ParkingLot.occupied_count), 0)).scalar()
+    return {
+        'total_lots': ParkingLot.query.count(),
+        'total_spots': int(total_spots),
+        'total_users': User.query.filter_by(role='user').count(),
+    }
+
+
+def home_stats():
+    return cache.get_or_set(HOME_STATS_KEY, _load_home_stats)
+
+
+def invalidate():
+    cache.invalidate(CATALOGUE_KEY, HOME_STATS_KEY)
+    lot_search.invalidate()
+
+
+def invalidate_home_stats():
+    cache.invalidate(HOME_STATS_KEY)
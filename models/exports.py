@@ -0,0 +1,129 @@
+# Reservation export as CSV or NDJSON
+# Everything here is a generator: rows come out of the database batch_size at
+# a time (yield_per, so SQLAlchemy never buffers the whole result) and are
+# turned into text one batch at a time, so an export of any size uses about
+# the same memory. Archived stays (models/archive.py) come first, then the
+# reservation table, both oldest first.
+# The same pipeline feeds the streamed download and the background export
+# jobs (controllers/jobs.py).
+
+import csv
+import io
+import json
+from datetime import datetime
+from sqlalchemy import func, select
+from controllers.extensions import db
+from models import archive
+from models.models import ParkingLot, ParkingSpot, Reservation, User
+
+FORMATS = ('csv', 'ndjson')
+MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+COLUMNS = ('id', 'username', 'lot_id', 'lot_name', 'spot_id', 'parking_timestamp', 'leaving_timestamp',
+           'parking_cost', 'start_time', 'end_time', 'archived')
+
+
+def _ts(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)  # archive files store text
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _filtered(query, start, end, lot_id):
+    if start is not None:
+        query = query.where(Reservation.parking_timestamp >= start)
+    if end is not None:
+        query = query.where(Reservation.parking_timestamp < end)
+    if lot_id is not None:
+        query = query.where(ParkingSpot.lot_id == lot_id)
+    return query
+
+
+def _archived_batches(start, end, lot_id, batch_size):
+    # archive rows only carry ids, so look the names up once per batch
+    for rows in archive.iter_reservations(start, end, lot_id, batch_size):
+        user_ids = {row['user_id'] for row in rows}
+        lot_ids = {row['lot_id'] for row in rows if row['lot_id'] is not None}
+        users = dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids)))
+        lots = dict(db.session.query(ParkingLot.id, ParkingLot.prime_location_name)
+                    .filter(ParkingLot.id.in_(lot_ids))) if lot_ids else {}
+        yield [{
+            'id': row['id'],
+            'username': users.get(row['user_id']),
+            'lot_id': row['lot_id'],
+            'lot_name': lots.get(row['lot_id']),
+            'spot_id': row['spot_id'],
+            'parking_timestamp': _ts(row['parking_timestamp']),
+            'leaving_timestamp': _ts(row['leaving_timestamp']),
+            'parking_cost': row['parking_cost'],
+            'start_time': _ts(row['start_time']),
+            'end_time': _ts(row['end_time']),
+            'archived': True,
+        } for row in rows]
+
+
+def _live_batches(start, end, lot_id, batch_size):
+    query = _filtered(
+        select(Reservation.id, User.username, ParkingSpot.lot_id, ParkingLot.prime_location_name,
+               Reservation.spot_id, Reservation.parking_timestamp, Reservation.leaving_timestamp,
+               Reservation.parking_cost, Reservation.start_time, Reservation.end_time)
+        .outerjoin(User, Reservation.user_id == User.id)
+        .outerjoin(ParkingSpot, Reservation.spot_id == ParkingSpot.id)
+        .outerjoin(ParkingLot, ParkingSpot.lot_id == ParkingLot.id),
+        start, end, lot_id).order_by(Reservation.id)
+    result = db.session.execute(query.execution_options(yield_per=batch_size))
+    try:
+        for rows in result.partitions():
+            yield [{
+                'id': rid,
+                'username': username,
+                'lot_id': row_lot_id,
+                'lot_name': lot_name,
+                'spot_id': spot_id,
+                'parking_timestamp': _ts(parked),
+                'leaving_timestamp': _ts(left),
+                'parking_cost': cost,
+                'start_time': _ts(window_start),
+                'end_time': _ts(window_end),
+                'archived': False,
+            } for (rid, username, row_lot_id, lot_name, spot_id, parked, left, cost,
+                   window_start, window_end) in rows]
+    finally:
+        result.close()
+
+
+def batches(start=None, end=None, lot_id=None, batch_size=5000):
+    # lists of row dicts, archived rows first
+    yield from _archived_batches(start, end, lot_id, batch_size)
+    yield from _live_batches(start, end, lot_id, batch_size)
+
+
+def count(start=None, end=None, lot_id=None):
+    # how many rows an export will have, for progress reporting
+    query = _filtered(select(func.count(Reservation.id))
+                      .select_from(Reservation)
+                      .outerjoin(ParkingSpot, Reservation.spot_id == ParkingSpot.id), start, end, lot_id)
+    return db.session.execute(query).scalar() + archive.count_reservations(start, end, lot_id)
+
+
+def encode(fmt, row_batches, progress=None):
+    # text chunks, one per batch; progress(rows so far) is called after each
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=COLUMNS)
+        writer.writeheader()
+        yield buffer.getvalue()
+    done = 0
+    for rows in row_batches:
+        if fmt == 'csv':
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(rows)
+            yield buffer.getvalue()
+        else:
+            yield ''.join(json.dumps(row) + '\n' for row in rows)
+        done += len(rows)
+        if progress:
+            progress(done)
@@ -0,0 +1,132 @@
+# Tiny schema migration runner
+# db.create_all() only creates missing tables, it never changes a table that
+# already exists, so columns and indexes added later need a migration to reach
+# old parking.db files. Each migration runs once, in order, and is recorded in
+# the schema_migrations table. They are written to be safe on a fresh database
+# too, because create_app runs create_all() first and then upgrade().
+
+from datetime import datetime
+from sqlalchemy import DateTime, Float, column, inspect, table, text
+from controllers.extensions import db
+
+
+def _columns(table):
+    return {col['name'] for col in inspect(db.session.connection()).get_columns(table)}
+
+
+def add_column(table, name, ddl):
+    # ALTER TABLE ... ADD COLUMN, skipped if the column is already there
+    if name in _columns(table):
+        return False
+    db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}'))
+    return True
+
+
+def create_indexes(model, *names):
+    # creates the named Indexes from the model's __table_args__ if they don't exist yet
+    # always list them by name - a migration must not pick up indexes added (on
+    # columns added) by later ones
+    connection = db.session.connection()
+    declared = {index.name: index for index in model.__table__.indexes}
+    for name in names:
+        declared[name].create(connection, checkfirst=True)
+
+
+def _0001_lot_counters():
+    # plain SQL on purpose: the ORM model has columns later migrations add
+    added = add_column('parking_lot', 'available_count', 'INTEGER NOT NULL DEFAULT 0')
+    added = add_column('parking_lot', 'occupied_count', 'INTEGER NOT NULL DEFAULT 0') or added
+    if added:
+        db.session.execute(text(
+            "UPDATE parking_lot SET"
+            " available_count = (SELECT count(*) FROM parking_spot"
+            "                    WHERE parking_spot.lot_id = parking_lot.id AND parking_spot.status = 'A'),"
+            " occupied_count = (SELECT count(*) FROM parking_spot"
+            "                   WHERE parking_spot.lot_id = parking_lot.id AND parking_spot.status = 'O')"))
+
+
+def _0002_rollups():
+    # the table itself comes from create_all, this fills it for old databases
+    # (rebuild() needs the window columns - without them 0006 fills it instead)
+    from models import rollups
+    if 'checked_in_at' in _columns('reservation'):
+        rollups.rebuild()
+
+
+def _0003_indexes():
+    from models.models import ParkingSpot, Reservation
+    create_indexes(ParkingSpot, 'ix_parking_spot_lot_status')
+    create_indexes(Reservation, 'ix_reservation_user_parked', 'ix_reservation_spot',
+                   'ix_reservation_parked', 'ix_reservation_active')
+
+
+def _0004_change_versions():
+    add_column('parking_lot', 'change_version', 'INTEGER NOT NULL DEFAULT 0')
+    add_column('user', 'reservations_version', 'INTEGER NOT NULL DEFAULT 0')
+
+
+def _0005_booking_windows():
+    from models.models import Reservation
+    add_column('reservation', 'start_time', 'DATETIME')
+    add_column('reservation', 'end_time', 'DATETIME')
+    create_indexes(Reservation, 'ix_reservation_spot_window')
+
+
+def _0006_window_check_in():
+    # advance bookings used to be stored as finished, prepaid stays - the ones that
+    # haven't started yet go back to being upcoming (no leaving time, no cost yet)
+    from models import rollups
+    if not add_column('reservation', 'checked_in_at', 'DATETIME'):
+        return
+    reservation = table('reservation', column('start_time', DateTime), column('leaving_timestamp', DateTime),
+                        column('parking_cost', Float))
+    db.session.execute(reservation.update()
+                       .where(reservation.c.start_time > datetime.utcnow())
+                       .values(leaving_timestamp=None, parking_cost=None))
+    rollups.rebuild()  # drops the not-yet-started windows from the totals
+
+
+MIGRATIONS = [
+    (1, 'occupancy counters on parking_lot', _0001_lot_counters),
+    (2, 'backfill lot_daily_rollup', _0002_rollups),
+    (3, 'indexes for spot and reservation lookups', _0003_indexes),
+    (4, 'change versions on parking_lot and user', _0004_change_versions),
+    (5, 'booking windows on reservation', _0005_booking_windows),
+    (6, 'check-in time for advance bookings', _0006_window_check_in),
+]
+
+
+def _ensure_table():
+    db.session.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+        'version INTEGER PRIMARY KEY, description VARCHAR(255), applied_at VARCHAR(32))'))
+    db.session.commit()
+
+
+def applied_versions():
+    _ensure_table()
+    return {row[0] for row in db.session.execute(text('SELECT version FROM schema_migrations'))}
+
+
+def pending():
+    done = applied_versions()
+    return [m for m in MIGRATIONS if m[0] not in done]
+
+
+def upgrade(echo=None):
+    # applies every pending migration, each in its own transaction
+    applied = []
+    for version, description, migrate in pending():
+        if echo:
+            echo(f'applying {version:04d} {description}')
+        try:
+            migrate()
+            db.session.execute(
+                text('INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :t)'),
+                {'v': version, 'd': description, 't': datetime.utcnow().isoformat(timespec='seconds')})
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        applied.append(version)
+    return applied
@@ -13,6 +13,8 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(150), unique=True, nullable=False)
     password = db.Column(db.String(150), nullable=False)
     role = db.Column(db.String(10), nullable=False, default='user')  # admin or user
+    # bumped whenever one of the user's reservations is added or changes (models/versions.py)
+    reservations_version = db.Column(db.Integer, nullable=False, default=0)
     reservations = db.relationship('Reservation', backref='user', lazy=True)
     
     # TODO: add email field later - maybe for password reset functionality
@@ -21,6 +23,7 @@ class User(UserMixin, db.Model):
         self.username = username
         self.password = password
         self.role = role  # can be 'admin' or 'user'
+        self.reservations_version = 0
         # could add more fields later like email, phone, etc.
 
 class ParkingLot(db.Model):
@@ -30,6 +33,11 @@ class ParkingLot(db.Model):
     address = db.Column(db.String(255), nullable=False)
     pin_code = db.Column(db.String(10), nullable=False)  # for security - might change this later
     maximum_number_of_spots = db.Column(db.Integer, nullable=False)
+    # live counters so list pages don't have to load every spot - kept in step by models/occupancy.py
+    available_count = db.Column(db.Integer, nullable=False, default=0)
+    occupied_count = db.Column(db.Integer, nullable=False, default=0)
+    # goes up on every booking, release or edit, used for ETags (models/versions.py)
+    change_version = db.Column(db.Integer, nullable=False, default=0)
     spots = db.relationship('ParkingSpot', backref='lot', lazy=True, cascade='all, delete-orphan')
 
     def __init__(self, prime_location_name, price, address, pin_code, maximum_number_of_spots):
@@ -38,12 +46,19 @@ class ParkingLot(db.Model):
         self.address = address
         self.pin_code = pin_code
         self.maximum_number_of_spots = maximum_number_of_spots
+        self.available_count = 0  # bumped as spots get created
+        self.occupied_count = 0
+        self.change_version = 0
         # might add more fields like description, image_url later
 
 class ParkingSpot(db.Model):
+    __table_args__ = (
+        # "free spots in lot X" is the booking hot path
+        db.Index('ix_parking_spot_lot_status', 'lot_id', 'status'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     lot_id = db.Column(db.Integer, db.ForeignKey('parking_lot.id'), nullable=False)
-    status = db.Column(db.String(1), nullable=False, default='A')  # A=Available, O=Occupied
+    status = db.Column(db.String(1), nullable=False, default='A')  # A=Available, O=Occupied, R=Retired
     reservations = db.relationship('Reservation', backref='spot', lazy=True)
 
     def __init__(self, lot_id, status='A'):
@@ -52,17 +67,67 @@ class ParkingSpot(db.Model):
         # A = Available, O = Occupied - could use enum later
 
 class Reservation(db.Model):
+    __table_args__ = (
+        db.Index('ix_reservation_user_parked', 'user_id', 'parking_timestamp'),  # a user's history, newest first
+        db.Index('ix_reservation_spot', 'spot_id'),
+        db.Index('ix_reservation_parked', 'parking_timestamp'),  # recent activity + today's numbers
+        # only the few open stays end up in this one
+        db.Index('ix_reservation_active', 'spot_id',
+                 sqlite_where=db.text('leaving_timestamp IS NULL'),
+                 postgresql_where=db.text('leaving_timestamp IS NULL')),
+        # clash checks for advance bookings, walk-ins leave start/end empty
+        db.Index('ix_reservation_spot_window', 'spot_id', 'end_time',
+                 sqlite_where=db.text('end_time IS NOT NULL'),
+                 postgresql_where=db.text('end_time IS NOT NULL')),
+    )
     id = db.Column(db.Integer, primary_key=True)
     spot_id = db.Column(db.Integer, db.ForeignKey('parking_spot.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     parking_timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     leaving_timestamp = db.Column(db.DateTime, nullable=True)  # null until user leaves
     parking_cost = db.Column(db.Float, nullable=True)  # calculated when leaving
+    # booked window for advance bookings (see models/booking.book_window), empty for walk-ins
+    start_time = db.Column(db.DateTime, nullable=True)
+    end_time = db.Column(db.DateTime, nullable=True)
+    # when an advance booking turned into a stay, null until then (and for walk-ins)
+    checked_in_at = db.Column(db.DateTime, nullable=True)
 
-    def __init__(self, spot_id, user_id, parking_timestamp=None, leaving_timestamp=None, parking_cost=None):
+    def __init__(self, spot_id, user_id, parking_timestamp=None, leaving_timestamp=None, parking_cost=None,
+                 start_time=None, end_time=None):
         self.spot_id = spot_id
         self.user_id = user_id
         self.parking_timestamp = parking_timestamp or datetime.utcnow()
         self.leaving_timestamp = leaving_timestamp
         self.parking_cost = parking_cost
-        # parking_cost is calculated when user leaves the spot 
\ No newline at end of file
+        self.start_time = start_time
+        self.end_time = end_time
+        # parking_cost is calculated when user leaves the spot 
+
+    @property
+    def upcoming(self):
+        # an advance booking that hasn't started yet - not a stay, not counted anywhere
+        return self.start_time is not None and self.checked_in_at is None and self.leaving_timestamp is None
+
+    @classmethod
+    def upcoming_clause(cls):
+        # the same test as a SQL condition
+        return db.and_(cls.start_time.isnot(None), cls.checked_in_at.is_(None), cls.leaving_timestamp.is_(None))
+
+class LotDailyRollup(db.Model):
+    # one row per lot per day with running totals, so dashboards don't have to
+    # scan every reservation ever made - see models/rollups.py
+    __tablename__ = 'lot_daily_rollup'
+    lot_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)  # the day the booking was made (UTC)
+    bookings = db.Column(db.Integer, nullable=False, default=0)
+    completed = db.Column(db.Integer, nullable=False, default=0)  # stays that have been released
+    revenue = db.Column(db.Float, nullable=False, default=0)  # from completed stays only
+    occupied_minutes = db.Column(db.Float, nullable=False, default=0)
+
+    def __init__(self, lot_id, day, bookings=0, completed=0, revenue=0, occupied_minutes=0):
+        self.lot_id = lot_id
+        self.day = day
+        self.bookings = bookings
+        self.completed = completed
+        self.revenue = revenue
+        self.occupied_minutes = occupied_minutes
@@ -0,0 +1,95 @@
+# Spot status changes and the per-lot occupancy counters
+# Every place that flips a spot between 'A' and 'O' should go through here
+# so ParkingLot.available_count / occupied_count stay in the same transaction
+# as the status change. Callers still do the db.session.commit() themselves.
+
+from sqlalchemy import case, func
+from controllers.events import hub
+from controllers.extensions import db
+from models.models import ParkingLot, ParkingSpot
+
+
+def adjust_lot_counts(lot_id, available_delta=0, occupied_delta=0):
+    # done as "col = col + n" in SQL so two requests can't overwrite each other's count
+    # any change in the counters is a change to the lot, so its version goes up in the same UPDATE
+    if not available_delta and not occupied_delta:
+        return
+    db.session.query(ParkingLot).filter(ParkingLot.id == lot_id).update({
+        ParkingLot.available_count: ParkingLot.available_count + available_delta,
+        ParkingLot.occupied_count: ParkingLot.occupied_count + occupied_delta,
+        ParkingLot.change_version: ParkingLot.change_version + 1,
+    }, synchronize_session=False)
+
+
+def _compare_and_set(spot_id, expected, new_status):
+    # UPDATE parking_spot SET status=new WHERE id=? AND status=expected
+    # only one of any number of concurrent callers can win, no matter how many workers there are
+    table = ParkingSpot.__table__
+    result = db.session.execute(
+        table.update()
+        .where(table.c.id == spot_id, table.c.status == expected)
+        .values(status=new_status))
+    return result.rowcount == 1
+
+
+def occupy_spot(spot_id, lot_id):
+    # True if we got the spot, False if it wasn't free anymore
+    if not _compare_and_set(spot_id, 'A', 'O'):
+        return False
+    adjust_lot_counts(lot_id, -1, 1)
+    return True
+
+
+def vacate_spot(spot_id, lot_id):
+    if not _compare_and_set(spot_id, 'O', 'A'):
+        return False
+    adjust_lot_counts(lot_id, 1, -1)
+    return True
+
+
+def lot_counts(lot_id):
+    # (available, occupied) from the counters, or None if the lot is gone
+    row = (db.session.query(ParkingLot.available_count, ParkingLot.occupied_count)
+           .filter(ParkingLot.id == lot_id)
+           .first())
+    return tuple(row) if row else None
+
+
+def announce(lot_id, changes=(), kind='delta'):
+    # tell live watchers of the lot (controllers/events.py) what changed - call after commit
+    # changes is a list of (spot_id, new_status). Costs nothing if nobody is watching.
+    if not hub.has_subscribers(lot_id):
+        return
+    event = {'type': kind, 'lot_id': lot_id,
+             'spots': [{'id': spot_id, 'status': status} for spot_id, status in changes]}
+    counts = lot_counts(lot_id) if kind != 'closed' else None
+    if counts:
+        event['available'], event['occupied'] = counts
+    hub.publish(lot_id, event)
+
+
+def count_spots_by_lot():
+    # the "real" numbers straight from the spot table: {lot_id: (available, occupied)}
+    rows = db.session.query(
+        ParkingSpot.lot_id,
+        func.sum(case((ParkingSpot.status == 'A', 1), else_=0)),
+        func.sum(case((ParkingSpot.status == 'O', 1), else_=0)),
+    ).group_by(ParkingSpot.lot_id).all()
+    return {lot_id: (available or 0, occupied or 0) for lot_id, available, occupied in rows}
+
+
+def repair_lot_counts(dry_run=False):
+    # compare the counters with the spot table and fix any that drifted
+    # returns a list of (lot_id, old_counts, real_counts) for the lots that were wrong
+    actual = count_spots_by_lot()
+    mismatched = []
+    for lot in ParkingLot.query.all():
+        real = actual.get(lot.id, (0, 0))
+        stored = (lot.available_count, lot.occupied_count)
+        if stored != real:
+            mismatched.append((lot.id, stored, real))
+            if not dry_run:
+                lot.available_count, lot.occupied_count = real
+    if mismatched and not dry_run:
+        db.session.commit()
+    return mismatched
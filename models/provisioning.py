@@ -0,0 +1,70 @@
+# Creating and resizing the spots of a lot in bulk
+# Adding spots one ORM object at a time is really slow for big garages, so
+# these go straight to executemany / single UPDATE statements.
+# Spots that are taken out of service get status 'R' (retired) instead of
+# being deleted so old reservations still point at a real spot.
+
+from datetime import datetime
+from sqlalchemy import insert, select
+from controllers.extensions import db
+from models.models import ParkingSpot, Reservation
+from models.occupancy import adjust_lot_counts
+
+RETIRED = 'R'
+
+
+def provision_spots(lot_id, count):
+    # one executemany for all the new spots
+    if count <= 0:
+        return 0
+    db.session.execute(insert(ParkingSpot.__table__), [{'lot_id': lot_id, 'status': 'A'}] * count)
+    adjust_lot_counts(lot_id, available_delta=count)
+    return count
+
+
+def _set_status(lot_id, from_status, to_status, limit, newest_first, keep_booked=False):
+    # flips up to `limit` spots in one UPDATE ... WHERE id IN (SELECT ... LIMIT n)
+    # keep_booked leaves spots with an upcoming advance booking alone
+    order = ParkingSpot.id.desc() if newest_first else ParkingSpot.id
+    ids = (select(ParkingSpot.id)
+           .where(ParkingSpot.lot_id == lot_id, ParkingSpot.status == from_status)
+           .order_by(order)
+           .limit(limit))
+    if keep_booked:
+        ids = ids.where(~select(Reservation.id)
+                        .where(Reservation.spot_id == ParkingSpot.id,
+                               Reservation.end_time > datetime.utcnow(),
+                               Reservation.leaving_timestamp.is_(None))
+                        .exists())
+    result = db.session.execute(
+        ParkingSpot.__table__.update()
+        .where(ParkingSpot.id.in_(ids), ParkingSpot.status == from_status)
+        .values(status=to_status))
+    return result.rowcount
+
+
+def resize_lot(lot, new_capacity):
+    # grow or shrink a lot to new_capacity active spots without touching occupied ones
+    # raises ValueError if there aren't enough free spots to retire - the caller
+    # should roll back then. Otherwise the caller commits and refreshes the availability index
+    if new_capacity < 0:
+        raise ValueError('Capacity cannot be negative.')
+    current = lot.available_count + lot.occupied_count
+    change = new_capacity - current
+    if change > 0:
+        # bring retired spots back first so spot ids stay stable, then add new ones
+        revived = _set_status(lot.id, RETIRED, 'A', change, newest_first=False)
+        if revived:
+            adjust_lot_counts(lot.id, available_delta=revived)
+        provision_spots(lot.id, change - revived)
+    elif change < 0:
+        to_retire = -change
+        if to_retire > lot.available_count:
+            raise ValueError(f'Only {lot.available_count} spots are free, cannot remove {to_retire}.')
+        retired = _set_status(lot.id, 'A', RETIRED, to_retire, newest_first=True, keep_booked=True)
+        if retired != to_retire:
+            # someone booked one of them in the meantime, or they're booked in advance
+            raise ValueError('Not enough free spots without upcoming bookings, please try again later.')
+        adjust_lot_counts(lot.id, available_delta=-retired)
+    lot.maximum_number_of_spots = new_capacity
+    return change
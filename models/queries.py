@@ -0,0 +1,146 @@
+# Named queries used by the routes and the api
+# Each loader eager-loads exactly the relationships its page touches so
+# templates can walk reservation.spot.lot / reservation.user without firing
+# one lazy load per row (the classic N+1 problem).
+
+import base64
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import and_, event, or_
+from sqlalchemy.orm import joinedload
+from controllers.extensions import db
+from models.models import ParkingSpot, Reservation
+
+
+def lot_spots(lot_id):
+    # retired spots ('R') are left out, they only exist for old reservations
+    return (ParkingSpot.query
+            .filter(ParkingSpot.lot_id == lot_id, ParkingSpot.status != 'R')
+            .order_by(ParkingSpot.id)
+            .all())
+
+
+def lot_has_occupied_spots(lot_id):
+    # EXISTS query instead of loading every spot of the lot
+    return db.session.query(ParkingSpot.query
+                            .filter_by(lot_id=lot_id, status='O')
+                            .exists()).scalar()
+
+
+def lot_has_upcoming_bookings(lot_id):
+    # advance bookings that haven't ended yet
+    return db.session.query(Reservation.query
+                            .join(ParkingSpot, Reservation.spot_id == ParkingSpot.id)
+                            .filter(ParkingSpot.lot_id == lot_id,
+                                    Reservation.end_time > datetime.utcnow(),
+                                    Reservation.leaving_timestamp.is_(None))
+                            .exists()).scalar()
+
+
+def recent_reservations(limit):
+    # newest bookings with who booked and where, for the admin activity feed
+    return (Reservation.query
+            .options(joinedload(Reservation.user),
+                     joinedload(Reservation.spot).joinedload(ParkingSpot.lot))
+            .order_by(Reservation.parking_timestamp.desc())
+            .limit(limit)
+            .all())
+
+
+def user_reservations(user_id, limit=None):
+    # a user's bookings newest first, with spot and lot loaded in the same query
+    query = (Reservation.query
+             .options(joinedload(Reservation.spot).joinedload(ParkingSpot.lot))
+             .filter(Reservation.user_id == user_id)
+             .order_by(Reservation.parking_timestamp.desc()))
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def encode_cursor(reservation):
+    # opaque "where the last page stopped" token: parking_timestamp + id
+    raw = f'{reservation.parking_timestamp.isoformat()}|{reservation.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    # raises ValueError for anything that isn't a cursor we made
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, reservation_id = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(reservation_id)
+    except (TypeError, UnicodeDecodeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def reservation_page(user_id, limit, cursor=None, start=None, end=None, lot_id=None, active_only=False):
+    # one page of a user's bookings, newest first, using keyset pagination on
+    # (parking_timestamp, id) so page 500 costs the same as page 1
+    # returns (reservations, next_cursor) - next_cursor is None on the last page
+    query = (Reservation.query
+             .options(joinedload(Reservation.spot).joinedload(ParkingSpot.lot))
+             .filter(Reservation.user_id == user_id))
+    if start is not None:
+        query = query.filter(Reservation.parking_timestamp >= start)
+    if end is not None:
+        query = query.filter(Reservation.parking_timestamp < end)
+    if lot_id is not None:
+        query = query.filter(Reservation.spot.has(ParkingSpot.lot_id == lot_id))
+    if active_only:
+        query = query.filter(Reservation.leaving_timestamp.is_(None), ~Reservation.upcoming_clause())
+    if cursor:
+        after_timestamp, after_id = decode_cursor(cursor)
+        query = query.filter(or_(
+            Reservation.parking_timestamp < after_timestamp,
+            and_(Reservation.parking_timestamp == after_timestamp, Reservation.id < after_id)))
+    rows = (query.order_by(Reservation.parking_timestamp.desc(), Reservation.id.desc())
+            .limit(limit + 1)  # one extra row tells us if there's another page
+            .all())
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def lot_reservations(lot_id, start=None, end=None):
+    # every booking made in a lot (booked in [start, end) if given), with the user who made it
+    query = (Reservation.query
+             .join(ParkingSpot, Reservation.spot_id == ParkingSpot.id)
+             .options(joinedload(Reservation.user))
+             .filter(ParkingSpot.lot_id == lot_id))
+    if start is not None:
+        query = query.filter(Reservation.parking_timestamp >= start)
+    if end is not None:
+        query = query.filter(Reservation.parking_timestamp < end)
+    return query.order_by(Reservation.id).all()
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_queries():
+    # counts every SQL statement sent to the engine inside the with block
+    counter = QueryCounter()
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter)
+
+
+@contextmanager
+def assert_max_queries(budget, label='block'):
+    # use in tests/benchmarks: fails if the code inside runs more than `budget` queries
+    with count_queries() as counter:
+        yield counter
+    if counter.count > budget:
+        statements = '\n'.join(counter.statements)
+        raise AssertionError(f'{label} ran {counter.count} queries (budget {budget}):\n{statements}')
@@ -0,0 +1,47 @@
+# EXPLAIN QUERY PLAN helpers (SQLite only)
+# Used by `flask check-query-plans` to catch queries that scan a whole hot
+# table instead of using one of the indexes declared in models/models.py.
+
+import re
+from contextlib import contextmanager
+from sqlalchemy import event
+from controllers.extensions import db
+
+# tables that grow with traffic - a full scan of these is always a problem
+HOT_TABLES = ('parking_spot', 'reservation')
+
+_scan_re = re.compile(r'^SCAN (\w+)(?: AS \w+)?$')
+
+
+@contextmanager
+def capture_statements():
+    # records (statement, parameters) for every query run inside the block
+    captured = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and not executemany:
+            captured.append((statement, parameters))
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        yield captured
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+
+
+def explain(statement, parameters):
+    # returns the plan detail lines for one statement
+    connection = db.session.connection()
+    rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    return [row[-1] for row in rows]
+
+
+def full_scans(plan):
+    # tables the plan reads top to bottom without an index
+    tables = []
+    for detail in plan:
+        match = _scan_re.match(detail.strip())
+        if match:
+            tables.append(match.group(1))
+    return tables
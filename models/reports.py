@@ -0,0 +1,38 @@
+# Admin reports that span the hot reservation table and the archive
+# Recent stays come from the reservation table, older ones from the monthly
+# archive files (models/archive.py). The archive is only opened for months
+# the requested dates actually reach, so reports on recent days never touch it.
+
+from controllers.extensions import db
+from models import aggregates, archive, queries
+from models.models import User
+
+
+def daily_totals(start=None, end=None, lot_id=None):
+    # [(day 'YYYY-MM-DD', totals)] ordered by day, same shape as aggregates.totals_by_day
+    days = dict(aggregates.totals_by_day(start, end, lot_id))
+    for day, (bookings, revenue, _) in archive.totals_by_day(start, end, lot_id).items():
+        totals = days.setdefault(day, {'bookings': 0, 'active': 0, 'completed': 0, 'revenue': 0.0})
+        totals['bookings'] += bookings
+        totals['completed'] += bookings
+        totals['revenue'] += revenue
+    return sorted(days.items())
+
+
+def lot_bookings(lot_id, start=None, end=None):
+    # every booking of a lot in [start, end) as dicts with the username, oldest first
+    bookings = [{'username': r.user.username if r.user else 'Unknown',
+                 'parking_timestamp': r.parking_timestamp,
+                 'leaving_timestamp': r.leaving_timestamp,
+                 'upcoming': r.upcoming}
+                for r in queries.lot_reservations(lot_id, start, end)]
+    archived = archive.lot_reservations(lot_id, start, end)
+    if archived:
+        user_ids = {row['user_id'] for row in archived}
+        names = dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids)))
+        bookings = [{'username': names.get(row['user_id'], 'Unknown'),
+                     'parking_timestamp': row['parking_timestamp'],
+                     'leaving_timestamp': row['leaving_timestamp'],
+                     'upcoming': False}
+                    for row in archived] + bookings  # archived rows are all older
+    return bookings
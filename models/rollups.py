@@ -0,0 +1,156 @@
+# Daily per-lot rollups (LotDailyRollup)
+# Booking and release bump the row for (lot, booking day) as they happen, and
+# `flask compact-rollups` rebuilds rows from the raw reservations if they ever
+# drift. Dashboards read old days from here and only scan today's raw rows.
+
+from datetime import date, datetime, timedelta
+from sqlalchemy import case, func, insert, select
+from controllers.extensions import db
+from models.models import LotDailyRollup, ParkingLot, ParkingSpot, Reservation
+from models import aggregates
+
+
+def today_start():
+    # rollups are keyed on UTC days since all timestamps are utcnow()
+    now = datetime.utcnow()
+    return datetime(now.year, now.month, now.day)
+
+
+def _upsert(lot_id, day, **deltas):
+    # add the deltas to the (lot, day) row, creating it if needed
+    table = LotDailyRollup.__table__
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(table).values(lot_id=lot_id, day=day, **deltas)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.lot_id, table.c.day],
+            set_={name: table.c[name] + stmt.excluded[name] for name in deltas})
+        db.session.execute(stmt)
+        return
+    # other databases: try the update first, insert if there was no row yet
+    result = db.session.execute(
+        table.update()
+        .where(table.c.lot_id == lot_id, table.c.day == day)
+        .values({name: table.c[name] + value for name, value in deltas.items()}))
+    if result.rowcount == 0:
+        db.session.execute(insert(table).values(lot_id=lot_id, day=day, **deltas))
+
+
+def record_totals(lot_id, day, **deltas):
+    # add already-summed deltas for one (lot, day), used by the batch api
+    _upsert(lot_id, day, **deltas)
+
+
+def record_booking(lot_id, reservation):
+    _upsert(lot_id, reservation.parking_timestamp.date(), bookings=1)
+
+
+def record_release(lot_id, reservation, cost):
+    # completed stays are counted against the day they were booked, same as the rebuild
+    minutes = (reservation.leaving_timestamp - reservation.parking_timestamp).total_seconds() / 60
+    _upsert(lot_id, reservation.parking_timestamp.date(),
+            completed=1, revenue=cost or 0, occupied_minutes=max(minutes, 0))
+
+
+def _minutes_between(start, end):
+    if db.session.get_bind().dialect.name == 'sqlite':
+        return (func.julianday(end) - func.julianday(start)) * 1440
+    return func.extract('epoch', end - start) / 60
+
+
+def rebuild(since=None):
+    # throw away the rollups from `since` (a date, or everything if None)
+    # and recompute them with one grouped INSERT ... SELECT
+    table = LotDailyRollup.__table__
+    day = func.date(Reservation.parking_timestamp)
+    done = Reservation.leaving_timestamp.isnot(None)
+    query = (select(
+                ParkingSpot.lot_id,
+                day,
+                func.count(Reservation.id),
+                func.coalesce(func.sum(case((done, 1), else_=0)), 0),
+                func.coalesce(func.sum(case((done, aggregates.revenue_expr), else_=0)), 0),
+                func.coalesce(func.sum(case(
+                    (done, _minutes_between(Reservation.parking_timestamp, Reservation.leaving_timestamp)),
+                    else_=0)), 0))
+             .select_from(Reservation)
+             .join(ParkingSpot, Reservation.spot_id == ParkingSpot.id)
+             .join(ParkingLot, ParkingSpot.lot_id == ParkingLot.id)
+             .where(~aggregates.upcoming_expr)  # counted once they're checked in
+             .group_by(ParkingSpot.lot_id, day))
+    delete = table.delete()
+    if since is not None:
+        start = datetime(since.year, since.month, since.day)
+        query = query.where(Reservation.parking_timestamp >= start)
+        delete = delete.where(table.c.day >= since)
+    db.session.execute(delete)
+    result = db.session.execute(insert(table).from_select(
+        ['lot_id', 'day', 'bookings', 'completed', 'revenue', 'occupied_minutes'], query))
+    written = result.rowcount
+    # stays that were moved to the archive still count (models/archive.py)
+    from models import archive
+    known_lots = {lot_id for (lot_id,) in db.session.query(ParkingLot.id)}
+    for (lot_id, day), (bookings, revenue, minutes) in archive.rollup_totals(since).items():
+        if lot_id in known_lots:
+            _upsert(lot_id, date.fromisoformat(day), bookings=bookings, completed=bookings,
+                    revenue=revenue, occupied_minutes=minutes)
+            written += 1
+    db.session.commit()
+    return written
+
+
+def delete_lot_rollups(lot_id):
+    db.session.query(LotDailyRollup).filter(LotDailyRollup.lot_id == lot_id).delete(synchronize_session=False)
+
+
+def _rollup_totals(lot_id=None, before=None):
+    query = db.session.query(
+        func.coalesce(func.sum(LotDailyRollup.bookings), 0),
+        func.coalesce(func.sum(LotDailyRollup.completed), 0),
+        func.coalesce(func.sum(LotDailyRollup.revenue), 0),
+        func.coalesce(func.sum(LotDailyRollup.occupied_minutes), 0))
+    if lot_id is not None:
+        query = query.filter(LotDailyRollup.lot_id == lot_id)
+    if before is not None:
+        query = query.filter(LotDailyRollup.day < before)
+    bookings, completed, revenue, minutes = query.one()
+    return {
+        'bookings': bookings,
+        'active': bookings - completed,
+        'completed': completed,
+        'revenue': float(revenue),
+        'occupied_minutes': float(minutes),
+    }
+
+
+def overall_totals():
+    # past days from the rollups + today's bookings from the raw table
+    start = today_start()
+    totals = _rollup_totals(before=start.date())
+    today = aggregates.overall_totals(since=start)
+    for key in ('bookings', 'active', 'completed', 'revenue'):
+        totals[key] += today[key]
+    return totals
+
+
+def lot_totals(lot_id, include_active=False):
+    # same as aggregates.lot_totals but only today's rows are read raw
+    start = today_start()
+    totals = _rollup_totals(lot_id=lot_id, before=start.date())
+    if include_active and totals['active']:
+        # open stays have no cost yet so they're valued at the lot's current price
+        lot = db.session.get(ParkingLot, lot_id)
+        totals['revenue'] += totals['active'] * (lot.price or 0)
+    today = aggregates.lot_totals(lot_id, include_active=include_active, since=start)
+    for key in ('bookings', 'active', 'completed', 'revenue'):
+        totals[key] += today[key]
+    return totals
+
+
+def backfill_window(days):
+    # convenience for the cli: rebuild just the last `days` days
+    return rebuild(since=(today_start() - timedelta(days=days)).date())
@@ -0,0 +1,54 @@
+# Change versions for conditional GETs
+# Every lot has a change_version that goes up whenever its spots, counters or
+# details change (adjust_lot_counts bumps it with the counters), and every
+# user has a reservations_version for their own reservation list. The api
+# turns these into ETags, so a client polling an unchanged lot gets a 304
+# after reading one integer instead of loading every spot again.
+
+import hashlib
+from controllers.extensions import db
+from models.models import ParkingLot, ParkingSpot, Reservation, User
+
+
+def bump_lot(lot_id):
+    # for changes that don't go through the counters (name, price, ...)
+    db.session.query(ParkingLot).filter(ParkingLot.id == lot_id).update(
+        {ParkingLot.change_version: ParkingLot.change_version + 1}, synchronize_session=False)
+
+
+def bump_users(user_ids):
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    db.session.query(User).filter(User.id.in_(user_ids)).update(
+        {User.reservations_version: User.reservations_version + 1}, synchronize_session=False)
+
+
+def bump_lot_users(lot_id):
+    # everyone who ever parked in the lot, e.g. before the lot is deleted
+    user_ids = (db.session.query(Reservation.user_id)
+                .join(ParkingSpot, Reservation.spot_id == ParkingSpot.id)
+                .filter(ParkingSpot.lot_id == lot_id)
+                .distinct())
+    bump_users(user_id for (user_id,) in user_ids)
+
+
+def lot_version(lot_id):
+    # None if the lot doesn't exist
+    return (db.session.query(ParkingLot.change_version)
+            .filter(ParkingLot.id == lot_id)
+            .scalar())
+
+
+def user_version(user_id):
+    return (db.session.query(User.reservations_version)
+            .filter(User.id == user_id)
+            .scalar())
+
+
+def all_lots_version():
+    # one tag for the whole lot list, changes when any lot is added, removed or changed
+    digest = hashlib.blake2b(digest_size=8)
+    for lot_id, version in db.session.query(ParkingLot.id, ParkingLot.change_version).order_by(ParkingLot.id):
+        digest.update(f'{lot_id}:{version};'.encode())
+    return digest.hexdigest()
@@ -0,0 +1,155 @@
+# Advance bookings from booking to release
+# A window booked for later is "upcoming" until it is checked in: the spot
+# stays free, no total or rollup counts it, release is refused and it can be
+# cancelled. Walk-ins must not take a spot held by a window even when this
+# process's window index hasn't heard of it yet.
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import create_app
+from controllers.availability import availability
+from controllers.config import get_config
+from controllers.extensions import db
+from controllers.windows import windows
+from models import aggregates, booking, rollups
+from models.models import LotDailyRollup, ParkingLot, ParkingSpot, Reservation
+
+USER_ID = 2
+
+
+@pytest.fixture(scope='module')
+def app():
+    app = create_app(get_config('testing'))
+    admin = app.test_client()
+    admin.post('/login', data={'username': 'admin', 'password': 'admin'})
+    admin.post('/admin/lots/create', data={
+        'prime_location_name': 'Lot A', 'price': '10', 'address': '1 Main St',
+        'pin_code': '560001', 'maximum_number_of_spots': '3'})
+    user = app.test_client()
+    user.post('/register', data={'username': 'alice', 'password': 'pw'})
+    with app.app_context():
+        # the indexes are per process, other test modules may have filled them from their own database
+        windows.drop(1)
+        availability.refresh_lot(1)
+    return app
+
+
+def _window(start_in, length):
+    start = datetime.utcnow() + start_in
+    return start, start + length
+
+
+def _book(client, spot_id, start, end):
+    return client.post('/reserve', json={'user_id': USER_ID, 'spot_id': spot_id,
+                                         'start_time': start.isoformat(), 'end_time': end.isoformat()})
+
+
+def _spot_status(spot_id):
+    return db.session.query(ParkingSpot.status).filter(ParkingSpot.id == spot_id).scalar()
+
+
+def _rollup_bookings():
+    return db.session.query(db.func.coalesce(db.func.sum(LotDailyRollup.bookings), 0)).scalar()
+
+
+def test_future_window_end_to_end(app):
+    client = app.test_client()
+    start, end = _window(timedelta(days=1), timedelta(hours=2))
+    response = _book(client, 1, start, end)
+    assert response.status_code == 200
+    assert response.get_json()['estimated_cost'] == 20.0
+    reservation_id = response.get_json()['reservation_id']
+
+    with app.app_context():
+        listed = client.get(f'/user/{USER_ID}/reservations').get_json()['reservations']
+        assert [r['status'] for r in listed] == ['upcoming']
+        # not a stay yet: the spot is free, nothing is counted
+        assert _spot_status(1) == 'A'
+        assert db.session.get(ParkingLot, 1).available_count == 3
+        assert aggregates.user_totals(USER_ID)['bookings'] == 0
+        assert rollups.overall_totals()['bookings'] == 0
+        assert _rollup_bookings() == 0
+
+    # it can't be released, or checked in a day early
+    response = client.post('/api/releases:batch', json={'releases': [{'reservation_id': reservation_id}]})
+    assert response.get_json()['results'][0]['status'] == 'invalid'
+    assert client.post(f'/reservations/{reservation_id}/check-in').status_code == 400
+
+    # someone else can't cancel it, the owner can - once
+    assert client.post(f'/reservations/{reservation_id}/cancel', json={'user_id': 1}).status_code == 403
+    assert client.post(f'/reservations/{reservation_id}/cancel', json={'user_id': USER_ID}).status_code == 200
+    assert client.post(f'/reservations/{reservation_id}/cancel').status_code == 404
+    with app.app_context():
+        assert db.session.get(Reservation, reservation_id) is None
+        assert not windows.conflicts(1, 1, start, end)
+
+    # book it again and let the cron job run it: check-in at the start, release at the end
+    reservation_id = _book(client, 1, start, end).get_json()['reservation_id']
+    with app.app_context():
+        counts = booking.advance_windows(now=start + timedelta(minutes=5))
+        assert counts == {'checked_in': 1, 'ended': 0, 'expired': 0}
+        reservation = db.session.get(Reservation, reservation_id)
+        assert reservation.parking_timestamp == start  # billed from the window start
+        assert not reservation.upcoming and reservation.leaving_timestamp is None
+        assert _spot_status(1) == 'O'
+        assert aggregates.user_totals(USER_ID)['active'] == 1
+
+        counts = booking.advance_windows(now=end + timedelta(minutes=5))
+        assert counts == {'checked_in': 0, 'ended': 1, 'expired': 0}
+        reservation = db.session.get(Reservation, reservation_id)
+        assert reservation.leaving_timestamp == end
+        assert reservation.parking_cost == 20.0
+        assert _spot_status(1) == 'A'
+        totals = aggregates.user_totals(USER_ID)
+        assert (totals['bookings'], totals['completed'], totals['revenue']) == (1, 1, 20.0)
+
+        # the rollups kept up as it went, a rebuild agrees with them
+        kept = rollups._rollup_totals(lot_id=1)
+        rollups.rebuild()
+        assert rollups._rollup_totals(lot_id=1) == pytest.approx(kept)
+        assert (kept['bookings'], kept['completed'], kept['revenue']) == (1, 1, 20.0)
+
+
+def test_window_expires_while_spot_is_taken(app):
+    client = app.test_client()
+    start, end = _window(timedelta(hours=3), timedelta(hours=1))
+    reservation_id = _book(client, 2, start, end).get_json()['reservation_id']
+    with app.app_context():
+        # a walk-in that never leaves
+        db.session.query(ParkingSpot).filter(ParkingSpot.id == 2).update({'status': 'O'})
+        db.session.commit()
+        assert booking.advance_windows(now=start + timedelta(minutes=1))['checked_in'] == 0
+        assert booking.advance_windows(now=end)['expired'] == 1
+        assert db.session.get(Reservation, reservation_id) is None
+        db.session.query(ParkingSpot).filter(ParkingSpot.id == 2).update({'status': 'A'})
+        db.session.commit()
+
+
+def test_walkin_rechecks_the_database(app):
+    client = app.test_client()
+    with app.app_context():
+        windows.drop(1)
+        availability.refresh_lot(1)
+        start, end = _window(timedelta(minutes=10), timedelta(hours=1))
+        assert not windows.conflicts(1, 3, start, end)  # the index is loaded - and about to go stale
+        # another worker books spot 3 in advance
+        db.session.add(Reservation(spot_id=3, user_id=USER_ID, parking_timestamp=start,
+                                   start_time=start, end_time=end))
+        db.session.commit()
+        assert not windows.conflicts(1, 3, start, end)
+
+        response = client.post('/reserve', json={'user_id': USER_ID, 'spot_id': 3})
+        assert response.status_code == 400
+        response = client.post('/api/reservations:batch', json={'reservations': [{'user_id': USER_ID, 'spot_id': 3}]})
+        assert response.get_json()['results'][0]['error'] == 'spot is booked in advance'
+        assert _spot_status(3) == 'A'
+
+        # any-spot walk-ins get the others, and then nothing
+        taken = [booking.book_in_lot(1, USER_ID, 5) for _ in range(2)]
+        assert sorted(r.spot_id for r in taken) == [1, 2]
+        assert booking.book_in_lot(1, USER_ID, 5) is None
+        assert _spot_status(3) == 'A'
+        for reservation in taken:
+            assert booking.release_reservation(reservation)
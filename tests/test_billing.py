@@ -0,0 +1,91 @@
+# Tariff.cost() is the reference price; the bulk recompute prices on SQLite
+# with Tariff.cost_expression() instead, so the two must agree to the cent.
+
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from app import create_app
+from controllers.config import get_config
+from controllers.extensions import db
+from models import billing
+from models.models import ParkingLot, ParkingSpot, Reservation
+
+PRICES = ['10', '12.5', '19.99', '7.3', '0.25', '33.33']
+TARIFFS = [(15, 10), (15, 0), (10, 8), (7, 0), (1, 24), (60, 3)]
+
+
+def _stays(count):
+    # short and long stays, exact step boundaries and a few microseconds either side of them
+    rng = random.Random(42)
+    start = datetime(2024, 3, 1, 8, 0, 0)
+    stays = []
+    for i in range(count):
+        parked = start + timedelta(minutes=rng.randint(0, 60 * 24 * 30), microseconds=rng.randint(0, 999999))
+        kind = i % 4
+        if kind == 0:
+            length = timedelta(minutes=rng.randint(0, 3 * 1440), microseconds=rng.randint(0, 999999))
+        elif kind == 1:
+            length = timedelta(minutes=rng.choice([0, 1, 7, 10, 15, 30, 60, 1440, 2880]))
+        elif kind == 2:
+            length = timedelta(minutes=rng.choice([15, 30, 1440]), microseconds=rng.choice([-31, -30, -1, 1, 29, 30, 31]))
+        else:
+            length = timedelta(seconds=rng.randint(0, 120))
+        stays.append((parked, parked + length))
+    return stays
+
+
+@pytest.fixture(scope='module')
+def app():
+    app = create_app(get_config('testing'))
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin'})
+    for i, price in enumerate(PRICES):
+        client.post('/admin/lots/create', data={
+            'prime_location_name': f'Lot {i}', 'price': price, 'address': f'{i} Main St',
+            'pin_code': f'56000{i}', 'maximum_number_of_spots': '1'})
+    with app.app_context():
+        spots = [spot_id for (spot_id,) in db.session.query(ParkingSpot.id).order_by(ParkingSpot.id)]
+        assert len(spots) == len(PRICES)
+        db.session.add_all(Reservation(spot_id=spots[i % len(spots)], user_id=1, parking_timestamp=parked,
+                                       leaving_timestamp=left)
+                           for i, (parked, left) in enumerate(_stays(2000)))
+        db.session.commit()
+    return app
+
+
+def _reference(rules):
+    rows = (db.session.query(Reservation.id, Reservation.parking_timestamp, Reservation.leaving_timestamp,
+                             ParkingLot.price)
+            .join(ParkingSpot, Reservation.spot_id == ParkingSpot.id)
+            .join(ParkingLot, ParkingSpot.lot_id == ParkingLot.id))
+    return {rid: rules.cost(parked, left, price) for rid, parked, left, price in rows}
+
+
+@pytest.mark.parametrize('increment, cap', TARIFFS)
+def test_cost_expression_matches_cost(app, increment, cap):
+    rules = billing.Tariff(increment, cap)
+    with app.app_context():
+        expected = _reference(rules)
+        priced = dict(db.session.execute(
+            select(Reservation.id, rules.cost_expression(Reservation.parking_timestamp,
+                                                         Reservation.leaving_timestamp, ParkingLot.price))
+            .join(ParkingSpot, Reservation.spot_id == ParkingSpot.id)
+            .join(ParkingLot, ParkingSpot.lot_id == ParkingLot.id)).all())
+    mismatches = {rid: (cost, priced[rid]) for rid, cost in expected.items() if priced[rid] != cost}
+    assert not mismatches, list(mismatches.items())[:10]
+
+
+def test_recompute_costs_matches_cost(app):
+    with app.app_context():
+        db.session.query(Reservation).update({Reservation.parking_cost: None})
+        db.session.commit()
+        priced, lots, earliest = billing.recompute_costs(batch_size=300)
+        assert priced == 2000
+        assert len(lots) == len(PRICES)
+        assert earliest == min(parked for (parked,) in db.session.query(Reservation.parking_timestamp)).date()
+        expected = _reference(billing.tariff())
+        stored = dict(db.session.query(Reservation.id, Reservation.parking_cost))
+    assert stored == expected
@@ -0,0 +1,91 @@
+# Query budgets for the main pages and api endpoints
+# Each route runs under queries.assert_max_queries() with every cache
+# emptied first, so a change that brings back a query per lot / spot /
+# reservation fails here instead of showing up in production. If a budget
+# has to go up on purpose, bump the number next to the route.
+#
+#   python -m pytest -q tests
+
+import pytest
+
+from app import create_app
+from controllers.cache import cache
+from controllers.config import get_config
+from controllers.fragments import fragments
+from controllers.lotsearch import lot_search
+from models import queries
+
+LOTS = 5
+SPOTS_PER_LOT = 20
+BOOKINGS = 6
+
+# (name, who, method, url, budget) - budgets are for a cold request
+ROUTES = [
+    ('home', 'anon', 'GET', '/', 0),
+    ('home_logged_in', 'user', 'GET', '/', 4),
+    ('admin_dashboard', 'admin', 'GET', '/admin/dashboard', 7),
+    ('admin_lots', 'admin', 'GET', '/admin/lots', 2),
+    ('admin_view_spots', 'admin', 'GET', '/admin/lots/1/spots', 3),
+    ('lot_summary', 'admin', 'GET', '/admin/lots/1/summary', 7),
+    ('user_dashboard', 'user', 'GET', '/user/dashboard', 5),
+    ('user_lots', 'user', 'GET', '/user/lots', 2),
+    ('user_lots_search', 'user', 'GET', '/user/lots?q=lot', 3),
+    ('user_reservations', 'user', 'GET', '/user/reservations', 5),
+    ('api_parking_lots', 'anon', 'GET', '/parking-lots', 2),
+    ('api_lot_search', 'anon', 'GET', '/parking-lots/search?q=main', 2),
+    ('api_lot_spots', 'anon', 'GET', '/parking-lot/1/spots', 2),
+    ('api_lot_spots_bitmap', 'anon', 'GET', '/parking-lot/1/spots?format=bitmap', 2),
+    ('api_user_reservations', 'anon', 'GET', '/user/2/reservations', 2),
+]
+
+
+def _clear_caches():
+    cache.clear()
+    fragments.clear()
+    lot_search.invalidate()
+
+
+@pytest.fixture(scope='module')
+def app():
+    app = create_app(get_config('testing'))
+    _clear_caches()
+    return app
+
+
+@pytest.fixture(scope='module')
+def clients(app):
+    admin = app.test_client()
+    assert admin.post('/login', data={'username': 'admin', 'password': 'admin'}).status_code == 302
+    for i in range(LOTS):
+        response = admin.post('/admin/lots/create', data={
+            'prime_location_name': f'Lot {i}', 'price': '10', 'address': f'{i} Main St',
+            'pin_code': f'56000{i}', 'maximum_number_of_spots': str(SPOTS_PER_LOT)})
+        assert response.status_code == 302
+
+    user = app.test_client()
+    user.post('/register', data={'username': 'bob', 'password': 'pw'})
+    assert user.post('/login', data={'username': 'bob', 'password': 'pw'}).status_code == 302
+    for i in range(BOOKINGS):
+        assert user.post(f'/user/lots/{i % LOTS + 1}/book').status_code == 302
+    # leave some stays open and end the rest, so both kinds are on the pages
+    for reservation_id in range(1, BOOKINGS // 2 + 1):
+        assert user.post(f'/user/reservations/{reservation_id}/release').status_code == 302
+    return {'anon': app.test_client(), 'admin': admin, 'user': user}
+
+
+@pytest.mark.parametrize('name, who, method, url, budget', ROUTES, ids=[route[0] for route in ROUTES])
+def test_route_query_budget(app, clients, name, who, method, url, budget):
+    _clear_caches()
+    client = clients[who]
+    with app.app_context():
+        with queries.assert_max_queries(budget, label=name):
+            response = client.open(url, method=method)
+    assert response.status_code == 200, response.status_code
+
+
+def test_booking_query_budget(app, clients):
+    _clear_caches()
+    with app.app_context():
+        with queries.assert_max_queries(9, label='book_spot'):
+            response = clients['user'].post('/user/lots/1/book')
+    assert response.status_code == 302